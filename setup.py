@@ -34,5 +34,5 @@ else:
               'endroid.plugins.sms',
           ],
           package_dir={'endroid': 'src/endroid'},
-          requires=['treq', 'twisted', 'webexteamssdk', 'autobahn']
+          requires=['treq', 'twisted', 'autobahn']
           )
@@ -17,13 +17,21 @@ from twisted.python import log  # used for xml logging
 
 # endroid base layer
 from endroid.webexhandler import WebexHandler
-from endroid.webex_client import WebexClient
+from endroid.webex_client import WebexClient, INGEST_WEBSOCKET
+from endroid.ingest import (DEFAULT_MAX_DEPTH, DEFAULT_SHED_ORDER,
+                            parse_shed_order)
+from endroid.replay import Recorder
+from endroid.outbound import DEFAULT_MAX_IN_FLIGHT
+from endroid.roomcache import DEFAULT_TTL
+from endroid.attachments import DEFAULT_MAX_SIZE, DEFAULT_MAX_DOWNLOADS
+from endroid.quota import DEFAULT_QUOTAS, parse_quota
 # top layer
 from endroid.usermanagement import UserManagement
 from endroid.messagehandler import MessageHandler
 # utilities
 from endroid.confparser import Parser
 from endroid.database import Database
+from endroid.cron import Cron
 import endroid.manhole
 
 
@@ -87,14 +95,60 @@ class Endroid(object):
         logging.info("Using " + dbfile + " as database file")
         Database.setFile(dbfile)
 
-        self.client = WebexClient(self.authorization) 
-
-        self.webexhandler = WebexHandler()
+        ingestion = self.conf.get("setup", "ingestion",
+                                  default=INGEST_WEBSOCKET)
+        logging.info("Receiving activities by " + ingestion)
+
+        recorder = None
+        if args.record:
+            recorder = Recorder(args.record)
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          recorder.close)
+            logging.info("Recording activities to " + recorder.path)
+
+        queue_depth = self.conf.get("setup", "ingest_queue_depth",
+                                    default=DEFAULT_MAX_DEPTH)
+        shed_order = parse_shed_order(
+            "ingest_shed_order",
+            self.conf.get("setup", "ingest_shed_order",
+                          default=DEFAULT_SHED_ORDER))
+        send_concurrency = self.conf.get("setup", "send_concurrency",
+                                         default=DEFAULT_MAX_IN_FLIGHT)
+
+        # Quotas are given as 'quota_<family> = <calls per second>, <burst>'
+        # or just 'quota_<family> = <calls per second>'
+        api_quotas = {}
+        for family, (rate, burst) in DEFAULT_QUOTAS.items():
+            key = "quota_" + family
+            api_quotas[family] = parse_quota(
+                key, self.conf.get("setup", key, default=(rate, burst)), burst)
+
+        self.client = WebexClient(self.authorization, rooms=rooms,
+                                  ingestion=ingestion,
+                                  queue_depth=int(queue_depth),
+                                  shed_order=shed_order,
+                                  recorder=recorder,
+                                  send_concurrency=int(send_concurrency),
+                                  api_quotas=api_quotas)
+
+        cache_ttl = self.conf.get("setup", "room_cache_ttl",
+                                  default=DEFAULT_TTL)
+        attachment_max_size = self.conf.get("setup", "attachment_max_size",
+                                            default=DEFAULT_MAX_SIZE)
+        attachment_downloads = self.conf.get("setup", "attachment_downloads",
+                                             default=DEFAULT_MAX_DOWNLOADS)
+        self.webexhandler = WebexHandler(
+            cache_ttl=float(cache_ttl),
+            attachment_max_size=int(attachment_max_size),
+            attachment_downloads=int(attachment_downloads))
 
         self.webexhandler.setHandlerParent(self.client)
-        self.client.set_callbacks(connected=self.webexhandler.connected,
-                                  on_message=self.webexhandler.onMessage,
-                                  on_membership=self.webexhandler.onMembership)
+        self.client.set_callbacks(
+            connected=self.webexhandler.connected,
+            on_message=self.webexhandler.onMessage,
+            on_membership=self.webexhandler.onMembership,
+            accept_activity=self.webexhandler.accept_activity,
+            on_room_change=self.webexhandler.onRoomChange)
 
         self.usermanagement = UserManagement(self.webexhandler,
                                              self.conf)
@@ -102,6 +156,8 @@ class Endroid(object):
         self.messagehandler = MessageHandler(self.webexhandler,
                                              self.usermanagement,
                                              config=self.conf)
+        # cron jobs are watched for blocking the reactor like handlers are
+        Cron.get().watchdog = self.messagehandler.watchdog
 
     def run(self):
         reactor.run()
@@ -168,6 +224,9 @@ def main(args):
                         help="Additionally log all traffic.")
     parser.add_argument("-w", "--logtwisted", action='store_true',
                         help="Additionally include twisted logging.")
+    parser.add_argument("-r", "--record", default=None, metavar="FILE",
+                        help="Record received activities to FILE, for "
+                        "replaying with 'python -m endroid.replay'.")
     parser.add_argument("-m", "--manhole", const=True, nargs='?', 
                         metavar="user@host:port", 
                         help="Login name, host and port for ssh access. "
@@ -190,7 +249,10 @@ def main(args):
 
     droid = Endroid(conffile, args=args)
 
-    manhole_dict = dict([('droid', droid)] + globals().items())
+    # e.g. 'print handler_stats.report()' in the manhole
+    manhole_dict = dict([('droid', droid),
+                         ('handler_stats', droid.messagehandler.handler_stats)]
+                        + globals().items())
     manhole_setup(args.manhole, droid.conf, manhole_dict)
 
     # Start the reactor
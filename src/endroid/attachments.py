@@ -0,0 +1,180 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Access to the files attached to Webex messages.
+
+Attachments are only downloaded when a plugin asks for them, and are
+streamed in chunks to a temporary file or a callable rather than held in
+memory.
+"""
+
+import os
+import re
+import logging
+import tempfile
+
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone, PotentialDataLoss
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+logger = logging.getLogger("webex-attachments")
+
+# Largest attachment (in bytes) that will be downloaded
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+# Number of attachments downloaded at once
+DEFAULT_MAX_DOWNLOADS = 2
+
+FILENAME_RE = re.compile(r'filename="?([^";]+)"?')
+
+
+class AttachmentTooLarge(Exception):
+    """An attachment is bigger than the maximum size allowed."""
+
+
+class _Download(Protocol):
+    """
+    Passes a response body to write in chunks, stopping if it exceeds
+    max_size bytes or write raises.
+    """
+    def __init__(self, finished, write, max_size):
+        self.finished = finished
+        self.write = write
+        self.max_size = max_size
+        self.size = 0
+        self._error = None
+
+    def abort(self, failure):
+        """Stop receiving the body, failing with failure."""
+        if self._error is None:
+            self._error = failure
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self._error is not None:
+            return
+        self.size += len(data)
+        try:
+            if self.size > self.max_size:
+                raise AttachmentTooLarge(
+                    "Attachment is over {} bytes".format(self.max_size))
+            self.write(data)
+        except Exception:
+            self.abort(Failure())
+
+    def connectionLost(self, reason):
+        if self._error is not None:
+            self.finished.errback(self._error)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.size)
+        else:
+            self.finished.errback(reason)
+
+
+class AttachmentFetcher(object):
+    """
+    Downloads attachments, a limited number at a time.
+
+    Attributes:
+        api       - The WebexAPI to download with.
+        max_size  - Largest attachment (in bytes) downloaded.
+        downloads - DeferredSemaphore limiting concurrent downloads.
+    """
+    def __init__(self, api, max_size=DEFAULT_MAX_SIZE,
+                 max_downloads=DEFAULT_MAX_DOWNLOADS):
+        self.api = api
+        self.max_size = max_size
+        self.downloads = defer.DeferredSemaphore(max_downloads)
+
+    def info(self, url):
+        """
+        Return a Deferred firing with the (filename, size, content type) of an
+        attachment, without downloading it.
+        """
+        def got_headers(response):
+            headers = response.headers
+            disposition = _header(headers, 'Content-Disposition') or ""
+            match = FILENAME_RE.search(disposition)
+            length = _header(headers, 'Content-Length')
+            return (match.group(1) if match else None,
+                    int(length) if length is not None else None,
+                    _header(headers, 'Content-Type'))
+
+        return self.api.open(url, method="HEAD").addCallback(got_headers)
+
+    def fetch(self, url, write):
+        """
+        Download an attachment, passing its contents to write in chunks.
+        Returns a Deferred firing with its size, or failing with
+        AttachmentTooLarge if it is over max_size.
+        """
+        return self.downloads.run(self._fetch, url, write)
+
+    def _fetch(self, url, write):
+        def got_response(response):
+            d = defer.Deferred()
+            download = _Download(d, write, self.max_size)
+            response.deliverBody(download)
+            if response.length != UNKNOWN_LENGTH and \
+                    response.length > self.max_size:
+                # No need to read any of it
+                download.abort(Failure(AttachmentTooLarge(
+                    "Attachment is {} bytes, over the limit of {}".format(
+                        response.length, self.max_size))))
+            return d
+
+        return self.api.open(url).addCallback(got_response)
+
+
+class Attachment(object):
+    """
+    A file attached to a received message. Nothing is downloaded until one
+    of its methods is called.
+
+    Attributes:
+        url - The URL of the file's contents.
+    """
+    def __init__(self, url, fetcher):
+        self.url = url
+        self._fetcher = fetcher
+
+    def info(self):
+        """
+        Return a Deferred firing with the file's (filename, size, content
+        type), any of which may be None if Webex doesn't say.
+        """
+        return self._fetcher.info(self.url)
+
+    def stream(self, write):
+        """
+        Download the file, calling write with each chunk of its contents as
+        it arrives. Returns a Deferred firing with the file's size.
+        """
+        return self._fetcher.fetch(self.url, write)
+
+    def save(self, directory=None):
+        """
+        Download the file to a new temporary file (in directory, if given).
+        Returns a Deferred firing with the file's path. The caller is
+        responsible for deleting it.
+        """
+        fd, path = tempfile.mkstemp(prefix="endroid-", dir=directory)
+        f = os.fdopen(fd, 'wb')
+
+        def done(result):
+            f.close()
+            if isinstance(result, Failure):
+                os.remove(path)
+                return result
+            return path
+
+        return self.stream(f.write).addBoth(done)
+
+
+def _header(headers, name):
+    values = headers.getRawHeaders(name)
+    return values[0] if values else None
@@ -0,0 +1,54 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Running the handlers of plugins declared as blocking in threads.
+
+Code in such a thread must not touch Twisted directly. The APIs plugins use
+(their messages and rosters, the MessageHandler and UserManagement methods
+that send messages or look up or change memberships, and MessageUpdaters)
+are decorated with on_reactor, so that calls to them from a blocking
+handler are made on the reactor thread instead.
+"""
+
+import functools
+import threading
+
+from twisted.internet import reactor, threads
+
+_worker = threading.local()
+
+
+def in_blocking_thread():
+    """Return whether the caller is a blocking plugin's handler thread."""
+    return getattr(_worker, 'blocking', False)
+
+
+def run_blocking(pool, fn, *args):
+    """
+    Call fn(*args) in a thread from pool, returning a Deferred firing with
+    its result.
+    """
+    def run():
+        _worker.blocking = True
+        try:
+            return fn(*args)
+        finally:
+            _worker.blocking = False
+    return threads.deferToThreadPool(reactor, pool, run)
+
+
+def on_reactor(fn):
+    """
+    Decorate a function so that calls to it from a blocking handler's thread
+    are made on the reactor thread. The thread waits for the result (and for
+    the Deferred's result, if it returns one).
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not in_blocking_thread():
+            return fn(*args, **kwargs)
+        return threads.blockingCallFromThread(reactor, fn, *args, **kwargs)
+    return wrapper
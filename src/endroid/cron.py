@@ -5,6 +5,7 @@
 # -----------------------------------------
 
 from endroid.database import Database
+from endroid.watchdog import Watchdog
 
 from twisted.internet import reactor
 from pytz import timezone
@@ -100,10 +101,15 @@ class CronSing(object):
     unpickled from params (so even if the function needs no arguments it should
     allow for one eg def foo(_) rather than def foo()).
 
+    Functions are called under watchdog, which reports any that block the
+    reactor (by default it doesn't watch; EnDroid sets it to its
+    MessageHandler's).
+
     """
     def __init__(self):
         self.delayedcall = None
         self.fun_dict = {}
+        self.watchdog = Watchdog(threshold=0)
         self.db = Database('Cron')
         # table for tasks which will be called after a certain amount of time
         if not self.db.table_exists('cron_delay'):
@@ -200,8 +206,10 @@ class CronSing(object):
                 self.db.delete(cron['table'], cron['data'])
                 logging.info("Running Cron: {}".format(cron['data']['reg_name']))
                 params = cPickle.loads(str(cron['data']['params']))
+                reg_name = cron['data']['reg_name']
                 try:
-                    self.fun_dict[cron['data']['reg_name']](params)
+                    with self.watchdog.watching(reg_name):
+                        self.fun_dict[reg_name](params)
                 except KeyError:
                     # If there has been a restart we will have lost our fun_dict
                     # If functions have not been re-registered then we will have a problem.
@@ -0,0 +1,109 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Statistics on how long plugins' message handlers take, and how often they
+fail.
+"""
+
+import bisect
+
+# Upper bounds (in seconds) of the buckets handler latencies are counted in.
+# A last bucket counts everything slower.
+LATENCY_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+# Columns a report can be sorted by
+SORT_KEYS = ('total', 'mean', 'max', 'calls', 'errors')
+
+
+class HandlerStats(object):
+    """
+    Counts of the calls to one handler.
+
+    Attributes:
+        calls   - Number of times the handler was called.
+        errors  - Number of calls that raised, failed or timed out.
+        total   - Total seconds spent in the handler (until its Deferred
+                  fired, for handlers returning one).
+        max     - Longest call, in seconds.
+        buckets - Count of calls in each of LATENCY_BUCKETS, and a last count
+                  of slower calls.
+    """
+    __slots__ = ("calls", "errors", "total", "max", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    @property
+    def mean(self):
+        return self.total / self.calls if self.calls else 0.0
+
+    def record(self, elapsed, failed=False):
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+
+class HandlerStatsTable(object):
+    """
+    HandlerStats for each handler, keyed by (plugin name, callback name,
+    category). Recording is just a few additions; the work of summarising is
+    left until a report is asked for.
+    """
+    def __init__(self):
+        self._stats = {}
+
+    def handler(self, plugin, name, category):
+        """Return the HandlerStats to record a handler's calls in."""
+        key = (plugin, name, category)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = HandlerStats()
+        return stats
+
+    def items(self, plugin=None):
+        """
+        Return a list of ((plugin, name, category), HandlerStats), for every
+        handler or just those of plugin.
+        """
+        return [(key, stats) for key, stats in self._stats.items()
+                if plugin is None or key[0] == plugin]
+
+    def clear(self):
+        self._stats.clear()
+
+    def report(self, plugin=None, sort='total', limit=None):
+        """
+        Return a table (as a string) of the handlers' statistics, slowest
+        (by the sort column) first, optionally for just one plugin.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError("Can't sort by {}, only by {}".format(
+                sort, ", ".join(SORT_KEYS)))
+        items = sorted(self.items(plugin),
+                       key=lambda item: getattr(item[1], sort), reverse=True)
+        if limit is not None:
+            items = items[:limit]
+        if not items:
+            return "No handler statistics recorded."
+
+        buckets = ["<={:g}s".format(bound) for bound in LATENCY_BUCKETS]
+        buckets.append(">{:g}s".format(LATENCY_BUCKETS[-1]))
+        lines = ["handler: calls errors total(s) mean(ms) max(ms) | " +
+                 " ".join(buckets)]
+        for (plugin, name, category), stats in items:
+            lines.append("{}.{} ({}): {} {} {:.3f} {:.2f} {:.2f} | {}".format(
+                plugin, name, category, stats.calls, stats.errors,
+                stats.total, stats.mean * 1000, stats.max * 1000,
+                " ".join(str(count) for count in stats.buckets)))
+        return "\n".join(lines)
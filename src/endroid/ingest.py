@@ -0,0 +1,287 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# Created by Jonathan Millican
+# -----------------------------------------
+
+"""
+Buffering of inbound Webex activities between the websocket and
+WebexHandler.
+"""
+
+import logging
+from collections import Counter, OrderedDict, deque
+
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+
+logger = logging.getLogger("webex-ingest")
+
+# Number of recently seen activity ids remembered for de-duplication
+DEFAULT_MAX_SEEN = 2048
+
+
+class _Slot(object):
+    """A place in a room's delivery order, filled when its fetch completes."""
+    __slots__ = ("activity_id", "done", "message")
+
+    def __init__(self, activity_id):
+        self.activity_id = activity_id
+        self.done = False
+        self.message = None
+
+
+class IngestBuffer(object):
+    """
+    De-duplicates activities and delivers each room's messages in the order
+    their activities arrived, even if the fetches complete out of order.
+
+    Attributes:
+        deliver  - Callback called with each message, in order per room.
+        max_seen - Number of recent activity ids remembered; older ids are
+                   forgotten in least recently seen order.
+        stats    - Counter of 'delivered' messages, 'duplicates' dropped,
+                   'reordered' messages that had to wait for an earlier
+                   fetch, and the 'max_reorder_depth' seen.
+    """
+    def __init__(self, deliver, max_seen=DEFAULT_MAX_SEEN):
+        self.deliver = deliver
+        self.max_seen = max_seen
+        self.stats = Counter()
+        self._seen = OrderedDict()
+        self._pending = {}  # room : deque of _Slots
+
+    def seen(self, activity_id):
+        """
+        Record an activity id, returning True if it has been seen recently (in
+        which case the activity should be dropped).
+        """
+        if activity_id in self._seen:
+            # Refresh its position in the LRU
+            del self._seen[activity_id]
+            self._seen[activity_id] = True
+            self.stats['duplicates'] += 1
+            logger.debug("Dropping duplicate activity %s", activity_id)
+            return True
+
+        self._seen[activity_id] = True
+        if len(self._seen) > self.max_seen:
+            self._seen.popitem(last=False)
+        return False
+
+    def add(self, room, activity_id, d):
+        """
+        Queue delivery of the message that Deferred d will produce for the
+        given activity (which should already have been checked with seen()).
+        d may fire with None (or fail) if there is nothing to deliver, in
+        which case later messages for the room are released.
+        """
+        slot = _Slot(activity_id)
+        self._pending.setdefault(room, deque()).append(slot)
+        d.addBoth(self._completed, room, slot)
+
+    def depth(self, room=None):
+        """Return the number of messages awaiting delivery (for a room)."""
+        if room is not None:
+            return len(self._pending.get(room, ()))
+        return sum(len(q) for q in self._pending.values())
+
+    def _completed(self, result, room, slot):
+        if isinstance(result, Failure):
+            logger.error("Fetch for activity %s failed: %s",
+                         slot.activity_id, result.getErrorMessage())
+            result = None
+        slot.done = True
+        slot.message = result
+
+        queue = self._pending[room]
+        if queue[0] is not slot:
+            # Waiting on earlier fetches for this room
+            position = next(i for i, s in enumerate(queue) if s is slot)
+            self.stats['reordered'] += 1
+            self.stats['max_reorder_depth'] = max(
+                self.stats['max_reorder_depth'], position)
+        self._flush(room)
+
+    def _flush(self, room):
+        queue = self._pending[room]
+        while queue and queue[0].done:
+            slot = queue.popleft()
+            if slot.message is None:
+                continue
+            self.stats['delivered'] += 1
+            try:
+                self.deliver(slot.message)
+            except Exception:
+                logger.exception("Got exception processing message %s",
+                                 slot.activity_id)
+        if not queue:
+            del self._pending[room]
+
+
+# Categories of work passed through the IngestQueue
+CATEGORY_SELF = "self"
+CATEGORY_MESSAGE = "message"
+CATEGORY_MEMBERSHIP = "membership"
+CATEGORY_UNHANDLED = "unhandled"
+
+DEFAULT_MAX_DEPTH = 1000
+# Categories in the order their work is dropped when the queue is full
+DEFAULT_SHED_ORDER = (CATEGORY_SELF, CATEGORY_UNHANDLED, CATEGORY_MEMBERSHIP,
+                      CATEGORY_MESSAGE)
+# Number of queued items processed per reactor iteration
+DEFAULT_BATCH_SIZE = 20
+
+
+def parse_shed_order(key, value):
+    """
+    Return the tuple of categories given by value, the setting key: a list
+    of categories or a single one. Raises ValueError naming the setting if
+    any category is unknown.
+    """
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    unknown = [category for category in value
+               if category not in DEFAULT_SHED_ORDER]
+    if unknown:
+        raise ValueError("{} has unknown categories {} (expected some of "
+                         "{})".format(key, ", ".join(map(str, unknown)),
+                                      ", ".join(DEFAULT_SHED_ORDER)))
+    return tuple(value)
+
+
+class _Work(object):
+    __slots__ = ("category", "fn", "args", "queued_at", "shed")
+
+    def __init__(self, category, fn, args, queued_at):
+        self.category = category
+        self.fn = fn
+        self.args = args
+        self.queued_at = queued_at
+        self.shed = False
+
+
+class IngestQueue(object):
+    """
+    Bounded queue of inbound work (message and membership handling), drained
+    a batch at a time so that a burst of activity doesn't monopolise the
+    reactor.
+
+    When the queue is full, work is shed according to its category: the
+    oldest queued item of the first category in shed_order that has any is
+    dropped, unless the new item's own category comes first, in which case
+    the new item is dropped instead. Categories missing from shed_order are
+    only ever dropped if nothing else can be.
+
+    Attributes:
+        max_depth  - Maximum number of items queued.
+        shed_order - Categories in the order their work is dropped.
+        batch_size - Number of items processed per reactor iteration.
+        stats      - Counter of items 'queued', 'processed' and 'shed' (also
+                     by category, e.g. 'shed.self'), and the 'max_depth' seen.
+    """
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH,
+                 shed_order=DEFAULT_SHED_ORDER, batch_size=DEFAULT_BATCH_SIZE,
+                 clock=reactor):
+        self.max_depth = max_depth
+        self.shed_order = tuple(shed_order)
+        self.batch_size = batch_size
+        self.stats = Counter()
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._clock = clock
+        self._queue = deque()
+        self._by_category = {}  # category : deque of _Work, oldest first
+        self._depth = 0
+        self._drain_call = None
+
+    def put(self, category, fn, *args):
+        """
+        Queue a call to fn(*args). Returns False if the call was dropped
+        because the queue is full.
+        """
+        if self._depth >= self.max_depth and not self._make_room(category):
+            self._record_shed(category)
+            return False
+
+        if len(self._queue) > 2 * self.max_depth:
+            # Clear out work that has been shed
+            self._queue = deque(w for w in self._queue if not w.shed)
+
+        work = _Work(category, fn, args, self._clock.seconds())
+        self._queue.append(work)
+        self._by_category.setdefault(category, deque()).append(work)
+        self._depth += 1
+        self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self._depth)
+        if self._drain_call is None:
+            self._drain_call = self._clock.callLater(0, self._drain)
+        return True
+
+    def depth(self):
+        """Return the number of items waiting to be processed."""
+        return self._depth
+
+    def metrics(self):
+        """Return a dict summarising the queue's depth and wait times."""
+        processed = self.stats['processed']
+        return {'depth': self._depth,
+                'max_depth': self.stats['max_depth'],
+                'queued': self.stats['queued'],
+                'processed': processed,
+                'shed': dict((k.split('.', 1)[1], v)
+                             for k, v in self.stats.items()
+                             if k.startswith('shed.')),
+                'mean_wait': self.total_wait / processed if processed else 0.0,
+                'max_wait': self.max_wait}
+
+    def _make_room(self, category):
+        """Shed the oldest item of a lower priority category, if any."""
+        victims = self.shed_order
+        if category not in victims:
+            victims += (category,)
+        for victim in victims:
+            if victim == category:
+                return False
+            queued = self._by_category.get(victim)
+            if queued:
+                work = queued.popleft()
+                work.shed = True
+                self._depth -= 1
+                self._record_shed(victim)
+                return True
+        return False
+
+    def _record_shed(self, category):
+        self.stats['shed'] += 1
+        self.stats['shed.' + category] += 1
+        logger.warning("Ingest queue full (%u items), shedding %s work",
+                       self.max_depth, category)
+
+    def _drain(self):
+        self._drain_call = None
+        now = self._clock.seconds()
+        done = 0
+        while self._queue and done < self.batch_size:
+            work = self._queue.popleft()
+            if work.shed:
+                continue
+            self._by_category[work.category].popleft()
+            self._depth -= 1
+            done += 1
+
+            wait = now - work.queued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.stats['processed'] += 1
+            try:
+                work.fn(*work.args)
+            except Exception:
+                logger.exception("Got exception processing %s work",
+                                 work.category)
+
+        if self._depth:
+            self._drain_call = self._clock.callLater(0, self._drain)
+        else:
+            # Only shed items can be left
+            self._queue.clear()
@@ -6,15 +6,25 @@
 
 import logging
 from collections import namedtuple
+from contextlib import contextmanager
 
 import twisted.internet.reactor as reactor
+from twisted.internet import defer
+from twisted.python.threadpool import ThreadPool
+
+from endroid.outbound import DEFAULT_UPDATE_INTERVAL
+from endroid.handlerstats import HandlerStatsTable
+from endroid.watchdog import Watchdog, DEFAULT_THRESHOLD
+from endroid.blocking import run_blocking, on_reactor
 
 class Handler(object):
-    __slots__ = ("name", "priority", "callback")
+    __slots__ = ("name", "priority", "callback", "plugin")
     def __init__(self, priority, callback):
         self.name = callback.__name__
         self.priority = priority
         self.callback = callback
+        # the plugin the callback is a method of, if any
+        self.plugin = getattr(callback, '__self__', None)
 
     def __str__(self):
         return "{}: {}".format(self.priority, self.name)
@@ -37,23 +47,89 @@ class MessageHandler(object):
     PRIORITY_BULK = Priority.BULK
 
     FALLBACK_CONTEXT_TIMEOUT = 30
+    FALLBACK_HANDLER_TIMEOUT = 60
+    FALLBACK_BLOCK_THRESHOLD = DEFAULT_THRESHOLD
+    FALLBACK_BLOCKING_THREADS = 4
     # for if it's not even specified in the config file
+    FALLBACK_COALESCE_WINDOW = 0
 
 
-    def __init__(self, wh, um, config=None):
+    def __init__(self, wh, um, config=None, clock=reactor):
         self.wh = wh
         self.um = um
         # wh translates messages and gives them to us, needs to know who we are
         self._handlers = {}
+        # sorted tuples of the Handlers to call for each (type, category,
+        # room/user), built on first use and dropped when a callback is
+        # registered or a user's groups change
+        self._dispatch = {}
+        self.um.register_roster_callback(self._roster_changed)
         self.wh.set_message_handler(self)
         self.response_callbacks = {}
+        # the plugin whose callback is currently running, if any
+        self.active_plugin = None
+        # call counts, errors and latencies of each plugin's handlers
+        self.handler_stats = HandlerStatsTable()
 
         if config is not None:
             self.context_awareness_timeout = config.get("setup",
                                                         "context_response_timeout",
                                                         default=self.FALLBACK_CONTEXT_TIMEOUT)
+            self.coalesce_window = float(config.get(
+                "setup", "coalesce_window",
+                default=self.FALLBACK_COALESCE_WINDOW))
+            self.handler_timeout = float(config.get(
+                "setup", "handler_timeout",
+                default=self.FALLBACK_HANDLER_TIMEOUT))
+            block_threshold = float(config.get(
+                "setup", "block_threshold",
+                default=self.FALLBACK_BLOCK_THRESHOLD))
+            self.blocking_threads = int(config.get(
+                "setup", "blocking_threads",
+                default=self.FALLBACK_BLOCKING_THREADS))
         else:
             self.context_awareness_timeout = self.FALLBACK_CONTEXT_TIMEOUT
+            self.coalesce_window = self.FALLBACK_COALESCE_WINDOW
+            self.handler_timeout = self.FALLBACK_HANDLER_TIMEOUT
+            block_threshold = self.FALLBACK_BLOCK_THRESHOLD
+            self.blocking_threads = self.FALLBACK_BLOCKING_THREADS
+
+        # reports handler and cron callbacks that hold up the reactor
+        self.watchdog = Watchdog(block_threshold)
+        reactor.callWhenRunning(self.watchdog.start)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      self.watchdog.stop)
+        # the threads running blocking plugins' handlers, started when first
+        # needed
+        self._blocking_pool = None
+        # times handlers, and their Deferreds out
+        self._clock = clock
+        # dict of message : (DelayedCall timing its handlers out, set of its
+        # handlers' Deferreds still to fire)
+        self._running_handlers = {}
+
+    @contextmanager
+    def acting_for(self, plugin):
+        """
+        Attribute messages sent within the block to plugin, so they are sent
+        with its settings (e.g. its coalesce_window).
+        """
+        previous, self.active_plugin = self.active_plugin, plugin
+        try:
+            yield
+        finally:
+            self.active_plugin = previous
+
+    def _coalesce_window(self, msg):
+        """
+        Return the number of seconds msg may be held to be coalesced with
+        other messages to the same place: the coalesce_window of the plugin
+        that sent it, or the global default. Urgent messages go immediately.
+        """
+        if msg.priority == Priority.URGENT:
+            return 0
+        conf = getattr(msg.plugin, 'vars', None) or {}
+        return float(conf.get("coalesce_window", self.coalesce_window))
 
     def _register_context_callback(self, user, callback=None,
                                    noresponse_callback=None, timeout_time=0):
@@ -144,6 +220,7 @@ class MessageHandler(object):
         handlers = cathndlrs.setdefault(name, [])
         handlers.append(Handler(priority, callback))
         handlers.sort(key=lambda h: h.priority)
+        self._dispatch.clear()
 
         # this callback be called when we get messages sent by ourself
         if including_self:
@@ -151,20 +228,172 @@ class MessageHandler(object):
                                     priority=priority)
 
     def _get_handlers(self, typ, cat, name):
+        """
+        Return a tuple of the Handlers for messages of type 'typ' and
+        category 'cat' in room or from user 'name', sorted by priority.
+
+        """
+        key = (typ, cat, name)
+        try:
+            return self._dispatch[key]
+        except KeyError:
+            handlers = self._dispatch[key] = self._build_handlers(*key)
+            return handlers
+
+    def _build_handlers(self, typ, cat, name):
         dct = self._handlers.get(typ, {}).get(cat, {})
         if typ == 'chat':  # we need to lookup name's groups
             handlers = []
             for name in self.um.get_groups(name):
                 handlers.extend(dct.get(name, []))
             handlers.sort(key=lambda h: h.priority)
-            return handlers
+            return tuple(handlers)
         else:  # we are in a room so only one set of handlers to read
-            return dct.get(name, [])
+            return tuple(dct.get(name, []))
+
+    def _roster_changed(self, user, place):
+        # the user's groups may have changed, so their handlers may have too
+        for key in [key for key in self._dispatch
+                    if key[0] == 'chat' and key[2] == user]:
+            del self._dispatch[key]
 
     def _get_filters(self, typ, cat, name):
         return self._get_handlers(typ, cat + "_filter", name)
 
+    def handles_self(self, place, name):
+        """
+        Return whether any plugin is interested in messages EnDroid sent
+        itself to room or user 'name' - if not, they need not be fetched.
+
+        """
+        return bool(self._get_handlers(place, "recv_self", name) or
+                    self._get_handlers(place, "unhandled_self", name))
+
+    def accept_sender(self, place, sender, recipient):
+        """
+        Run the sender filters for a message that has not yet been fetched.
+
+        Sender filters only look at msg.sender (the message body is None), so
+        can be run before paying for the message to be retrieved. Returns
+        False if the message should be dropped.
+
+        """
+        msg = Message(place, sender, None, self, recipient)
+        name = recipient if place == "muc" else sender
+        filters = self._get_handlers(place, "recv_sender_filter", name)
+        return all(f.callback(msg) for f in filters)
+
+    def run_handler(self, msg, callback, args=(), plugin=None,
+                    category=None):
+        """
+        Call callback(msg, *args) as one of msg's handlers (so it must already
+        have been counted with msg.inc_handlers()), on behalf of plugin (by
+        default the plugin callback is a method of). The call is recorded in
+        handler_stats under the plugin's name, the callback's name and
+        category (e.g. 'recv').
+
+        The callback may return a Deferred to handle the message
+        asynchronously. If it raises, or its Deferred fails or is still
+        running when msg's handlers time out, the message is treated as
+        unhandled by it. However often the callback calls msg.unhandled() as
+        well, it only counts once. Returns a Deferred firing (with None) once
+        the callback has finished, so it never fails.
+
+        """
+        # Nested handlers (e.g. those of commands) count against the message
+        # itself, not the handler running them
+        if isinstance(msg, _HandlerMessage):
+            msg = msg.message
+        handler_msg = _HandlerMessage(msg)
+        if plugin is None:
+            plugin = getattr(callback, '__self__', None)
+        name = getattr(callback, '__name__', repr(callback))
+        plugin_name = getattr(plugin, 'name', "-")
+        stats = self.handler_stats.handler(plugin_name, name, category)
+        started = self._clock.seconds()
+        try:
+            if getattr(plugin, 'blocking', False):
+                result = run_blocking(self._get_blocking_pool(), callback,
+                                      _ThreadMessage(handler_msg, self,
+                                                     plugin), *args)
+            else:
+                with self.acting_for(plugin), self.watchdog.watching(
+                        "{}.{}".format(plugin_name, name)):
+                    result = callback(handler_msg, *args)
+        except Exception:
+            stats.record(self._clock.seconds() - started, failed=True)
+            logging.exception("Exception in handler %s", name)
+            handler_msg.unhandled()
+            return defer.succeed(None)
+        if not isinstance(result, defer.Deferred):
+            stats.record(self._clock.seconds() - started)
+            return defer.succeed(None)
+
+        def succeeded(_):
+            stats.record(self._clock.seconds() - started)
+
+        def failed(failure):
+            stats.record(self._clock.seconds() - started, failed=True)
+            if failure.check(defer.CancelledError):
+                logging.warning("Handler %s timed out", name)
+            else:
+                logging.error("Failure in handler %s: %s", name,
+                              failure.getTraceback())
+            handler_msg.unhandled()
+
+        result.addCallbacks(succeeded, failed)
+        self._time_out_handler(msg, result)
+        return result
+
+    def _time_out_handler(self, msg, d):
+        """
+        Cancel d, the Deferred of one of msg's handlers, if it hasn't fired
+        when msg's handlers time out: handler_timeout seconds after the first
+        of msg's handlers still running started. The time limit applies to
+        the message as a whole, so handlers started later get less time.
+
+        """
+        if not self.handler_timeout or d.called:
+            return
+        if msg not in self._running_handlers:
+            timeout = self._clock.callLater(self.handler_timeout,
+                                            self._handlers_timed_out, msg)
+            self._running_handlers[msg] = (timeout, set())
+        timeout, running = self._running_handlers[msg]
+        running.add(d)
+
+        def finished(result):
+            running.discard(d)
+            if not running and timeout.active():
+                timeout.cancel()
+                del self._running_handlers[msg]
+            return result
+        d.addBoth(finished)
+
+    def _handlers_timed_out(self, msg):
+        _, running = self._running_handlers.pop(msg)
+        logging.warning("Handlers of message from %s still running after "
+                        "%ss", msg.sender, self.handler_timeout)
+        for d in list(running):
+            d.cancel()
+
+    def _get_blocking_pool(self):
+        if self._blocking_pool is None:
+            self._blocking_pool = ThreadPool(0, self.blocking_threads,
+                                             name="endroid-blocking")
+            self._blocking_pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self._blocking_pool.stop)
+        return self._blocking_pool
+
     def _do_callback(self, cat, msg, failback=lambda m: None):
+        """
+        Run the cat handlers for msg, or call failback if there are none or
+        the filters reject it. The handlers' Deferreds run concurrently, and
+        failback is called once none of them has handled the message.
+        Returns a Deferred firing once every handler has finished.
+
+        """
         if msg.place == "muc":
             # get the handlers active in the room - note that these are already
             # sorted (sorting is done in the register_callback method)
@@ -179,6 +408,7 @@ class MessageHandler(object):
             filters = self._get_filters(msg.place, cat, msg.sender)
 
         log_list = []
+        finished = []
         if handlers and all(f.callback(msg) for f in filters):
             msg.set_unhandled_cb(failback)
             for i in handlers:
@@ -186,13 +416,10 @@ class MessageHandler(object):
 
             log_list.append("Did {} {} handlers (priority: cb):".format(len(handlers), cat))
             for handler in handlers:
-                try:
-                    handler.callback(msg)
-                    log_list.append(str(handler))
-                except Exception as e:
-                    log_list.append("Exception in {}:\n{}".format(handler.name, e))
-                    msg.dec_handlers()
-                    raise
+                finished.append(self.run_handler(msg, handler.callback,
+                                                 plugin=handler.plugin,
+                                                 category=cat))
+                log_list.append(str(handler))
         else:
             failback(msg)
         if log_list:
@@ -200,21 +427,23 @@ class MessageHandler(object):
                          "\n\t".join(log_list)))
         else:
             logging.info("Finished plugin callback - no plugins called.")
+        return defer.gatherResults(finished)
 
+    # Unhandled callbacks are queued, so they can be shed if EnDroid is busy
     def _unhandled(self, msg):
-        self._do_callback("unhandled", msg)
+        self.wh.schedule("unhandled", self._do_callback, "unhandled", msg)
 
     def _unhandled_self(self, msg):
-        self._do_callback("unhandled_self", msg)
+        self.wh.schedule("unhandled", self._do_callback, "unhandled_self", msg)
 
     # Do normal (recv) callbacks on msg. If no callbacks handle the message
     # then call unhandled callbacks (msg's failback is set self._unhandled_...
     # by the last argument to _do_callback).
     def receive_muc(self, msg):
-        self._do_callback("recv", msg, self._unhandled)
+        return self._do_callback("recv", msg, self._unhandled)
 
     def receive_self_muc(self, msg):
-        self._do_callback("recv_self", msg, self._unhandled_self)
+        return self._do_callback("recv_self", msg, self._unhandled_self)
 
     def receive_chat(self, msg):
         self._handle_context_callback(msg)  # attempt to use context callbacks
@@ -226,10 +455,11 @@ class MessageHandler(object):
         # msg is still a context-reply (msg.context_response is True) if
         # msg._context_dealt_with is False or True.
         if not msg._context_dealt_with:
-            self._do_callback("recv", msg, self._unhandled)
+            return self._do_callback("recv", msg, self._unhandled)
+        return defer.succeed(None)
 
     def receive_self_chat(self, msg):
-        self._do_callback("recv_self", msg, self._unhandled_self)
+        return self._do_callback("recv_self", msg, self._unhandled_self)
 
     def for_plugin(self, pluginmanager, plugin):
         return PluginMessageHandler(self, pluginmanager, plugin)
@@ -238,10 +468,23 @@ class MessageHandler(object):
 
     def register(self, name, callback, priority=Priority.NORMAL, muc_only=False,
                  chat_only=False, include_self=False, unhandled=False,
-                 send_filter=False, recv_filter=False):
-        if sum(1 for i in (unhandled, send_filter, recv_filter) if i) > 1:
-            raise TypeError("Only one of unhandled, send_filter or recv_filter "
-                            "may be specified")
+                 send_filter=False, recv_filter=False, sender_filter=False):
+        """
+        Register a callback for messages in room or group 'name'.
+
+        By default the callback handles received messages. Alternatively it
+        may be registered as an unhandled callback, or as a send, receive or
+        sender filter. Sender filters are receive filters that only inspect
+        msg.sender; they are run before the message has been fetched, so
+        msg.body is None.
+
+        Handlers (but not filters) may return a Deferred; see run_handler.
+
+        """
+        if sum(1 for i in (unhandled, send_filter, recv_filter,
+                           sender_filter) if i) > 1:
+            raise TypeError("Only one of unhandled, send_filter, recv_filter "
+                            "or sender_filter may be specified")
         if chat_only and muc_only:
             raise TypeError("Only one of chat_only or muc_only may be "
                             "specified")
@@ -252,6 +495,8 @@ class MessageHandler(object):
             cat = "send_filter"
         elif recv_filter:
             cat = "recv_filter"
+        elif sender_filter:
+            cat = "recv_sender_filter"
         else:
             cat = "recv"
 
@@ -262,39 +507,166 @@ class MessageHandler(object):
             self._register_callback(name, "muc", cat, callback,
                                     include_self, priority)
 
-    def send_muc(self, room, body, source=None, priority=Priority.NORMAL):
+    @on_reactor
+    def send_muc(self, room, body, source=None, priority=Priority.NORMAL,
+                 plugin=None):
         """
         Send muc message to room.
 
         The message will be run through any registered filters before it is
-        sent.
+        sent. plugin is the plugin sending it (by default, the one whose
+        callback is running), whose coalesce_window applies. source defaults
+        to EnDroid; such messages are held until the Webex client has looked
+        up EnDroid's identity.
+
+        Returns a Deferred firing with True once the message has been sent,
+        or False if it was filtered out or failed to send.
 
         """
         # Verify this is a room EnDroid knows about
 
-        if source is None:
-            source = self.wh.my_emails[0]
+        msg = Message('muc', source, body, self, recipient=room,
+                      priority=priority)
+        msg.plugin = plugin or self.active_plugin
+        return self._send(msg)
+
+    def _send(self, msg, filters=None):
+        """
+        Run msg through the send filters (looked up unless given) and send it
+        if they all accept it. Returns the message's delivered Deferred.
+
+        Messages without a sender are sent as EnDroid, so wait until the
+        client knows who that is.
+        """
+        if msg.sender is None:
+            self.wh.when_bootstrapped(self._send_as_self, msg, filters)
+            return msg.delivered
+
+        if msg.delivered.called:
+            # Being sent again
+            msg.delivered = defer.Deferred()
+            msg.sending = False
 
-        msg = Message('muc', source, body, self, recipient=room) 
         # when sending messages we check the filters registered with the
         # _recipient_. Cf. when we receive messages we check filters registered
         # with the _sender_.
-        filters = self._get_filters('muc', 'send', msg.recipient)
+        if filters is None:
+            filters = self._get_filters(msg.place, 'send', msg.recipient)
 
         if all(f.callback(msg) for f in filters):
-            self.wh.groupChat(room, body)
-        else:
+            msg.sending = True
+            coalesce = self._coalesce_window(msg)
+            if msg.updater is not None:
+                d = msg.updater.start(msg.body)
+            elif msg.place == 'muc':
+                d = self.wh.groupChat(msg.recipient, msg.body, coalesce)
+            else:
+                d = self.wh.chat(msg.recipient, msg.body, coalesce)
+            d.chainDeferred(msg.delivered)
+        elif not (msg.held or msg.sending):
             # Need to rely on filters providing more detailed information
             # on why a message was filtered
-            logging.debug("Filtered out message to {}".format(room))
+            logging.debug("Filtered out message to {}".format(msg.recipient))
+            msg.delivered.callback(False)
+        return msg.delivered
+
+    def _send_as_self(self, msg, filters):
+        # Not returning the delivered Deferred, whose result is for the caller
+        msg.sender = self.wh.my_emails[0]
+        self._send(msg, filters)
+
+    @on_reactor
+    def broadcast(self, destinations, body, source=None,
+                  priority=Priority.NORMAL, plugin=None):
+        """
+        Send body to each of destinations, an iterable of ('muc', room) and
+        ('chat', user) pairs, ignoring repeats.
+
+        Each message is run through the send filters as for send_muc and
+        send_chat, but the filters are only looked up once for each room and
+        each distinct set of groups the users are in. The messages are all
+        queued to be sent at once.
+
+        Returns a Deferred firing with a dict of destination : True if the
+        message was sent to it, or False if it was filtered out or failed to
+        send.
+
+        """
+        plugin = plugin or self.active_plugin
+
+        unique = []
+        seen = set()
+        filters = {}
+        sends = []
+        for place, name in destinations:
+            if (place, name) in seen:
+                continue
+            seen.add((place, name))
+            unique.append((place, name))
+
+            # users in the same groups have the same filters
+            key = (place, name if place == 'muc' else
+                   frozenset(self.um.get_groups(name)))
+            if key not in filters:
+                filters[key] = self._get_filters(place, 'send', name)
+
+            msg = Message(place, source, body, self, recipient=name,
+                          priority=priority)
+            msg.plugin = plugin
+            sends.append(self._send(msg, filters[key]))
+
+        d = defer.gatherResults(sends)
+        d.addCallback(lambda results: dict(zip(unique, results)))
+        return d
+
+    @on_reactor
+    def send_muc_updatable(self, room, body, source=None,
+                           priority=Priority.NORMAL, plugin=None,
+                           interval=DEFAULT_UPDATE_INTERVAL):
+        """
+        Send muc message to room as for send_muc, returning a MessageUpdater
+        whose update method edits the message in place (at most once every
+        interval seconds), e.g. to show progress. Updates only go through
+        once the message has passed the send filters and been sent; the
+        updater's delivered Deferred fires with whether it was.
 
+        Unlike other messages, an updatable message is never split: body and
+        updates longer than the maximum message length are truncated (and a
+        warning logged).
+
+        """
+        msg = Message('muc', source, body, self, recipient=room,
+                      priority=priority)
+        msg.plugin = plugin or self.active_plugin
+        msg.updater = self.wh.updatable(room, interval=interval)
+        msg.updater.delivered = self._send(msg)
+        return msg.updater
+
+    @on_reactor
+    def send_chat_updatable(self, user, body, source=None,
+                            priority=Priority.NORMAL, plugin=None,
+                            interval=DEFAULT_UPDATE_INTERVAL):
+        """
+        Send chat message to person with address user as for send_chat,
+        returning a MessageUpdater as for send_muc_updatable.
+
+        """
+        msg = Message('chat', source, body, self, recipient=user,
+                      priority=priority)
+        msg.plugin = plugin or self.active_plugin
+        msg.updater = self.wh.updatable(user, direct=True, interval=interval)
+        msg.updater.delivered = self._send(msg)
+        return msg.updater
+
+    @on_reactor
     def send_chat(self, user, body, source=None, priority=Priority.NORMAL,
-                  response_cb=None, no_response_cb=None, timeout=None):
+                  response_cb=None, no_response_cb=None, timeout=None,
+                  plugin=None):
         """
         Send chat message to person with address user.
 
         The message will be run through any registered filters before it is
-        sent.
+        sent. plugin is as for send_muc.
 
         response_cb is an optional callback to be called to handle the next
         message received from the user. (Note that only the latest such callback
@@ -308,14 +680,15 @@ class MessageHandler(object):
         If response_cb is not specified but no_response_cb is, Endroid
         effectively waits for the timeout to elapse; if the user didn't reply
         in that time, it calls no_response_cb.
-        """
 
-        if source is None:
-            source = self.wh.my_emails[0]
+        Returns a Deferred firing with True once the message has been sent,
+        or False if it was filtered out or failed to send.
+        """
 
         # Verify user is known to EnDroid
-        msg = Message('chat', source, body, self, recipient=user)
-        filters = self._get_filters('chat', 'send', msg.recipient)
+        msg = Message('chat', source, body, self, recipient=user,
+                      priority=priority)
+        msg.plugin = plugin or self.active_plugin
 
         if response_cb or no_response_cb:
             # set up context callbacks before the message gets sent, so that the
@@ -323,12 +696,7 @@ class MessageHandler(object):
             self._register_context_callback(user, response_cb, no_response_cb,
                                             timeout)
 
-        if all(f.callback(msg) for f in filters):
-            self.wh.chat(user, body) 
-        else:
-            # Need to rely on filters providing more detailed information
-            # on why a message was filtered
-            logging.debug("Filtered out message to {0}".format(user))
+        return self._send(msg)
 
 
 class PluginMessageHandler(object): 
@@ -343,8 +711,9 @@ class PluginMessageHandler(object):
     def send_muc(self, body, source=None, priority=Priority.NORMAL):
         if self._pluginmanager.place != "room":
             raise ValueError("Not in a room")
-        self._messagehandler.send_muc(self._pluginmanager.name, body, 
-                                      source=source, priority=priority)
+        return self._messagehandler.send_muc(self._pluginmanager.name, body, 
+                                             source=source, priority=priority,
+                                             plugin=self._plugin)
 
     def send_chat(self, user, body, source=None, priority=Priority.NORMAL): 
         if self._pluginmanager.place != "group":
@@ -353,12 +722,33 @@ class PluginMessageHandler(object):
                                                     self._pluginmanager.name):
             raise ValueError("Target user is not in this group")
         # Verify user is in the group we are in
-        self._messagehandler.send_chat(user, body, source=source, 
-                                       priority=priority)
+        return self._messagehandler.send_chat(user, body, source=source, 
+                                              priority=priority,
+                                              plugin=self._plugin)
+
+    def send_muc_updatable(self, body, source=None, priority=Priority.NORMAL,
+                           interval=DEFAULT_UPDATE_INTERVAL):
+        if self._pluginmanager.place != "room":
+            raise ValueError("Not in a room")
+        return self._messagehandler.send_muc_updatable(
+            self._pluginmanager.name, body, source=source, priority=priority,
+            plugin=self._plugin, interval=interval)
+
+    def send_chat_updatable(self, user, body, source=None,
+                            priority=Priority.NORMAL,
+                            interval=DEFAULT_UPDATE_INTERVAL):
+        if self._pluginmanager.place != "group":
+            raise ValueError("Not in a group")
+        if user not in self._pluginmanager.usermanagement.users(
+                                                    self._pluginmanager.name):
+            raise ValueError("Target user is not in this group")
+        return self._messagehandler.send_chat_updatable(
+            user, body, source=source, priority=priority,
+            plugin=self._plugin, interval=interval)
 
     def register(self, callback, priority=Priority.NORMAL, muc_only=False,
                  chat_only=False, include_self=False, unhandled=False,
-                 send_filter=False, recv_filter=False):
+                 send_filter=False, recv_filter=False, sender_filter=False):
         if self._pluginmanager.place == "room" and not chat_only:
             muc_only = True
         if self._pluginmanager.place == "group" and not muc_only:
@@ -369,7 +759,62 @@ class PluginMessageHandler(object):
                                       include_self=include_self,
                                       unhandled=unhandled,
                                       send_filter=send_filter,
-                                      recv_filter=recv_filter)
+                                      recv_filter=recv_filter,
+                                      sender_filter=sender_filter)
+
+
+class _ThreadMessage(object):
+    """
+    Stands in for a Message given to a blocking plugin's handler, which runs
+    in a thread. Calls that act on the message (replying, marking it
+    unhandled etc.) are passed to the reactor thread to be made, so return
+    nothing; everything else is read from the message.
+
+    """
+    _PASSED_TO_REACTOR = frozenset(("reply", "reply_to_sender", "unhandled",
+                                    "inc_handlers", "dec_handlers"))
+
+    def __init__(self, msg, messagehandler, plugin):
+        self._msg = msg
+        self._messagehandler = messagehandler
+        self._plugin = plugin
+
+    def __getattr__(self, name):
+        value = getattr(self._msg, name)
+        if name not in self._PASSED_TO_REACTOR:
+            return value
+
+        def call(*args):
+            reactor.callFromThread(self._call, value, *args)
+        return call
+
+    def _call(self, method, *args):
+        with self._messagehandler.acting_for(self._plugin):
+            method(*args)
+
+
+class _HandlerMessage(object):
+    """
+    Stands in for a Message given to one of its handlers, so that the handler
+    counts as not handling the message at most once, however many times it
+    (or run_handler, if it fails) calls unhandled. Everything else is read
+    from, or set on, the message.
+
+    """
+    def __init__(self, msg):
+        self.__dict__['message'] = msg
+        self.__dict__['_settled'] = False
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.message, name, value)
+
+    def unhandled(self, *args):
+        if not self._settled:
+            self.__dict__['_settled'] = True
+            self.message.unhandled()
 
 
 class Message(object): 
@@ -401,26 +846,48 @@ class Message(object):
         self._context_response = context_response
         self._context_dealt_with = False
 
+        # for outgoing messages: fires with whether the message was sent,
+        # whether a send filter has kept the message to send later, and
+        # whether it is being sent (possibly by a send filter)
+        self.delivered = defer.Deferred()
+        self.held = False
+        self.sending = False
+        # the plugin sending it, if known
+        self.plugin = None
+        # for messages that are edited after being sent, their MessageUpdater
+        self.updater = None
+        # for received messages, an Attachment for each attached file
+        self.attachments = ()
+
     def send(self):
-        if self.place == "chat":
-            self._messagehandler.send_chat(self.recipient, self.body, 
-                                           self.sender)
-        elif self.place == "muc":
-            self._messagehandler.send_muc(self.recipient, self.body, 
-                                          self.sender)
+        """
+        Send (or resend) this message, running it through the send filters
+        again. Returns the message's delivered Deferred.
+        """
+        self.held = False
+        return self._messagehandler._send(self)
+
+    def hold(self):
+        """
+        Called by a send filter that rejects the message but will send it
+        itself later (with send()), so delivered isn't fired yet.
+        """
+        self.held = True
 
     def reply(self, body):
         if self.place == "chat":
-            self._messagehandler.send_chat(self.sender, body, self.recipient)
+            return self._messagehandler.send_chat(self.sender, body,
+                                                  self.recipient)
         elif self.place == "muc":
             # we send to the room (the recipient), not the message's sender
-            self._messagehandler.send_muc(self.recipient, body)
+            return self._messagehandler.send_muc(self.recipient, body)
 
     def reply_to_sender(self, body):
         if self.place == "chat":
-            self._messagehandler.send_chat(self.sender, body, self.recipient)
+            return self._messagehandler.send_chat(self.sender, body,
+                                                  self.recipient)
         elif self.place == "muc":
-            self._messagehandler.send_chat(self.sender, body) 
+            return self._messagehandler.send_chat(self.sender, body) 
 
     def inc_handlers(self):
         self.__handlers += 1
@@ -454,8 +921,11 @@ class Message(object):
             self.dec_handlers()
 
     def do_unhandled(self):
-        if self.__handlers == 0 and hasattr(self, '_unhandled_cb'):
-            self._unhandled_cb(self)
+        # the callback is only called once, when the last handler finishes
+        # with the message
+        if self.__handlers == 0 and getattr(self, '_unhandled_cb', None):
+            callback, self._unhandled_cb = self._unhandled_cb, None
+            callback(self)
 
     def set_unhandled_cb(self, cb):
         self._unhandled_cb = cb
@@ -0,0 +1,402 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Dispatching of outbound Webex messages.
+"""
+
+import logging
+from collections import Counter, deque
+
+from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
+
+from endroid.webex_api import ApiError, RateLimitError
+from endroid.blocking import on_reactor
+
+logger = logging.getLogger("webex-outbound")
+
+# Maximum size of a message's text, in UTF-8 bytes
+MAX_MESSAGE_LEN = 7439
+# Separator between coalesced messages
+COALESCE_SEPARATOR = "\n"
+
+# Minimum seconds between edits of an updatable message
+DEFAULT_UPDATE_INTERVAL = 2.0
+
+# Maximum number of messages being created at once (across destinations)
+DEFAULT_MAX_IN_FLIGHT = 4
+# Number of times a send is retried after a rate limit or server error
+DEFAULT_MAX_RETRIES = 5
+# Backoff (in seconds) before the first retry, doubling for each retry after
+# that, when the server doesn't say how long to wait
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+def message_size(text):
+    """Return the size of text as the API measures it (in UTF-8 bytes)."""
+    if isinstance(text, unicode):
+        return len(text.encode('utf-8'))
+    return len(text)
+
+
+def chunk_text(text, limit=MAX_MESSAGE_LEN):
+    """
+    Split text into chunks of at most limit bytes. Chunks end at a line break
+    if there is one in the second half of the chunk, otherwise at a space,
+    and only split words (never characters) as a last resort. The line
+    break or space split at is dropped.
+    """
+    if message_size(text) <= limit:
+        return [text]
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+
+    chunks = []
+    while message_size(text) > limit:
+        # The most characters that fit, without splitting a multibyte one
+        fits = len(text[:limit].encode('utf-8')[:limit].decode('utf-8',
+                                                               'ignore'))
+        for boundary in ('\n', ' '):
+            cut = text.rfind(boundary, fits // 2, fits + 1)
+            if cut > 0:
+                chunks.append(text[:cut])
+                text = text[cut + 1:]
+                break
+        else:
+            chunks.append(text[:fits])
+            text = text[fits:]
+    chunks.append(text)
+    return chunks
+
+
+class _Send(object):
+    __slots__ = ("fields", "deferred", "attempts")
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.deferred = defer.Deferred()
+        self.attempts = 0
+
+
+class _Batch(object):
+    """Messages to a destination waiting to be coalesced into one."""
+    __slots__ = ("fields", "texts", "deferreds", "length", "flush_call")
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.texts = []
+        self.deferreds = []
+        self.length = -len(COALESCE_SEPARATOR)
+        self.flush_call = None
+
+    def fits(self, text):
+        return (self.length + len(COALESCE_SEPARATOR) + message_size(text) <=
+                MAX_MESSAGE_LEN)
+
+    def add(self, text):
+        self.length += len(COALESCE_SEPARATOR) + message_size(text)
+        # Mixing byte strings and unicode in the join would fail for
+        # non-ASCII byte strings
+        if not isinstance(text, unicode):
+            text = text.decode('utf-8', 'replace')
+        self.texts.append(text)
+        d = defer.Deferred()
+        self.deferreds.append(d)
+        return d
+
+
+class SendQueue(object):
+    """
+    Sends messages in order for each destination (room or person), with a
+    bounded number of creates in flight across all destinations.
+
+    Plain text messages sent with a coalescing window are held for that long,
+    and merged with any further such messages to the same destination sent
+    in the meantime (up to MAX_MESSAGE_LEN), so they need just one create.
+
+    A send rejected with a 429 is retried after the server's Retry-After
+    time, and nothing else is sent until then. Server errors are retried
+    with exponential backoff, and other errors fail the send.
+
+    Attributes:
+        max_in_flight - Maximum number of messages being created at once.
+        max_retries   - Number of times a send is retried before failing.
+        stats         - Counter of messages 'sent', 'failed', 'retried',
+                        'rate_limited' and 'coalesced' (into another).
+    """
+    def __init__(self, api, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_retries=DEFAULT_MAX_RETRIES, clock=reactor):
+        self.api = api
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.stats = Counter()
+        self._clock = clock
+        self._queues = {}       # destination : deque of _Sends
+        self._ready = deque()   # destinations with a send waiting to go
+        self._busy = set()      # destinations with a send in flight
+        self._paused = None     # DelayedCall to resume after a rate limit
+        self._batches = {}      # destination : _Batch being coalesced
+
+    def send(self, destination, coalesce=0, **fields):
+        """
+        Queue the creation of a message with the given fields, behind any
+        messages already queued for destination. Returns a Deferred firing
+        with the created message.
+
+        If coalesce is non-zero, a plain text message is held for up to that
+        many seconds to be merged with later messages to destination.
+        """
+        batch = self._batches.get(destination)
+        text = fields.get('text')
+        if coalesce and text is not None and set(fields) <= set(
+                ('text', 'roomId', 'toPersonEmail')):
+            if batch is not None and batch.fits(text):
+                self.stats['coalesced'] += 1
+                return batch.add(text)
+            self._flush(destination)
+            batch = _Batch(fields)
+            batch.flush_call = self._clock.callLater(coalesce, self._flush,
+                                                     destination)
+            self._batches[destination] = batch
+            return batch.add(text)
+
+        # Keep anything waiting to be coalesced in front of this message
+        self._flush(destination)
+        return self._enqueue(destination, fields)
+
+    def _flush(self, destination):
+        """Queue the coalesced message for destination, if there is one."""
+        batch = self._batches.pop(destination, None)
+        if batch is None:
+            return
+        if batch.flush_call.active():
+            batch.flush_call.cancel()
+
+        def fan_out(result):
+            for waiting in batch.deferreds:
+                waiting.callback(result)
+
+        try:
+            fields = dict(batch.fields,
+                          text=COALESCE_SEPARATOR.join(batch.texts))
+        except Exception:
+            # Called from a DelayedCall, so fail the senders rather than
+            # leaving them waiting forever
+            fan_out(Failure())
+            return
+        self._enqueue(destination, fields).addBoth(fan_out)
+
+    def _enqueue(self, destination, fields):
+        item = _Send(fields)
+        queue = self._queues.setdefault(destination, deque())
+        queue.append(item)
+        if len(queue) == 1 and destination not in self._busy:
+            self._ready.append(destination)
+        self._dispatch()
+        return item.deferred
+
+    def depth(self, destination=None):
+        """
+        Return the number of messages waiting (for a destination), counting
+        each message being coalesced.
+        """
+        if destination is not None:
+            batch = self._batches.get(destination)
+            return (len(self._queues.get(destination, ())) +
+                    (len(batch.texts) if batch is not None else 0))
+        return (sum(len(queue) for queue in self._queues.values()) +
+                sum(len(batch.texts) for batch in self._batches.values()))
+
+    def _dispatch(self):
+        while (self._ready and self._paused is None and
+               len(self._busy) < self.max_in_flight):
+            destination = self._ready.popleft()
+            self._busy.add(destination)
+            item = self._queues[destination][0]
+            item.attempts += 1
+            d = self.api.messages.create(**item.fields)
+            d.addCallbacks(self._sent, self._failed,
+                           callbackArgs=(destination, item),
+                           errbackArgs=(destination, item))
+
+    def _sent(self, message, destination, item):
+        self.stats['sent'] += 1
+        self._finish(destination)
+        item.deferred.callback(message)
+
+    def _failed(self, failure, destination, item):
+        error = failure.value
+        retryable = (isinstance(error, RateLimitError) or
+                     (isinstance(error, ApiError) and
+                      error.status_code >= 500))
+        if retryable and item.attempts <= self.max_retries:
+            delay = getattr(error, 'retry_after', None)
+            if delay is None:
+                delay = min(INITIAL_BACKOFF * 2 ** (item.attempts - 1),
+                            MAX_BACKOFF)
+            self.stats['retried'] += 1
+            if isinstance(error, RateLimitError):
+                self.stats['rate_limited'] += 1
+                self._pause(delay)
+            logger.warning("Send to %s failed (%s), retrying in %.1fs",
+                           destination, failure.getErrorMessage(), delay)
+            self._clock.callLater(delay, self._retry, destination)
+            return
+
+        self.stats['failed'] += 1
+        self._finish(destination)
+        item.deferred.errback(failure)
+
+    def _retry(self, destination):
+        self._busy.discard(destination)
+        self._ready.appendleft(destination)
+        self._dispatch()
+
+    def _finish(self, destination):
+        """The send at the head of destination's queue is done with."""
+        self._busy.discard(destination)
+        queue = self._queues[destination]
+        queue.popleft()
+        if queue:
+            self._ready.append(destination)
+        else:
+            del self._queues[destination]
+        self._dispatch()
+
+    def _pause(self, delay):
+        """Stop dispatching for delay seconds, after a rate limit."""
+        if self._paused is not None:
+            if self._paused.getTime() >= self._clock.seconds() + delay:
+                return
+            self._paused.cancel()
+        self._paused = self._clock.callLater(delay, self._resume)
+
+    def _resume(self):
+        self._paused = None
+        self._dispatch()
+
+
+class MessageUpdater(object):
+    """
+    Handle on a message that is edited in place as it changes, e.g. to show
+    progress. Updates are collapsed so that the message is edited at most
+    once per interval, always to the latest text.
+
+    An updatable message can't be split into several messages, so text over
+    MAX_MESSAGE_LEN is truncated (at a line or word boundary where possible)
+    and a warning is logged.
+
+    Attributes:
+        message  - The created message, once it has been sent.
+        delivered - Deferred firing with whether the message was sent, if
+                   it is sent by MessageHandler (which may filter it out).
+        interval - Minimum seconds between edits.
+        stats    - Counter of 'updates' requested, 'edits' made, edits
+                   'failed' and texts 'truncated'.
+    """
+    def __init__(self, queue, destination, interval=DEFAULT_UPDATE_INTERVAL,
+                 clock=reactor, **fields):
+        self.message = None
+        self.delivered = None
+        self.interval = interval
+        self.stats = Counter()
+        self._queue = queue
+        self._destination = destination
+        self._fields = fields
+        self._clock = clock
+        self._latest = None     # text not yet edited in
+        self._last_edit = None  # time of the last edit (or the create)
+        self._edit_call = None  # DelayedCall of the next edit
+        self._editing = False
+        self._idle = []         # Deferreds waiting for edits to finish
+
+    def start(self, text):
+        """
+        Send the message with its initial text. Returns a Deferred firing with
+        True once it has been sent, or False if it couldn't be.
+        """
+        d = self._queue.send(self._destination, text=self._fit(text),
+                             **self._fields)
+        d.addCallback(self._created)
+        d.addErrback(self._create_failed)
+        return d
+
+    @on_reactor
+    def update(self, text):
+        """Change the message's text, editing it when the interval allows."""
+        self.stats['updates'] += 1
+        self._latest = text
+        if (self.message is not None and not self._editing and
+                self._edit_call is None):
+            self._schedule()
+
+    @on_reactor
+    def flushed(self):
+        """Return a Deferred firing once all updates have been edited in."""
+        if self._latest is None and not self._editing:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idle.append(d)
+        return d
+
+    def _fit(self, text):
+        """Return text, truncated if it is too long for a message."""
+        chunks = chunk_text(text)
+        if len(chunks) > 1:
+            self.stats['truncated'] += 1
+            logger.warning("Truncated updatable message to %s from %u to %u "
+                           "bytes", self._destination, message_size(text),
+                           message_size(chunks[0]))
+        return chunks[0]
+
+    def _created(self, message):
+        self.message = message
+        self._last_edit = self._clock.seconds()
+        if self._latest is not None:
+            self._schedule()
+        return True
+
+    def _create_failed(self, failure):
+        logger.error("Failed to send updatable message to %s: %s",
+                     self._destination, failure.getErrorMessage())
+        # Updates can never be edited in
+        self._latest = None
+        self._fire_idle()
+        return False
+
+    def _schedule(self):
+        wait = max(0, self._last_edit + self.interval - self._clock.seconds())
+        self._edit_call = self._clock.callLater(wait, self._edit)
+
+    def _edit(self):
+        self._edit_call = None
+        text, self._latest = self._latest, None
+        self._editing = True
+        self._last_edit = self._clock.seconds()
+        self.stats['edits'] += 1
+        d = self._queue.api.messages.update(self.message.id,
+                                            roomId=self.message.roomId,
+                                            text=self._fit(text))
+        d.addErrback(self._edit_failed)
+        d.addBoth(self._edited)
+
+    def _edit_failed(self, failure):
+        self.stats['failed'] += 1
+        logger.error("Failed to edit message %s: %s", self.message.id,
+                     failure.getErrorMessage())
+
+    def _edited(self, _):
+        self._editing = False
+        if self._latest is not None:
+            self._schedule()
+        else:
+            self._fire_idle()
+
+    def _fire_idle(self):
+        idle, self._idle = self._idle, []
+        for d in idle:
+            d.callback(None)
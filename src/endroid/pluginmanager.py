@@ -71,7 +71,8 @@ class PluginMeta(type):
                 def inner(*args, **kwargs):
                     # This function is here to ensure the right obj is passed
                     # as self to the method.
-                    return fn(self, *args, **kwargs)
+                    with self.messagehandler.acting_for(self):
+                        return fn(self, *args, **kwargs)
                 task = self.cron.register(inner, fn._cron_name,
                                           persistent=fn._cron_persistent)
                 setattr(self, name, task)
@@ -230,6 +231,12 @@ class Plugin(object):
     
     dependencies = ()
     preferences = ()
+    # set to True if the plugin's message handlers block (e.g. on I/O), so
+    # they must be run in a thread rather than on the reactor. Such handlers
+    # may use msg, self.messages, self.rosters and self.usermanagement (whose
+    # calls are made on the reactor, waiting for any Deferred's result rather
+    # than returning it), but not the database, cron or Twisted directly
+    blocking = False
 
 
 class GlobalPlugin(Plugin):
@@ -35,7 +35,7 @@ class Blacklist(Plugin):
 
         self.task = self.cron.register(self.unblacklist, CRON_UNBLACKLIST)
 
-        self.messages.register(self.checklist, recv_filter=True)
+        self.messages.register(self.checklist, sender_filter=True)
         self.messages.register(self.command, chat_only=True)
         self.messages.register(self.checksend, send_filter=True, chat_only=True)
 
@@ -49,8 +49,8 @@ class Blacklist(Plugin):
         
     def checklist(self, msg):
         """
-        Receive filter callback - checks the message sender against the
-        blacklist
+        Sender filter callback - checks the message sender against the
+        blacklist (before the message has been fetched)
         """
         return msg.sender not in self.get_blacklist()
 
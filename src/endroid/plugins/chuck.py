@@ -18,6 +18,6 @@ class ChuckNorris(CommandPlugin):
             fact = re.sub(r"<.*?>", "", FACTRE.search(data).group(1)).strip()
             msg.reply("Fact: {0}".format(HTMLParser().unescape(fact.strip())))
 
-        getPage("http://www.whatisawesome.com/chuck").addCallbacks(extract_fact,
-                                                                   msg.unhandled)
+        return getPage("http://www.whatisawesome.com/chuck").addCallback(
+            extract_fact)
     cmd_chuck.synonyms = ('norris', 'chucknorris')
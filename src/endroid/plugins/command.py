@@ -252,25 +252,28 @@ class Command(Plugin):
         current remaining message string; msg is the full Message object.
 
         All handlers for the current command are called after first recursing
-        down to any subcommands that match.
+        down to any subcommands that match. Each counts as a handler of msg.
         """
         com, arg = self._command_split(args)
         if com in handlers.subcommands:
-            msg.inc_handlers()
             self._command(handlers.subcommands[com], arg, msg)
         for handler in handlers.handlers:
             msg.inc_handlers()
-            handler.callback(msg, args)
-        msg.dec_handlers()
+            self.messagehandler.run_handler(msg, handler.callback, (args,),
+                                            plugin=handler.plugin,
+                                            category="command")
     
     def _command_muc(self, msg):
         # Some clients seem to send an empty message when joining a chat room
         # - Ignore it
         if msg.body is not None:
             self._command(self._muc_handlers, msg.body, msg)
+            # Only the commands' handlers may have handled it
+            msg.unhandled()
 
     def _command_chat(self, msg):
         self._command(self._chat_handlers, msg.body, msg)
+        msg.unhandled()
     
     def _command_split(self, text):
         num = text.count(' ')
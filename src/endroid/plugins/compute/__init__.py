@@ -104,6 +104,7 @@ class Compute(Plugin):
                     headers={'Content-Type':'application/x-www-form-urlencoded'})
         d.addCallbacks(callback=lambda data: self._result_callback(msg, data, fail_silent),
                        errback=lambda error: msg.reply(MESSAGES['download-error'].format(error)))
+        return d
         
 
         
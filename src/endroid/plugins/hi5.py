@@ -129,13 +129,14 @@ class Hi5(CommandPlugin):
         msg.reply('A High Five "' + text + '" is being sent to ' + jidlist)
         self._log_hi5(','.join(fulljids), msg.sender, text)
 
-        for jid in fulljids:
-            self.messagehandler.send_chat(jid, "You've been sent an anonymous "
-                                               "High Five: " + text)
-        for group in self.vars.get('broadcast', []):
-            groupmsg = '{} {} been sent an anonymous High Five: {}'.format(
-                jidlist, 'have' if len(jids) > 1 else 'has', text)
-            self.messagehandler.send_muc(group, groupmsg)
+        self.messagehandler.broadcast([('chat', jid) for jid in fulljids],
+                                      "You've been sent an anonymous "
+                                      "High Five: " + text)
+        groupmsg = '{} {} been sent an anonymous High Five: {}'.format(
+            jidlist, 'have' if len(jids) > 1 else 'has', text)
+        self.messagehandler.broadcast([('muc', group) for group in
+                                       self.vars.get('broadcast', [])],
+                                      groupmsg)
     
     @staticmethod
     def _parse(msg):
@@ -5,6 +5,7 @@
 # -----------------------------------------
 
 from endroid.plugins.command import CommandPlugin, command
+from twisted.internet import defer
 import shlex
 import re
 
@@ -79,8 +80,7 @@ class Invite(CommandPlugin):
         users = [msg.sender]
         rooms = set(args + kwargs.get("to", [])) or ["all"]
 
-        results = self._do_invites(users, rooms)
-        msg.reply(results)
+        self._do_invites(users, rooms).addCallback(msg.reply)
 
     @command(helphint="<reason>", muc_only=True)
     def invite_all(self, msg, arg):
@@ -91,10 +91,9 @@ class Invite(CommandPlugin):
         rooms = [self.place_name]
 
         if len(users) > 0:
-            results = self._do_invites(users, rooms)
+            self._do_invites(users, rooms).addCallback(msg.reply)
         else:
-            results = "All registered users are available in the room."
-        msg.reply(results)
+            msg.reply("All registered users are available in the room.")
 
     @command(helphint="<user>+ {to|into} <room>+")
     def invite_users(self, msg, arg):
@@ -103,15 +102,19 @@ class Invite(CommandPlugin):
         users = replace(args, "me", msg.sender)
         rooms = kwargs.get("to", [])
 
-        results = self._do_invites(users, rooms)
-        msg.reply(results)
+        self._do_invites(users, rooms).addCallback(msg.reply)
 
     def _do_invites(self, users, rooms):
+        """
+        Invite each of users to each of rooms. Returns a deferred which fires
+        with a summary of the results.
+        """
         if 'all' in users:
             if len(rooms) == 1 and 'all' not in rooms:
                 users = self.usermanagement.get_users(rooms[0])
             else:
-                return "Can only invite 'all' users to a single room"
+                return defer.succeed(
+                    "Can only invite 'all' users to a single room")
 
         users = self._fuzzy_match(users, self.usermanagement.get_users())
 
@@ -119,32 +122,39 @@ class Invite(CommandPlugin):
             if len(users) == 1:
                 rooms = self.usermanagement.get_rooms(users[0])
                 if not rooms:
-                    return ("There are no rooms to invite user '{}' "
-                            "to.".format(users[0]))
+                    return defer.succeed("There are no rooms to invite user "
+                                         "'{}' to.".format(users[0]))
             else:
-                return "Can only invite a single user to 'all' rooms"
+                return defer.succeed(
+                    "Can only invite a single user to 'all' rooms")
 
         rooms = self._fuzzy_match(rooms, self.usermanagement.get_rooms())
 
         if not users:
-            return "User not found."
+            return defer.succeed("User not found.")
         if not rooms:
-            return "Room not found."
-
-        results = []
-        invitations = 0
-        for room in rooms:
-            for user in users:
-                s, reason = self.usermanagement.invite(user, room)
-                if not s:
-                    results.append("{} to {} failed: {}".format(user, room, reason))
-                else:
-                    invitations += 1
-
-        reply = "Sent {} invitations.".format(invitations)
-        if results:
-            reply +=  '\n' + '\n'.join(results)
-        return reply
+            return defer.succeed("Room not found.")
+
+        def summarise(outcomes):
+            results = []
+            invitations = 0
+            for room, room_outcomes in zip(rooms, outcomes):
+                for user in users:
+                    s, reason = room_outcomes[user]
+                    if not s:
+                        results.append("{} to {} failed: {}".format(user, room, reason))
+                    else:
+                        invitations += 1
+
+            reply = "Sent {} invitations.".format(invitations)
+            if results:
+                reply +=  '\n' + '\n'.join(results)
+            return reply
+
+        d = defer.gatherResults([self.usermanagement.invite_many(room, users)
+                                 for room in rooms])
+        d.addCallback(summarise)
+        return d
 
     @staticmethod
     def _fuzzy_match(partials, fulls):
@@ -34,27 +34,26 @@ class Bomb(object):
     def explode(self, _):
         # some shorthands
         get_rooms = self.plugin.usermanagement.get_available_rooms
-        send_muc = self.plugin.messagehandler.send_muc
-        send_chat = self.plugin.messagehandler.send_chat
+        broadcast = self.plugin.messagehandler.broadcast
 
         msg_explode = "!!!BOOM!!!"
         msg_farexplode = "You hear a distant boom"
         msg_kill = "{} was got by the bomb"
 
-        rooms = get_rooms(self.user)
-        for room in rooms:
-            # let everyone in a room with self.user here the explosion
-            send_muc(room, msg_explode)
-            send_muc(room, msg_kill.format(self.user))
+        # let everyone in a room with self.user here the explosion
+        rooms = [('muc', room) for room in get_rooms(self.user)]
+        broadcast(rooms, msg_explode)
+        broadcast(rooms, msg_kill.format(self.user))
 
         # alert those who passed the bomb that it has exploded
-        for user in self.history:
-            if user == self.user:
-                send_chat(self.user, msg_explode)
-                send_chat(self.user, msg_kill.format("You"))
-            else:
-                send_chat(user, msg_farexplode)
-                send_chat(user, msg_kill.format(self.user))
+        if self.user in self.history:
+            victim = [('chat', self.user)]
+            broadcast(victim, msg_explode)
+            broadcast(victim, msg_kill.format("You"))
+        others = [('chat', user) for user in self.history
+                  if user != self.user]
+        broadcast(others, msg_farexplode)
+        broadcast(others, msg_kill.format(self.user))
 
         self.plugin.register_kill(self.source)
         self.plugin.bombs[self.user].discard(self)
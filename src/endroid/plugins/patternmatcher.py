@@ -45,7 +45,8 @@ class PatternMatcher(Plugin):
             body = msg.body.strip()
             if pattern.search(body):
                 msg.inc_handlers()
-                callback(msg)
+                self.messagehandler.run_handler(msg, callback,
+                                                category="pattern")
         msg.unhandled()
     
     def match_muc_message(self, message):
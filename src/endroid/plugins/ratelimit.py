@@ -163,7 +163,8 @@ class RateLimit(Plugin):
         self.blacklist = self.get("endroid.plugins.blacklist")
 
         self.messages.register(self.ratelimit, priority=10, send_filter=True)
-        self.messages.register(self.checkabuse, priority=10, recv_filter=True)
+        self.messages.register(self.checkabuse, priority=10,
+                               sender_filter=True)
 
         # Make all the state attributes class attributes
         # This means that users are limited globally accross all usergroups and
@@ -200,6 +201,9 @@ class RateLimit(Plugin):
             # ourselves or we're queuing the message for later sending
             accept = False
             msg_to_send = sc.accept_msg(msg)
+            if msg_to_send is not msg:
+                # msg has been queued for sending later
+                msg.hold()
             if msg_to_send:
                 self.send(msg_to_send)
             else:
@@ -213,6 +217,9 @@ class RateLimit(Plugin):
         """
         Check for abuse of the EnDroid. Users who exceed the limit imposed here
         are placed on the blacklist (if that plugin is available) for an hour.
+
+        This is a sender filter, so abusive senders are dropped before their
+        messages are fetched.
         """
         if not self.abusers[msg.sender].use_token():
             if self.blacklist is not None:
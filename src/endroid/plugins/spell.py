@@ -9,6 +9,7 @@
 import re
 from functools import partial
 
+from twisted.internet import defer
 from twisted.web.client import getPage
 from endroid.pluginmanager import Plugin
 
@@ -39,16 +40,16 @@ class Spell(Plugin):
         """
         matches = REOBJ.findall(msg.body)
 
-        for word in matches:
-            self.checkspelling(msg, word)
+        return defer.gatherResults([self.checkspelling(msg, word)
+                                    for word in matches], consumeErrors=True)
 
     def checkspelling(self, msg, word):
-        getPage("https://www.google.com/tbproxy/spell?lang=en:",
+        return getPage("https://www.google.com/tbproxy/spell?lang=en:",
                 method="POST",
                 postdata=POSTFORM % str(word.replace(']', '')),
                 headers={"Content-Type":
                              "application/x-www-form-urlencoded"} # Really?
-                ).addCallbacks(partial(self.spell, msg, word), msg.unhandled)
+                ).addCallback(partial(self.spell, msg, word))
 
     def spell(self, msg, word, data):
         # Cheap and dirty: the response format is an XML document, where the
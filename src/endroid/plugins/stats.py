@@ -0,0 +1,49 @@
+# -----------------------------------------
+# Endroid - Report statistics on EnDroid's plugins
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from endroid.plugins.command import CommandPlugin, command
+from endroid.handlerstats import SORT_KEYS
+
+# Number of handlers listed unless a plugin is given
+DEFAULT_LIMIT = 10
+
+
+class Stats(CommandPlugin):
+    """
+    Lets administrators (specified in config) see how long each plugin's
+    message handlers are taking, and how often they fail.
+    """
+    help = "Report how plugins' message handlers are performing."
+    hidden = True
+
+    def endroid_init(self):
+        self.admins = set(map(str.strip, self.vars.get("admins", [])))
+
+    @command(helphint="[<plugin>] [by {}] | reset".format("|".join(SORT_KEYS)),
+             hidden=True, chat_only=True)
+    def handler_stats(self, msg, args):
+        if msg.sender not in self.admins:
+            msg.unhandled()
+            return
+
+        stats = self.messagehandler.handler_stats
+        words = args.split()
+        if words == ["reset"]:
+            stats.clear()
+            msg.reply("Handler statistics reset.")
+            return
+
+        sort = 'total'
+        if len(words) >= 2 and words[-2] == "by":
+            sort = words[-1]
+            words = words[:-2]
+        if len(words) > 1 or sort not in SORT_KEYS:
+            msg.reply("Usage: handler stats {}".format(
+                self.handler_stats.helphint))
+            return
+
+        plugin = words[0] if words else None
+        msg.reply(stats.report(plugin=plugin, sort=sort,
+                               limit=None if plugin else DEFAULT_LIMIT))
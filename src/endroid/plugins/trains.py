@@ -114,7 +114,7 @@ class TrainTimes(CommandPlugin):
                 src, dst, ("/" + time) if time else "",
                 "a" if typ == "arriving" else "",
                 ("/" + when.replace(" ", "-")) if when else "")
-        getPage("http://www.traintimes.org.uk" + urllib.quote(url)
+        return getPage("http://www.traintimes.org.uk" + urllib.quote(url)
                 ).addCallbacks(extract_results, lambda x: msg.reply("Bad train request"))
 
     @staticmethod
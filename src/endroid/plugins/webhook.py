@@ -0,0 +1,154 @@
+# -----------------------------------------------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------------------------------------------
+
+"""
+Receive Webex activities by webhook rather than over the device websocket.
+
+Webhooks are delivered to http://<server>/webhook/ on the httpinterface web
+server, so several EnDroid processes can share the load behind a single
+target URL. Set 'ingestion = webhook' in the [Setup] section to use this.
+"""
+
+import hmac
+import json
+import hashlib
+import logging
+
+from twisted.web.resource import Resource
+
+from endroid.pluginmanager import Plugin
+from endroid.webex_api import ApiError
+from endroid.webex_client import WEBHOOK_VERBS, INGEST_WEBHOOK
+
+logger = logging.getLogger("webex-webhook")
+
+DEFAULT_WEBHOOK_NAME = "endroid"
+
+# The (resource, event) pairs EnDroid needs webhooks for
+WEBHOOK_EVENTS = tuple(sorted(WEBHOOK_VERBS))
+
+SIGNATURE_HEADER = "X-Spark-Signature"
+
+
+def signature(secret, body):
+    """Return the signature Webex sends with a webhook body."""
+    return hmac.new(secret, body, hashlib.sha1).hexdigest()
+
+
+class WebhookResource(Resource):
+    """
+    Receives webhook POSTs, checks their signatures and passes the events to
+    the WebexClient.
+    """
+    isLeaf = True
+
+    def __init__(self, client, secret):
+        Resource.__init__(self)
+        self.client = client
+        self.secret = secret
+
+    def render_POST(self, request):
+        if self.client.ingestion != INGEST_WEBHOOK:
+            # Activities are arriving over the websocket, so these would be
+            # handled twice
+            request.setResponseCode(404)
+            return ""
+
+        if not self.client.bootstrapped.called:
+            # We don't know who we are yet
+            request.setResponseCode(503)
+            return ""
+
+        body = request.content.read()
+        sent = request.getHeader(SIGNATURE_HEADER) or ""
+        if not hmac.compare_digest(sent, signature(self.secret, body)):
+            logger.warning("Dropping webhook with bad signature from %s",
+                           request.getClientIP())
+            request.setResponseCode(403)
+            return ""
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            request.setResponseCode(400)
+            return ""
+
+        try:
+            self.client.process_webhook(payload)
+        except Exception:
+            logger.exception("Got exception processing webhook %s",
+                             payload.get('id'))
+        return ""
+
+
+class Webhook(Plugin):
+    """
+    Registers EnDroid's webhooks with Webex and receives their events.
+
+    Config:
+        target_url - The URL Webex should deliver events to, e.g. that of a
+                     load balancer in front of several EnDroids (required).
+        secret     - Shared secret used to sign the events (required).
+        name       - Name given to the webhooks, defaults to 'endroid'.
+    """
+    name = "webhook"
+    hidden = True
+    dependencies = ['endroid.plugins.httpinterface']
+
+    _registered = False
+
+    def endroid_init(self):
+        # Only the first instance of the plugin sets up the webhooks
+        if Webhook._registered:
+            return
+        Webhook._registered = True
+
+        self.client = self.usermanagement.wh.client
+        if self.client.ingestion != INGEST_WEBHOOK:
+            logger.warning("Not registering webhooks, as activities are "
+                           "received by %s", self.client.ingestion)
+            return
+
+        self.target_url = self.vars["target_url"]
+        self.secret = str(self.vars["secret"])
+        self.webhook_name = self.vars.get("name", DEFAULT_WEBHOOK_NAME)
+
+        http = self.get('endroid.plugins.httpinterface')
+        http.register_resource(self, WebhookResource(self.client,
+                                                     self.secret))
+
+        d = self.client.webex_api.webhooks.list()
+        d.addCallback(self._got_webhooks)
+        d.addErrback(self._failed, "list webhooks")
+
+    def _got_webhooks(self, webhooks):
+        """
+        Create any webhooks that don't already exist. Webhooks with our name
+        but a different target are stale, so delete them. Several EnDroids
+        sharing a target URL will therefore share one set of webhooks.
+        """
+        wanted = set(WEBHOOK_EVENTS)
+        for webhook in webhooks:
+            if webhook.name != self.webhook_name:
+                continue
+            key = (webhook.resource, webhook.event)
+            if webhook.targetUrl == self.target_url and key in wanted:
+                logger.info("Reusing webhook for %s/%s", *key)
+                wanted.discard(key)
+            else:
+                logger.info("Deleting stale webhook %s", webhook.id)
+                d = self.client.webex_api.webhooks.delete(webhook.id)
+                d.addErrback(self._failed, "delete webhook")
+
+        for resource, event in wanted:
+            logger.info("Creating webhook for %s/%s", resource, event)
+            d = self.client.webex_api.webhooks.create(
+                name=self.webhook_name, targetUrl=self.target_url,
+                resource=resource, event=event, secret=self.secret)
+            d.addErrback(self._failed, "create webhook")
+
+    def _failed(self, failure, action):
+        failure.trap(ApiError)
+        logger.error("Failed to %s: %s", action, failure.getErrorMessage())
@@ -0,0 +1,141 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Client-side limiting of the rate of Webex REST calls.
+"""
+
+import logging
+from collections import Counter, deque
+
+from twisted.internet import reactor, defer
+
+logger = logging.getLogger("webex-quota")
+
+# Default (calls per second, burst) for each family of API calls. Families
+# not listed (and those with a rate of 0) are not limited.
+DEFAULT_QUOTAS = {
+    'messages': (10, 20),
+    'memberships': (5, 10),
+    'rooms': (5, 10),
+    'people': (5, 10),
+}
+
+
+def parse_quota(key, value, default_burst):
+    """
+    Return the (calls per second, burst) quota given by value, the setting
+    key: either a rate and a burst, or just a rate (with default_burst).
+    Raises ValueError naming the setting if it is neither.
+    """
+    if isinstance(value, (int, long, float)):
+        return (float(value), default_burst)
+    try:
+        rate, burst = value
+        return (float(rate), float(burst))
+    except (TypeError, ValueError):
+        raise ValueError("{} should be '<calls per second>, <burst>' or "
+                         "'<calls per second>', not {!r}".format(key, value))
+
+
+class TokenBucket(object):
+    """
+    A bucket holding up to capacity tokens, refilled at rate tokens per
+    second. Each call takes a token.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def level(self, now):
+        """Return the number of tokens in the bucket."""
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, now):
+        """
+        Take a token if there is one, returning 0. Otherwise return the
+        number of seconds until there will be.
+        """
+        if self.level(now) >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class QuotaLimiter(object):
+    """
+    Holds back calls in each family (messages, memberships etc.) so that
+    they are made no faster than the family's quota, queueing them rather
+    than letting them be rejected by the server. Calls in a family are made
+    in the order they were submitted.
+
+    Attributes:
+        buckets - Dict of family : TokenBucket.
+        stats   - Counter of calls 'delayed' (also by family, e.g.
+                  'delayed.messages').
+    """
+    def __init__(self, quotas=DEFAULT_QUOTAS, clock=reactor):
+        self._clock = clock
+        self.buckets = dict((family, TokenBucket(rate, burst,
+                                                 clock.seconds()))
+                            for family, (rate, burst) in quotas.items()
+                            if rate)
+        self.stats = Counter()
+        self._waiting = {}  # family : deque of (Deferred, fn, args, kwargs)
+        self._drain_calls = {}  # family : DelayedCall
+
+    def run(self, family, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs), returning a Deferred of its result, once
+        the family's quota allows.
+        """
+        bucket = self.buckets.get(family)
+        if bucket is None:
+            return defer.maybeDeferred(fn, *args, **kwargs)
+
+        waiting = self._waiting.setdefault(family, deque())
+        if not waiting and bucket.take(self._clock.seconds()) == 0:
+            return defer.maybeDeferred(fn, *args, **kwargs)
+
+        d = defer.Deferred()
+        waiting.append((d, fn, args, kwargs))
+        self.stats['delayed'] += 1
+        self.stats['delayed.' + family] += 1
+        logger.debug("Over quota for %s calls, %u waiting", family,
+                     len(waiting))
+        if family not in self._drain_calls:
+            self._drain(family)
+        return d
+
+    def levels(self):
+        """
+        Return a dict of family : (tokens available, number of calls
+        waiting).
+        """
+        now = self._clock.seconds()
+        return dict((family, (bucket.level(now),
+                              len(self._waiting.get(family, ()))))
+                    for family, bucket in self.buckets.items())
+
+    def _drain(self, family):
+        """Make waiting calls while there are tokens, then wait for more."""
+        self._drain_calls.pop(family, None)
+        waiting = self._waiting[family]
+        bucket = self.buckets[family]
+        while waiting:
+            wait = bucket.take(self._clock.seconds())
+            if wait:
+                self._drain_calls[family] = self._clock.callLater(
+                    wait, self._drain, family)
+                return
+            d, fn, args, kwargs = waiting.popleft()
+            defer.maybeDeferred(fn, *args, **kwargs).chainDeferred(d)
@@ -0,0 +1,370 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Recording of the activities EnDroid receives, and replaying of recordings
+for offline load testing.
+
+A recording is a gzipped JSONL file. Each line is an object with the 'time'
+it was written and one of:
+    identity - EnDroid's own person details (from people/me).
+    activity - An event as received on the websocket (or by webhook).
+    message  - A message fetched for one of the activities.
+
+Record with 'endroid --record FILE', then replay with:
+
+    python -m endroid.replay [--speed N] [--config FILE] FILE
+
+Replaying feeds the activities back through WebexClient._process_message at
+their original pace (or N times faster, or as fast as possible if N is 0),
+with the recorded messages returned by a stub API, and reports the
+throughput and the latency from each activity to its message's delivery.
+"""
+
+import sys
+import gzip
+import json
+import logging
+import argparse
+import os.path
+
+from twisted.internet import reactor, defer, task
+
+from endroid.webex_api import WebexObject, ApiError, uuid_from_id
+from endroid.webex_client import WebexClient, INGEST_WEBHOOK
+from endroid.database import Database
+
+logger = logging.getLogger("webex-replay")
+
+# Seconds between checks that everything fed in has been processed
+DRAIN_POLL_INTERVAL = 0.1
+
+PERCENTILES = (50, 90, 99)
+
+
+class Recorder(object):
+    """
+    Writes activities and messages to a recording. Appends to the file if it
+    already exists.
+
+    Attributes:
+        path  - The file being recorded to.
+        count - The number of records written.
+    """
+    def __init__(self, path, clock=reactor):
+        self.path = os.path.expanduser(path)
+        self.count = 0
+        self._clock = clock
+        self._file = gzip.open(self.path, 'ab')
+
+    def _write(self, kind, data):
+        self._file.write(json.dumps({'time': self._clock.seconds(),
+                                     kind: data}) + '\n')
+        self.count += 1
+
+    def record_identity(self, me):
+        self._write('identity', me)
+
+    def record_activity(self, data):
+        self._write('activity', data)
+
+    def record_message(self, message):
+        """
+        Record a fetched message. Returns the message, so this can be added as
+        a Deferred callback.
+        """
+        if message is not None:
+            self._write('message', message)
+        return message
+
+    def close(self):
+        logger.info("Recorded %u items to %s", self.count, self.path)
+        self._file.close()
+
+
+def read_recording(path):
+    """Yield (time, kind, data) for each record in a recording."""
+    with gzip.open(os.path.expanduser(path), 'rb') as f:
+        for line in f:
+            record = json.loads(line)
+            time = record.pop('time')
+            kind, data = record.popitem()
+            yield time, kind, data
+
+
+class _StubEndpoint(object):
+    """Answers API calls without doing anything."""
+    def get(self, obj_id):
+        return defer.succeed(WebexObject(id=obj_id))
+
+    def list(self, **params):
+        return defer.succeed([])
+
+    def list_until(self, stop, **params):
+        return defer.succeed([])
+
+    def create(self, **fields):
+        return defer.succeed(WebexObject(fields))
+
+    def delete(self, *args, **kwargs):
+        return defer.succeed(None)
+
+
+class _StubPeople(_StubEndpoint):
+    def __init__(self, identity):
+        self._identity = identity
+
+    def me(self):
+        return defer.succeed(self._identity)
+
+
+class _ReplayMessages(_StubEndpoint):
+    """Answers message fetches from the recording, after an optional delay."""
+    def __init__(self, messages, delay, clock):
+        self._messages = messages
+        self._delay = delay
+        self._clock = clock
+
+    def get(self, message_id):
+        message = self._messages.get(message_id)
+        if message is None:
+            return defer.fail(ApiError(404, "GET", "messages/" + message_id))
+        if self._delay:
+            return task.deferLater(self._clock, self._delay, lambda: message)
+        return defer.succeed(message)
+
+
+class ReplayAPI(object):
+    """
+    Stands in for WebexAPI when replaying. Messages are fetched from the
+    recording and everything else succeeds without doing anything.
+
+    Attributes:
+        messages, memberships, rooms, people, webhooks - As for WebexAPI.
+    """
+    def __init__(self, messages, identity, fetch_delay=0.0, clock=reactor):
+        self.messages = _ReplayMessages(messages, fetch_delay, clock)
+        self.memberships = _StubEndpoint()
+        self.rooms = _StubEndpoint()
+        self.webhooks = _StubEndpoint()
+        self.people = _StubPeople(identity)
+
+    def request(self, method, url, params=None, json=None):
+        return defer.succeed(WebexObject())
+
+
+class Replayer(object):
+    """
+    Feeds recorded activities to a WebexClient and measures how long each
+    message takes to be delivered.
+
+    Attributes:
+        activities - List of (time, activity) to replay.
+        speed      - Multiple of the recorded pace to replay at, or 0 to feed
+                     everything in at once.
+        latencies  - Seconds from each activity being fed in to its message
+                     being delivered.
+    """
+    def __init__(self, activities, speed=1.0, clock=reactor):
+        self.activities = activities
+        self.speed = speed
+        self.latencies = []
+        self._clock = clock
+        self._fed = {}  # activity id : time fed in
+        self._started = None
+        self._finished = None
+
+    def delivered(self, message):
+        """Note a message's delivery. Wrap the client's on_message with it."""
+        fed = self._fed.pop(uuid_from_id(message.id), None)
+        if fed is not None:
+            self.latencies.append(self._clock.seconds() - fed)
+
+    def run(self, client):
+        """
+        Replay the activities, returning a Deferred that fires with a report
+        dict once everything has been processed.
+        """
+        self._started = self._clock.seconds()
+        if not self.activities:
+            return defer.succeed(self.report(client))
+
+        start = self.activities[0][0]
+        feeds = []
+        for time, activity in self.activities:
+            delay = (time - start) / self.speed if self.speed else 0
+            feeds.append(task.deferLater(self._clock, delay, self._feed,
+                                         client, activity))
+
+        d = defer.gatherResults(feeds)
+        d.addCallback(lambda _: self._drained(client))
+        d.addCallback(lambda _: self.report(client))
+        return d
+
+    def _feed(self, client, data):
+        activity = data.get('data', {}).get('activity')
+        if activity is not None:
+            self._fed.setdefault(activity['id'], self._clock.seconds())
+        client._process_message(data)
+
+    def _drained(self, client):
+        """Return a Deferred firing once the client has nothing queued."""
+        d = defer.Deferred()
+
+        def check():
+            if client.ingest.depth() == 0 and client.queue.depth() == 0:
+                self._finished = self._clock.seconds()
+                loop.stop()
+                d.callback(None)
+
+        loop = task.LoopingCall(check)
+        loop.clock = self._clock
+        loop.start(DRAIN_POLL_INTERVAL)
+        return d
+
+    def report(self, client):
+        elapsed = (self._finished or self._clock.seconds()) - self._started
+        latencies = sorted(self.latencies)
+        return {
+            'activities': len(self.activities),
+            'delivered': len(latencies),
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'latency': dict(('p{}'.format(p), percentile(latencies, p))
+                            for p in PERCENTILES),
+            'max_latency': latencies[-1] if latencies else 0.0,
+            'ingest': dict(client.ingest_stats),
+            'buffer': dict(client.ingest.stats),
+            'queue': client.queue.metrics(),
+        }
+
+
+def percentile(values, p):
+    """Return the p'th percentile (nearest rank) of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def load(path):
+    """
+    Read a recording, returning the identity, a dict of message id :
+    message, and a list of (time, activity).
+    """
+    identity = WebexObject(emails=[], id=None)
+    messages = {}
+    activities = []
+    for time, kind, data in read_recording(path):
+        if kind == 'identity':
+            identity = WebexObject(data)
+        elif kind == 'message':
+            message = WebexObject(data)
+            messages[message.id] = message
+            # The websocket activities refer to messages by bare UUID
+            messages[uuid_from_id(message.id)] = message
+        elif kind == 'activity':
+            activities.append((time, data))
+    return identity, messages, activities
+
+
+def build_client(conf, rooms, api, replayer):
+    """
+    Create a WebexClient using api. If a config is given, EnDroid's message
+    handling and plugins are set up behind it as normal.
+    """
+    client = WebexClient("replay", rooms=rooms, ingestion=INGEST_WEBHOOK)
+    client.webex_api = api
+    client.outbound.api = api
+
+    if conf is None:
+        client.set_callbacks(connected=lambda: None,
+                             on_message=replayer.delivered,
+                             on_membership=lambda room, user: None)
+        return client
+
+    # Imported here as they are only needed for a full replay
+    from endroid.webexhandler import WebexHandler
+    from endroid.usermanagement import UserManagement
+    from endroid.messagehandler import MessageHandler
+
+    def on_message(message):
+        wh.onMessage(message)
+        replayer.delivered(message)
+
+    wh = WebexHandler()
+    wh.setHandlerParent(client)
+    client.set_callbacks(connected=wh.connected,
+                         on_message=on_message,
+                         on_membership=wh.onMembership,
+                         accept_activity=wh.accept_activity,
+                         on_room_change=wh.onRoomChange)
+    um = UserManagement(wh, conf)
+    MessageHandler(wh, um, config=conf)
+    return client
+
+
+def print_report(report, out=sys.stdout):
+    out.write("Replayed {activities} activities in {elapsed:.3f}s\n"
+              "Delivered {delivered} messages ({throughput:.1f}/s)\n"
+              .format(**report))
+    out.write("Latency (ms): " + ", ".join(
+        "{} {:.2f}".format(name, report['latency'][name] * 1000)
+        for name in sorted(report['latency'])) +
+        ", max {:.2f}\n".format(report['max_latency'] * 1000))
+    for name in ('ingest', 'buffer', 'queue'):
+        out.write("{}: {}\n".format(name, report[name]))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="endroid.replay",
+        description="Replay a recording of the activities EnDroid received.")
+    parser.add_argument("recording", help="Recording file to replay.")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Multiple of the recorded speed to replay at, "
+                        "or 0 to replay as fast as possible.")
+    parser.add_argument("-d", "--fetch-delay", type=float, default=0.0,
+                        help="Simulated seconds taken to fetch a message.")
+    parser.add_argument("-c", "--config", default=None,
+                        help="EnDroid config file. If given, messages are "
+                        "handled by the configured plugins.")
+    parser.add_argument("-l", "--level", type=int, default=logging.WARNING,
+                        help="Logging level. Lower is more verbose.")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=args.level)
+    # Don't let plugins touch a real database
+    Database.setFile(":memory:")
+
+    identity, messages, activities = load(args.recording)
+    api = ReplayAPI(messages, identity, fetch_delay=args.fetch_delay)
+    replayer = Replayer(activities, speed=args.speed)
+
+    conf = None
+    if args.config is not None:
+        from endroid.confparser import Parser
+        conf = Parser(args.config)
+        rooms = conf.get("setup", "rooms", default=[])
+    else:
+        rooms = set(message.roomId for message in messages.values()
+                    if message.roomType == 'group')
+    client = build_client(conf, rooms, api, replayer)
+
+    def done(result):
+        reactor.stop()
+        return result
+
+    d = client.bootstrapped
+    d.addCallback(lambda _: replayer.run(client))
+    d.addCallback(print_report)
+    d.addErrback(lambda f: logger.error("Replay failed: %s",
+                                        f.getTraceback()))
+    d.addBoth(done)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
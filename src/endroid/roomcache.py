@@ -0,0 +1,128 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Caching of room details and memberships fetched from Webex.
+"""
+
+import logging
+from collections import Counter
+
+from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
+
+logger = logging.getLogger("webex-roomcache")
+
+# Seconds a room's details or memberships are trusted for, if no activity
+# says they have changed before then
+DEFAULT_TTL = 300.0
+
+
+class _Entry(object):
+    __slots__ = ("value", "expires", "waiting")
+
+    def __init__(self):
+        self.value = None
+        self.expires = None     # None until a fetch has completed
+        self.waiting = None     # Deferreds waiting on a fetch in progress
+
+
+class RoomCache(object):
+    """
+    Caches each room's details and list of memberships for up to ttl
+    seconds. Callers asking for something already being fetched share the
+    fetch.
+
+    Entries are invalidated (or updated in place where possible) by the
+    membership activities EnDroid receives, and by its own membership
+    changes, so the TTL only bounds staleness from changes EnDroid wasn't
+    told about.
+
+    Attributes:
+        api   - The WebexAPI to fetch with.
+        ttl   - Seconds an entry is used for.
+        stats - Counter of 'hits', 'misses' (also by kind, e.g.
+                'misses.memberships') and 'invalidated' entries.
+    """
+    def __init__(self, api, ttl=DEFAULT_TTL, clock=reactor):
+        self.api = api
+        self.ttl = ttl
+        self.stats = Counter()
+        self._clock = clock
+        self._rooms = {}        # room : _Entry of the room's details
+        self._memberships = {}  # room : _Entry of the room's memberships
+
+    def room(self, room):
+        """Return a Deferred firing with the room's details."""
+        return self._get(self._rooms, "room", room,
+                         lambda: self.api.rooms.get(room))
+
+    def memberships(self, room):
+        """Return a Deferred firing with the list of the room's memberships."""
+        return self._get(self._memberships, "memberships", room,
+                         lambda: self.api.memberships.list(roomId=room))
+
+    def _get(self, entries, kind, room, fetch):
+        entry = entries.setdefault(room, _Entry())
+        if entry.expires is not None and entry.expires > self._clock.seconds():
+            self.stats['hits'] += 1
+            return defer.succeed(entry.value)
+
+        self.stats['misses'] += 1
+        self.stats['misses.' + kind] += 1
+        # Each caller gets its own Deferred, so none can alter the result
+        # for the others
+        d = defer.Deferred()
+        if entry.waiting is None:
+            entry.waiting = [d]
+            fetch().addBoth(self._fetched, entries, room, entry)
+        else:
+            entry.waiting.append(d)
+        return d
+
+    def _fetched(self, result, entries, room, entry):
+        waiting, entry.waiting = entry.waiting, None
+        if not isinstance(result, Failure) and entries.get(room) is entry:
+            # Not invalidated while the fetch was in progress
+            entry.value = result
+            entry.expires = self._clock.seconds() + self.ttl
+        for d in waiting:
+            d.callback(result)
+
+    def invalidate(self, room, details=True, memberships=True):
+        """Forget the room's details and/or memberships."""
+        for wanted, entries in ((details, self._rooms),
+                                (memberships, self._memberships)):
+            if wanted and entries.pop(room, None) is not None:
+                logger.debug("Invalidated cached %s for room %s",
+                             "details" if entries is self._rooms
+                             else "memberships", room)
+                self.stats['invalidated'] += 1
+
+    def member_added(self, room, membership=None, email=None):
+        """
+        Note that a membership was created. If the membership itself is known
+        it is added to the cached list, otherwise the list is invalidated
+        (unless it already has the member).
+        """
+        entry = self._memberships.get(room)
+        if entry is None or entry.expires is None:
+            self.invalidate(room, details=False)
+            return
+        emails = set(m.personEmail for m in entry.value)
+        if membership is not None:
+            if membership.personEmail not in emails:
+                entry.value = entry.value + [membership]
+        elif email not in emails:
+            self.invalidate(room, details=False)
+
+    def member_removed(self, room, email):
+        """Remove a member's memberships from the cached list."""
+        entry = self._memberships.get(room)
+        if entry is None or entry.expires is None:
+            self.invalidate(room, details=False)
+            return
+        entry.value = [membership for membership in entry.value
+                       if membership.personEmail != email]
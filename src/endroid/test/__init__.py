@@ -0,0 +1,10 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Unit tests for EnDroid, run with trial:
+
+    PYTHONPATH=src trial endroid.test
+"""
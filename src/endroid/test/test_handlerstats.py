@@ -0,0 +1,76 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.trial import unittest
+
+from endroid.handlerstats import HandlerStats, HandlerStatsTable
+
+
+class HandlerStatsTests(unittest.TestCase):
+    def test_record(self):
+        stats = HandlerStats()
+        self.assertEqual(stats.mean, 0.0)
+        stats.record(0.0005)
+        stats.record(0.5, failed=True)
+        stats.record(20)
+        self.assertEqual(stats.calls, 3)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.max, 20)
+        self.assertAlmostEqual(stats.mean, 20.5005 / 3)
+        self.assertEqual(stats.buckets, [1, 0, 0, 1, 0, 1])
+
+    def test_bucket_bounds_inclusive(self):
+        stats = HandlerStats()
+        stats.record(0.01)
+        self.assertEqual(stats.buckets, [0, 1, 0, 0, 0, 0])
+
+
+class HandlerStatsTableTests(unittest.TestCase):
+    def setUp(self):
+        self.table = HandlerStatsTable()
+        self.table.handler("chuck", "joke", "recv").record(2.0)
+        self.table.handler("chuck", "joke", "recv").record(0.001)
+        self.table.handler("spell", "check", "command").record(0.5,
+                                                                failed=True)
+        self.table.handler("spell", "suggest", "recv").record(0.002)
+
+    def handlers(self, report):
+        """Return the handler names in the rows of report."""
+        return [line.split(" ")[0] for line in report.split("\n")[1:]]
+
+    def test_same_handler_shared(self):
+        self.assertIs(self.table.handler("chuck", "joke", "recv"),
+                      self.table.handler("chuck", "joke", "recv"))
+        self.assertIsNot(self.table.handler("chuck", "joke", "recv"),
+                         self.table.handler("chuck", "joke", "unhandled"))
+
+    def test_report_sorted_by_total(self):
+        report = self.table.report()
+        self.assertTrue(report.startswith("handler: calls errors"))
+        self.assertEqual(self.handlers(report),
+                         ["chuck.joke", "spell.check", "spell.suggest"])
+        self.assertIn("chuck.joke (recv): 2 0 2.001 1000.50 2000.00 | "
+                      "1 0 0 0 1 0", report)
+
+    def test_report_sort_and_limit(self):
+        report = self.table.report(sort='errors', limit=1)
+        self.assertEqual(self.handlers(report), ["spell.check"])
+        report = self.table.report(sort='calls')
+        self.assertEqual(self.handlers(report)[0], "chuck.joke")
+
+    def test_report_for_plugin(self):
+        report = self.table.report(plugin="spell", sort='max')
+        self.assertEqual(self.handlers(report),
+                         ["spell.check", "spell.suggest"])
+
+    def test_report_bad_sort(self):
+        self.assertRaises(ValueError, self.table.report, sort='name')
+
+    def test_report_empty(self):
+        self.table.clear()
+        self.assertEqual(self.table.report(),
+                         "No handler statistics recorded.")
+        self.assertEqual(self.table.report(plugin="nobody"),
+                         HandlerStatsTable().report())
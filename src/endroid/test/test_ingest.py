@@ -0,0 +1,167 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from endroid.ingest import (IngestBuffer, IngestQueue, CATEGORY_SELF,
+                            CATEGORY_MESSAGE, CATEGORY_MEMBERSHIP,
+                            CATEGORY_UNHANDLED, parse_shed_order)
+
+
+class IngestBufferTests(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+        self.buffer = IngestBuffer(self.delivered.append, max_seen=3)
+
+    def test_duplicates_dropped(self):
+        self.assertFalse(self.buffer.seen("a"))
+        self.assertTrue(self.buffer.seen("a"))
+        self.assertFalse(self.buffer.seen("b"))
+        self.assertEqual(self.buffer.stats['duplicates'], 1)
+
+    def test_least_recently_seen_forgotten(self):
+        for activity in ("a", "b", "c"):
+            self.buffer.seen(activity)
+        # Seeing a again makes b the least recently seen
+        self.assertTrue(self.buffer.seen("a"))
+        self.buffer.seen("d")
+        self.assertFalse(self.buffer.seen("b"))
+        self.assertTrue(self.buffer.seen("a"))
+
+    def test_delivered_in_arrival_order(self):
+        first, second, third = (defer.Deferred() for _ in range(3))
+        self.buffer.add("room", "1", first)
+        self.buffer.add("room", "2", second)
+        self.buffer.add("room", "3", third)
+
+        third.callback("m3")
+        second.callback("m2")
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.buffer.depth("room"), 3)
+
+        first.callback("m1")
+        self.assertEqual(self.delivered, ["m1", "m2", "m3"])
+        self.assertEqual(self.buffer.depth(), 0)
+        self.assertEqual(self.buffer.stats['reordered'], 2)
+        self.assertEqual(self.buffer.stats['max_reorder_depth'], 2)
+
+    def test_rooms_independent(self):
+        slow, fast = defer.Deferred(), defer.Deferred()
+        self.buffer.add("room1", "1", slow)
+        self.buffer.add("room2", "2", fast)
+        fast.callback("m2")
+        self.assertEqual(self.delivered, ["m2"])
+        slow.callback("m1")
+        self.assertEqual(self.delivered, ["m2", "m1"])
+
+    def test_failed_fetch_releases_later_messages(self):
+        failing, later = defer.Deferred(), defer.Deferred()
+        self.buffer.add("room", "1", failing)
+        self.buffer.add("room", "2", later)
+        later.callback("m2")
+        failing.errback(RuntimeError("fetch failed"))
+        self.assertEqual(self.delivered, ["m2"])
+        self.assertEqual(self.buffer.stats['delivered'], 1)
+
+    def test_nothing_to_deliver(self):
+        d = defer.Deferred()
+        self.buffer.add("room", "1", d)
+        d.callback(None)
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(self.buffer.depth(), 0)
+
+
+class IngestQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.done = []
+        self.queue = IngestQueue(max_depth=3, batch_size=2, clock=self.clock)
+
+    def put(self, category, name):
+        return self.queue.put(category, self.done.append, name)
+
+    def test_processed_in_batches(self):
+        queue = IngestQueue(max_depth=10, batch_size=2, clock=self.clock)
+        for i in range(5):
+            queue.put(CATEGORY_MESSAGE, self.done.append, i)
+        self.assertEqual(self.done, [])
+        self.clock.advance(0)
+        self.assertEqual(self.done, [0, 1, 2, 3, 4])
+        self.assertEqual(queue.depth(), 0)
+
+    def test_sheds_lowest_priority_first(self):
+        self.put(CATEGORY_MESSAGE, "m1")
+        self.put(CATEGORY_MEMBERSHIP, "join")
+        self.put(CATEGORY_SELF, "self")
+        # Full: the self message goes first, then the membership. An
+        # unhandled fallback ranks below a membership, so it is dropped
+        # itself
+        self.assertTrue(self.put(CATEGORY_MESSAGE, "m2"))
+        self.assertFalse(self.put(CATEGORY_UNHANDLED, "fallback"))
+        self.assertTrue(self.put(CATEGORY_MESSAGE, "m3"))
+
+        self.clock.advance(0)
+        self.assertEqual(self.done, ["m1", "m2", "m3"])
+        self.assertEqual(self.queue.stats['shed.self'], 1)
+        self.assertEqual(self.queue.stats['shed.membership'], 1)
+        self.assertEqual(self.queue.stats['shed.unhandled'], 1)
+
+    def test_oldest_of_category_shed(self):
+        self.put(CATEGORY_SELF, "s1")
+        self.put(CATEGORY_MESSAGE, "m1")
+        self.put(CATEGORY_SELF, "s2")
+        self.assertTrue(self.put(CATEGORY_MESSAGE, "m2"))
+        self.clock.advance(0)
+        self.assertEqual(self.done, ["m1", "s2", "m2"])
+
+    def test_same_category_drops_new_item(self):
+        for i in range(3):
+            self.put(CATEGORY_MESSAGE, i)
+        self.assertFalse(self.put(CATEGORY_MESSAGE, 3))
+        self.clock.advance(0)
+        self.assertEqual(self.done, [0, 1, 2])
+
+    def test_new_item_shed_if_lowest_priority(self):
+        for i in range(3):
+            self.put(CATEGORY_MESSAGE, i)
+        self.assertFalse(self.put(CATEGORY_SELF, "self"))
+        self.assertEqual(self.queue.depth(), 3)
+        self.assertEqual(self.queue.stats['shed.self'], 1)
+
+    def test_unlisted_category_shed_last(self):
+        queue = IngestQueue(max_depth=2, shed_order=(CATEGORY_SELF,),
+                            clock=self.clock)
+        queue.put("other", self.done.append, "o1")
+        queue.put(CATEGORY_MESSAGE, self.done.append, "m1")
+        # Neither category is in shed_order, so only the new item can go
+        self.assertFalse(queue.put(CATEGORY_MESSAGE, self.done.append, "m2"))
+        self.clock.advance(0)
+        self.assertEqual(self.done, ["o1", "m1"])
+
+    def test_metrics(self):
+        self.put(CATEGORY_MESSAGE, "m1")
+        self.clock.advance(2)
+        metrics = self.queue.metrics()
+        self.assertEqual(metrics['processed'], 1)
+        self.assertEqual(metrics['depth'], 0)
+        self.assertEqual(metrics['max_wait'], 2)
+
+
+class ShedOrderTests(unittest.TestCase):
+    def test_list(self):
+        self.assertEqual(parse_shed_order("ingest_shed_order",
+                                          ["unhandled", "self"]),
+                         (CATEGORY_UNHANDLED, CATEGORY_SELF))
+
+    def test_single_category(self):
+        self.assertEqual(parse_shed_order("ingest_shed_order", "self"),
+                         (CATEGORY_SELF,))
+
+    def test_unknown_category(self):
+        e = self.assertRaises(ValueError, parse_shed_order,
+                              "ingest_shed_order", ["self", "spam"])
+        self.assertIn("ingest_shed_order", str(e))
+        self.assertIn("spam", str(e))
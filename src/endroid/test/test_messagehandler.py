@@ -0,0 +1,198 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from endroid.confparser import Parser
+from endroid.messagehandler import MessageHandler, Message
+from endroid.usermanagement import UserManagement
+
+CONFIG = """
+[Setup]
+users = a@x.com, b@x.com
+groups = all, admins
+block_threshold = 0
+
+[group: admins]
+users = a@x.com,
+"""
+
+
+class FakeWebexHandler(object):
+    def set_user_management(self, um):
+        pass
+
+    def set_message_handler(self, mh):
+        pass
+
+
+def callback(msg):
+    pass
+
+
+def admin_callback(msg):
+    pass
+
+
+def message_handler(test, clock=None):
+    path = test.mktemp()
+    with open(path, 'w') as f:
+        f.write(CONFIG)
+    config = Parser(path)
+    wh = FakeWebexHandler()
+    um = UserManagement(wh, config)
+    return MessageHandler(wh, um, config, clock=clock or task.Clock())
+
+
+class DispatchTests(unittest.TestCase):
+    def setUp(self):
+        self.mh = message_handler(self)
+        self.um = self.mh.um
+        self.mh._register_callback("all", "chat", "recv", callback)
+        self.mh._register_callback("admins", "chat", "recv", admin_callback,
+                                   priority=-1)
+
+    def callbacks(self, user):
+        return [h.callback for h in
+                self.mh._get_handlers("chat", "recv", user)]
+
+    def test_handlers_from_all_groups_in_priority_order(self):
+        self.assertEqual(self.callbacks("a@x.com"), [admin_callback, callback])
+        self.assertEqual(self.callbacks("b@x.com"), [callback])
+
+    def test_handlers_built_once(self):
+        handlers = self.mh._get_handlers("chat", "recv", "a@x.com")
+        self.assertIdentical(self.mh._get_handlers("chat", "recv", "a@x.com"),
+                             handlers)
+
+    def test_registering_callback_rebuilds_table(self):
+        self.callbacks("b@x.com")
+        self.mh._register_callback("admins", "chat", "recv", callback)
+        self.mh._register_callback("all", "chat", "recv", admin_callback,
+                                   priority=1)
+        self.assertEqual(self.callbacks("b@x.com"), [callback, admin_callback])
+
+    def test_roster_change_rebuilds_users_handlers(self):
+        self.callbacks("a@x.com")
+        self.callbacks("b@x.com")
+        self.um.group_rosters["admins"].register_user("b@x.com")
+        self.assertEqual(self.callbacks("b@x.com"), [admin_callback, callback])
+        # Other users' handlers are kept
+        self.assertIn(("chat", "recv", "a@x.com"), self.mh._dispatch)
+
+
+class HandlerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.mh = message_handler(self, self.clock)
+        self.msg = Message("chat", "b@x.com", "hello", self.mh,
+                           "endroid@x.com")
+        self.fallbacks = []
+        # Deferreds returned by asynchronous handlers, in the order called
+        self.pending = []
+
+    def register(self, *callbacks):
+        for callback in callbacks:
+            self.mh._register_callback("all", "chat", "recv", callback)
+
+    def receive(self):
+        results = []
+        d = self.mh._do_callback("recv", self.msg, self.fallbacks.append)
+        d.addBoth(results.append)
+        return results
+
+    def handled(self, msg):
+        pass
+
+    def unhandled(self, msg):
+        msg.unhandled()
+
+    def later(self, msg):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def unhandled_later(self, msg):
+        return self.later(msg).addCallback(lambda _: msg.unhandled())
+
+    def test_fallback_when_no_handler_handles(self):
+        self.register(self.unhandled, self.unhandled)
+        self.receive()
+        self.assertEqual(self.fallbacks, [self.msg])
+
+    def test_no_fallback_when_handled(self):
+        self.register(self.unhandled, self.handled)
+        self.receive()
+        self.assertEqual(self.fallbacks, [])
+
+    def test_concurrent_handlers(self):
+        self.register(self.unhandled_later, self.unhandled_later)
+        results = self.receive()
+        self.assertEqual(len(self.pending), 2)
+        self.pending[1].callback(None)
+        self.assertEqual((self.fallbacks, results), ([], []))
+        self.pending[0].callback(None)
+        self.assertEqual(self.fallbacks, [self.msg])
+        self.assertEqual(results, [[None, None]])
+
+    def test_unhandled_then_raised_counted_once(self):
+        def fails(msg):
+            msg.unhandled()
+            raise RuntimeError("handler failed")
+        self.register(fails, self.later)
+        self.receive()
+        self.assertEqual(self.fallbacks, [])
+        self.pending[0].callback(None)
+        self.assertEqual(self.fallbacks, [])
+
+    def test_unhandled_then_failed_counted_once(self):
+        def fails(msg):
+            msg.unhandled()
+            return defer.fail(RuntimeError("handler failed"))
+        self.register(fails, self.unhandled_later)
+        self.receive()
+        self.assertEqual(self.fallbacks, [])
+        self.pending[0].callback(None)
+        self.assertEqual(self.fallbacks, [self.msg])
+
+    def test_nested_handlers(self):
+        # As run by the command plugin
+        def commands(msg):
+            msg.inc_handlers()
+            self.mh.run_handler(msg, self.unhandled_later)
+            msg.unhandled()
+        self.register(commands)
+        self.receive()
+        self.assertEqual(self.fallbacks, [])
+        self.pending[0].callback(None)
+        self.assertEqual(self.fallbacks, [self.msg])
+
+    def test_timeout_per_message(self):
+        self.register(self.later)
+        results = self.receive()
+        self.clock.advance(self.mh.handler_timeout / 2)
+        # A handler started later only gets what is left of the time
+        self.msg.inc_handlers()
+        self.mh.run_handler(self.msg, self.unhandled_later)
+        self.clock.advance(self.mh.handler_timeout / 2)
+        self.assertEqual(results, [[None]])
+        self.assertEqual(self.fallbacks, [self.msg])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout_cancelled_when_handlers_finish(self):
+        self.register(self.later)
+        self.receive()
+        self.pending[0].callback(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.mh._running_handlers, {})
+
+    def test_timed_out_handler_finishing_ignored(self):
+        self.register(self.unhandled_later)
+        self.receive()
+        self.clock.advance(self.mh.handler_timeout)
+        self.assertEqual(self.fallbacks, [self.msg])
+        self.pending[0].callback(None)
+        self.assertEqual(self.fallbacks, [self.msg])
@@ -0,0 +1,212 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from endroid.webex_api import ApiError, RateLimitError
+from endroid.outbound import (SendQueue, INITIAL_BACKOFF, MAX_MESSAGE_LEN,
+                              COALESCE_SEPARATOR, chunk_text, message_size)
+
+
+class ChunkTextTests(unittest.TestCase):
+    def test_short_text_unchanged(self):
+        self.assertEqual(chunk_text("hello", limit=5), ["hello"])
+        text = "x" * MAX_MESSAGE_LEN
+        self.assertEqual(chunk_text(text), [text])
+
+    def test_split_at_line_break(self):
+        self.assertEqual(chunk_text("one two\nthree four", limit=12),
+                         ["one two", "three four"])
+
+    def test_line_break_preferred_to_space(self):
+        self.assertEqual(chunk_text("aaaaaa\nbb cc dd", limit=10),
+                         ["aaaaaa", "bb cc dd"])
+
+    def test_early_line_break_not_used(self):
+        # A line break in the first half of the chunk would leave it short,
+        # so a later space is used instead
+        self.assertEqual(chunk_text("a\nbbbb cccc dddd", limit=12),
+                         ["a\nbbbb cccc", "dddd"])
+
+    def test_split_at_space(self):
+        self.assertEqual(chunk_text("aaa bbb ccc", limit=8),
+                         ["aaa bbb", "ccc"])
+
+    def test_long_word_split(self):
+        self.assertEqual(chunk_text("abcdefghij", limit=4),
+                         ["abcd", "efgh", "ij"])
+
+    def test_multibyte_characters_not_split(self):
+        text = u"\xe9" * 5
+        chunks = chunk_text(text, limit=3)
+        self.assertEqual(chunks, [u"\xe9"] * 5)
+        self.assertEqual(u"".join(chunks), text)
+
+    def test_chunks_fit(self):
+        text = u" ".join([u"w\u2603rd"] * 100) + u"\n" + u"x" * 50
+        chunks = chunk_text(text, limit=64)
+        self.assertTrue(all(message_size(chunk) <= 64 for chunk in chunks))
+        # Only the spaces and line breaks split at are lost
+        strip = lambda s: s.replace(u" ", u"").replace(u"\n", u"")
+        self.assertEqual(strip(u"".join(chunks)), strip(text))
+
+
+class FakeMessages(object):
+    """Records creates, leaving the test to fire their Deferreds."""
+    def __init__(self):
+        self.creates = []
+
+    def create(self, **fields):
+        d = defer.Deferred()
+        self.creates.append((fields, d))
+        return d
+
+    def texts(self):
+        return [fields['text'] for fields, _ in self.creates]
+
+
+class FakeAPI(object):
+    def __init__(self):
+        self.messages = FakeMessages()
+
+
+class SendQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.api = FakeAPI()
+        self.queue = SendQueue(self.api, max_in_flight=2, max_retries=2,
+                               clock=self.clock)
+
+    def send(self, destination, text, **kwargs):
+        results = []
+        d = self.queue.send(destination, roomId=destination, text=text,
+                            **kwargs)
+        d.addBoth(results.append)
+        return results
+
+    def fire(self, index, result=None):
+        _, d = self.api.messages.creates[index]
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result or {'id': index})
+
+    def test_in_order_per_destination(self):
+        self.send("room1", "a")
+        self.send("room1", "b")
+        self.send("room2", "c")
+        # One create in flight per destination
+        self.assertEqual(self.api.messages.texts(), ["a", "c"])
+        self.fire(0)
+        self.assertEqual(self.api.messages.texts(), ["a", "c", "b"])
+
+    def test_in_flight_bounded(self):
+        for room in ("room1", "room2", "room3"):
+            self.send(room, room)
+        self.assertEqual(len(self.api.messages.creates), 2)
+        self.fire(1)
+        self.assertEqual(len(self.api.messages.creates), 3)
+
+    def test_rate_limit_waits_for_retry_after(self):
+        results = self.send("room1", "a")
+        self.send("room2", "b")
+        self.fire(0, RateLimitError(429, "POST", "messages", retry_after=5))
+        self.fire(1)
+        # Nothing is sent during the pause
+        self.send("room2", "c")
+        self.clock.advance(4.9)
+        self.assertEqual(self.api.messages.texts(), ["a", "b"])
+
+        self.clock.advance(0.1)
+        texts = self.api.messages.texts()
+        self.assertEqual(sorted(texts[2:]), ["a", "c"])
+        retry = texts.index("a", 2)
+        self.fire(retry)
+        self.assertEqual(results, [{'id': retry}])
+        self.assertEqual(self.queue.stats['rate_limited'], 1)
+
+    def test_server_error_backs_off(self):
+        results = self.send("room1", "a")
+        self.fire(0, ApiError(503, "POST", "messages"))
+        self.clock.advance(INITIAL_BACKOFF)
+        self.assertEqual(len(self.api.messages.creates), 2)
+        self.fire(1, ApiError(500, "POST", "messages"))
+        # The backoff doubles
+        self.clock.advance(INITIAL_BACKOFF)
+        self.assertEqual(len(self.api.messages.creates), 2)
+        self.clock.advance(INITIAL_BACKOFF)
+        self.fire(2)
+        self.assertEqual(results, [{'id': 2}])
+        self.assertEqual(self.queue.stats['retried'], 2)
+
+    def test_retries_exhausted(self):
+        results = self.send("room1", "a")
+        later = self.send("room1", "b")
+        for attempt in range(3):
+            self.fire(attempt, ApiError(500, "POST", "messages"))
+            self.clock.advance(60)
+        self.assertEqual(len(results), 1)
+        results[0].trap(ApiError)
+        self.assertEqual(self.queue.stats['failed'], 1)
+        # The queue moves on to the next message
+        self.assertEqual(self.api.messages.texts()[-1], "b")
+        self.fire(3)
+        self.assertEqual(later, [{'id': 3}])
+
+    def test_client_error_not_retried(self):
+        results = self.send("room1", "a")
+        self.fire(0, ApiError(400, "POST", "messages"))
+        self.clock.advance(60)
+        self.assertEqual(len(self.api.messages.creates), 1)
+        results[0].trap(ApiError)
+
+    def test_coalesced_within_window(self):
+        first = self.send("room1", "a", coalesce=1)
+        self.clock.advance(0.5)
+        second = self.send("room1", "b", coalesce=1)
+        self.assertEqual(self.api.messages.creates, [])
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.api.messages.texts(),
+                         ["a" + COALESCE_SEPARATOR + "b"])
+        self.fire(0)
+        self.assertEqual(first, [{'id': 0}])
+        self.assertEqual(second, [{'id': 0}])
+        self.assertEqual(self.queue.stats['coalesced'], 1)
+
+    def test_coalescing_stops_at_max_length(self):
+        long_text = "x" * (MAX_MESSAGE_LEN - 1)
+        self.send("room1", long_text, coalesce=1)
+        self.send("room1", "b", coalesce=1)
+        # The first batch is full, so it is sent and b starts a new one
+        self.assertEqual(self.api.messages.texts(), [long_text])
+        self.fire(0)
+        self.clock.advance(1)
+        self.assertEqual(self.api.messages.texts(), [long_text, "b"])
+
+    def test_uncoalesced_message_keeps_order(self):
+        self.send("room1", "a", coalesce=1)
+        self.queue.send("room1", roomId="room1", markdown="**b**")
+        self.assertEqual(len(self.api.messages.creates), 1)
+        self.assertEqual(self.api.messages.creates[0][0]['text'], "a")
+        self.fire(0)
+        self.assertEqual(self.api.messages.creates[1][0],
+                         {'roomId': "room1", 'markdown': "**b**"})
+
+    def test_coalesce_bytes_and_unicode(self):
+        self.send("room1", u"caf\xe9".encode('utf-8'), coalesce=1)
+        self.send("room1", u"\u2603", coalesce=1)
+        self.clock.advance(1)
+        self.assertEqual(self.api.messages.texts(),
+                         [u"caf\xe9" + COALESCE_SEPARATOR + u"\u2603"])
+
+    def test_coalesced_failure_fails_all(self):
+        first = self.send("room1", "a", coalesce=1)
+        second = self.send("room1", "b", coalesce=1)
+        self.clock.advance(1)
+        self.fire(0, ApiError(400, "POST", "messages"))
+        first[0].trap(ApiError)
+        second[0].trap(ApiError)
@@ -0,0 +1,110 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from endroid.quota import TokenBucket, QuotaLimiter, parse_quota
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_starts_full(self):
+        bucket = TokenBucket(rate=2, capacity=3, now=0)
+        self.assertEqual(bucket.level(0), 3)
+        for _ in range(3):
+            self.assertEqual(bucket.take(0), 0)
+        # Half a second until the next token at 2 a second
+        self.assertEqual(bucket.take(0), 0.5)
+
+    def test_refills_up_to_capacity(self):
+        bucket = TokenBucket(rate=2, capacity=3, now=0)
+        for _ in range(3):
+            bucket.take(0)
+        self.assertEqual(bucket.level(1), 2)
+        self.assertEqual(bucket.level(100), 3)
+
+    def test_partial_token(self):
+        bucket = TokenBucket(rate=4, capacity=1, now=0)
+        bucket.take(0)
+        self.assertEqual(bucket.take(0.125), 0.125)
+        self.assertEqual(bucket.take(0.25), 0)
+
+
+class QuotaLimiterTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = []
+        self.limiter = QuotaLimiter({'messages': (2, 2), 'rooms': (0, 1)},
+                                    clock=self.clock)
+
+    def call(self, family, name):
+        results = []
+        d = self.limiter.run(family, self.record, name)
+        d.addCallback(results.append)
+        return results
+
+    def record(self, name):
+        self.calls.append(name)
+        return name
+
+    def test_burst_then_limited(self):
+        results = [self.call('messages', i) for i in range(5)]
+        self.assertEqual(self.calls, [0, 1])
+        self.assertEqual(results[1], [1])
+        self.assertEqual(self.limiter.stats['delayed.messages'], 3)
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [0, 1, 2])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [0, 1, 2, 3])
+        self.clock.advance(0.5)
+        self.assertEqual(results[4], [4])
+
+    def test_waiting_calls_keep_order(self):
+        for i in range(3):
+            self.call('messages', i)
+        # A token is back, but the call waiting goes first
+        self.clock.advance(0.5)
+        self.call('messages', 3)
+        self.assertEqual(self.calls, [0, 1, 2])
+        self.clock.advance(0.5)
+        self.assertEqual(self.calls, [0, 1, 2, 3])
+
+    def test_unlimited_families(self):
+        for i in range(10):
+            self.call('rooms', i)
+            self.call('people', i)
+        self.assertEqual(len(self.calls), 20)
+        self.assertNotIn('rooms', self.limiter.levels())
+
+    def test_failures_passed_on(self):
+        self.call('messages', 0)
+        self.call('messages', 1)
+        failures = []
+        d = self.limiter.run('messages', lambda: defer.fail(ValueError()))
+        d.addErrback(failures.append)
+        self.clock.advance(0.5)
+        failures[0].trap(ValueError)
+
+    def test_levels(self):
+        self.call('messages', 0)
+        self.call('messages', 1)
+        self.call('messages', 2)
+        self.assertEqual(self.limiter.levels(), {'messages': (0, 1)})
+
+
+class ParseQuotaTests(unittest.TestCase):
+    def test_rate_and_burst(self):
+        self.assertEqual(parse_quota("quota_messages", [10, 20], 5), (10, 20))
+
+    def test_rate_alone(self):
+        self.assertEqual(parse_quota("quota_messages", 10, 5), (10, 5))
+        self.assertEqual(parse_quota("quota_messages", 0.5, 5), (0.5, 5))
+
+    def test_bad_quota(self):
+        for value in ([10], [10, 20, 30], "fast", [10, "fast"]):
+            e = self.assertRaises(ValueError, parse_quota, "quota_messages",
+                                  value, 5)
+            self.assertIn("quota_messages", str(e))
@@ -0,0 +1,102 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from endroid.webex_api import WebexObject
+from endroid.roomcache import RoomCache
+
+
+class FakeMemberships(object):
+    def __init__(self):
+        self.lists = []
+
+    def list(self, roomId):
+        d = defer.Deferred()
+        self.lists.append((roomId, d))
+        return d
+
+
+class FakeRooms(object):
+    def __init__(self):
+        self.gets = []
+
+    def get(self, room):
+        self.gets.append(room)
+        return defer.succeed(WebexObject(id=room, title="Room"))
+
+
+class FakeAPI(object):
+    def __init__(self):
+        self.memberships = FakeMemberships()
+        self.rooms = FakeRooms()
+
+
+def member(email):
+    return WebexObject(personEmail=email)
+
+
+class RoomCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.api = FakeAPI()
+        self.cache = RoomCache(self.api, ttl=10, clock=self.clock)
+
+    def memberships(self, room="room"):
+        results = []
+        self.cache.memberships(room).addBoth(results.append)
+        return results
+
+    def test_cached_until_ttl(self):
+        self.cache.room("room")
+        self.clock.advance(9.9)
+        self.cache.room("room")
+        self.assertEqual(self.api.rooms.gets, ["room"])
+        self.clock.advance(0.1)
+        self.cache.room("room")
+        self.assertEqual(self.api.rooms.gets, ["room", "room"])
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(self.cache.stats['misses.room'], 2)
+
+    def test_concurrent_callers_share_fetch(self):
+        first = self.memberships()
+        second = self.memberships()
+        self.assertEqual(len(self.api.memberships.lists), 1)
+        self.api.memberships.lists[0][1].callback([member("a@x.com")])
+        self.assertEqual(first, second)
+
+    def test_failed_fetch_not_cached(self):
+        failed = self.memberships()
+        self.api.memberships.lists[0][1].errback(RuntimeError())
+        failed[0].trap(RuntimeError)
+        self.memberships()
+        self.assertEqual(len(self.api.memberships.lists), 2)
+
+    def test_invalidated_during_fetch(self):
+        self.memberships()
+        self.cache.invalidate("room")
+        self.api.memberships.lists[0][1].callback([member("a@x.com")])
+        self.memberships()
+        self.assertEqual(len(self.api.memberships.lists), 2)
+
+    def test_member_added_and_removed(self):
+        self.memberships()
+        self.api.memberships.lists[0][1].callback([member("a@x.com")])
+        self.cache.member_added("room", membership=member("b@x.com"))
+        self.cache.member_removed("room", "a@x.com")
+        result = self.memberships()
+        self.assertEqual(len(self.api.memberships.lists), 1)
+        self.assertEqual([m.personEmail for m in result[0]], ["b@x.com"])
+
+    def test_unknown_member_added_invalidates(self):
+        self.memberships()
+        self.api.memberships.lists[0][1].callback([member("a@x.com")])
+        self.cache.member_added("room", email="a@x.com")
+        self.memberships()
+        self.assertEqual(len(self.api.memberships.lists), 1)
+        self.cache.member_added("room", email="b@x.com")
+        self.memberships()
+        self.assertEqual(len(self.api.memberships.lists), 2)
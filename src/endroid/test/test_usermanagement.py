@@ -0,0 +1,150 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from endroid.confparser import Parser
+from endroid.usermanagement import UserManagement, Roster
+
+CONFIG = """
+[Setup]
+users = a@x.com, b@x.com, c@x.com
+rooms = room1, room2
+groups = all, admins
+
+[room: room2]
+users = a@x.com,
+
+[group: admins]
+users = b@x.com,
+"""
+
+
+class FakeMessageHandler(object):
+    def __init__(self):
+        self.sent = []
+
+    def send_muc(self, room, body):
+        d = defer.Deferred()
+        self.sent.append((room, d))
+        return d
+
+
+class FakeWebexHandler(object):
+    def __init__(self):
+        self.room_members = {"room1": set(), "room2": set()}
+        self.my_emails = ["endroid@x.com"]
+        self.messagehandler = FakeMessageHandler()
+
+    def set_user_management(self, um):
+        pass
+
+    def when_bootstrapped(self, fn, *args, **kwargs):
+        return defer.maybeDeferred(fn, *args, **kwargs)
+
+
+def user_management(test, wh):
+    path = test.mktemp()
+    with open(path, 'w') as f:
+        f.write(CONFIG)
+    return UserManagement(wh, Parser(path))
+
+
+class RosterTests(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+        self.roster = Roster("group",
+                             lambda user, place: self.changes.append(
+                                 ("+", user, place)),
+                             lambda user, place: self.changes.append(
+                                 ("-", user, place)))
+
+    def test_registration_list(self):
+        self.roster.set_registration_list(["a", "b"])
+        self.roster.set_registration_list(["b", "c"])
+        self.assertEqual(self.roster.registered, set(["b", "c"]))
+        self.assertEqual(sorted(self.changes),
+                         [("+", "a", "group"), ("+", "b", "group"),
+                          ("+", "c", "group"), ("-", "a", "group")])
+
+    def test_deregister_non_member(self):
+        self.roster.deregister_user("a")
+        self.assertEqual(self.changes, [])
+
+
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        self.wh = FakeWebexHandler()
+        self.um = user_management(self, self.wh)
+
+    def test_indexes_built_from_config(self):
+        self.assertEqual(sorted(self.um.rooms("a@x.com")), ["room1", "room2"])
+        self.assertEqual(self.um.rooms("b@x.com"), ["room1"])
+        self.assertEqual(sorted(self.um.groups("b@x.com")), ["admins", "all"])
+        self.assertEqual(self.um.groups("c@x.com"), ["all"])
+
+    def test_unknown_user(self):
+        self.assertEqual(self.um.rooms("z@x.com"), [])
+        self.assertEqual(self.um.groups("z@x.com"), [])
+
+    def test_registration_updates_indexes(self):
+        self.um.register_user("b@x.com", "room2")
+        self.um.register_user("c@x.com", "admins")
+        self.assertEqual(sorted(self.um.rooms("b@x.com")), ["room1", "room2"])
+        self.assertEqual(sorted(self.um.groups("c@x.com")), ["admins", "all"])
+
+    def test_deregistration_updates_indexes(self):
+        self.um.deregister_user("a@x.com", "room2")
+        self.um.deregister_user("b@x.com", "admins")
+        self.assertEqual(self.um.rooms("a@x.com"), ["room1"])
+        self.assertEqual(self.um.groups("b@x.com"), ["all"])
+
+        self.um.deregister_user("c@x.com", "room1")
+        self.assertEqual(self.um.rooms("c@x.com"), [])
+        self.assertNotIn("c@x.com", self.um._user_rooms)
+
+    def test_roster_callbacks(self):
+        changes = []
+        self.um.register_roster_callback(
+            lambda user, place: changes.append((user, place)))
+        self.um.register_user("c@x.com", "admins")
+        self.um.deregister_user("a@x.com", "room2")
+        self.assertEqual(changes, [("c@x.com", "admins")])
+
+    def test_available_rooms(self):
+        self.wh.room_members = {"room1": set(["b@x.com"]),
+                                "room2": set(["b@x.com"])}
+        self.assertEqual(self.um.available_rooms("a@x.com"), [])
+        self.assertEqual(self.um.available_rooms("b@x.com"), ["room1"])
+
+
+class UnrecognisedRoomTests(unittest.TestCase):
+    def setUp(self):
+        self.wh = FakeWebexHandler()
+        self.um = user_management(self, self.wh)
+        self.kicked = []
+        self.patch(self.um, 'kick', lambda room, user, reason:
+                   self.kicked.append((room, user)))
+
+    def test_leaves_after_message_sent(self):
+        results = []
+        self.um.self_joined_room("other", remove=True).addBoth(results.append)
+        self.assertEqual(results, [False])
+        [(room, sent)] = self.wh.messagehandler.sent
+        self.assertEqual(room, "other")
+        self.assertEqual(self.kicked, [])
+        sent.callback(True)
+        self.assertEqual(self.kicked, [("other", "endroid@x.com")])
+
+    def test_leaves_if_message_not_sent(self):
+        self.um.self_joined_room("other", remove=True)
+        self.wh.messagehandler.sent[0][1].callback(False)
+        self.assertEqual(self.kicked, [("other", "endroid@x.com")])
+
+    def test_stays_unless_removing(self):
+        self.um.self_joined_room("other")
+        self.assertEqual(self.wh.messagehandler.sent, [])
+        self.assertEqual(self.kicked, [])
@@ -0,0 +1,71 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+import logging
+
+from twisted.trial import unittest
+
+from endroid.watchdog import Watchdog, logger
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class WatchdogTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.watchdog = Watchdog(threshold=0.5, clock=self.clock)
+        self.records = Records()
+        logger.addHandler(self.records)
+        self.addCleanup(logger.removeHandler, self.records)
+
+    def run_for(self, name, seconds):
+        with self.watchdog.watching(name):
+            self.clock.now += seconds
+
+    def test_blocking_callback_reported(self):
+        self.run_for("slow.handler", 0.75)
+        self.assertEqual(self.watchdog.blocked, {"slow.handler": 1})
+        self.assertEqual(self.records.messages,
+                         ["slow.handler blocked the reactor for 0.750s"])
+
+    def test_quick_callback_not_reported(self):
+        self.run_for("quick.handler", 0.5)
+        self.assertEqual(self.watchdog.blocked, {})
+        self.assertEqual(self.records.messages, [])
+
+    def test_counts_each_time(self):
+        self.run_for("slow.handler", 1)
+        self.run_for("slow.handler", 0.1)
+        self.run_for("slow.handler", 2)
+        self.assertEqual(self.watchdog.blocked, {"slow.handler": 2})
+
+    def test_reported_if_callback_raises(self):
+        def fails():
+            with self.watchdog.watching("failing.handler"):
+                self.clock.now += 1
+                raise RuntimeError()
+        self.assertRaises(RuntimeError, fails)
+        self.assertEqual(self.watchdog.blocked, {"failing.handler": 1})
+        self.assertEqual(self.watchdog._watching, [])
+
+    def test_disabled(self):
+        self.watchdog.threshold = 0
+        self.run_for("slow.handler", 10)
+        self.assertEqual(self.watchdog.blocked, {})
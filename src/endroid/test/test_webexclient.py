@@ -0,0 +1,177 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from collections import Counter
+
+import treq
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.http_headers import Headers
+
+from endroid.ingest import IngestBuffer
+from endroid.webex_api import WebexAPI, WebexObject, ApiError
+from endroid.webex_client import (WebexClient, CATCH_UP_CONCURRENCY,
+                                  CATCH_UP_PAGE_SIZE)
+
+DISCONNECTED_AT = "2020-01-01T00:00:05.000Z"
+
+
+class FakeResponse(object):
+    def __init__(self, items, next_url=None):
+        self.content = {'items': items}
+        self.headers = Headers()
+        if next_url is not None:
+            self.headers.addRawHeader('Link',
+                                      '<{}>; rel="next"'.format(next_url))
+
+
+class ListTests(unittest.TestCase):
+    def setUp(self):
+        self.api = WebexAPI("token")
+        self.requested = []
+        self.pages = {
+            "messages": FakeResponse([{'id': 6}, {'id': 5}], "page2"),
+            "page2": FakeResponse([{'id': 4}, {'id': 3}], "page3"),
+            "page3": FakeResponse([{'id': 2}]),
+        }
+        self.api._request = self.request
+        self.patch(treq, 'json_content',
+                   lambda response: defer.succeed(response.content))
+
+    def request(self, method, url, **kwargs):
+        self.requested.append(url)
+        return defer.succeed(self.pages[url])
+
+    def list(self, **kwargs):
+        results = []
+        self.api.list("messages", {'roomId': "room"}, **kwargs).addCallback(
+            results.append)
+        return [item.id for item in results[0]]
+
+    def test_follows_pages(self):
+        self.assertEqual(self.list(), [6, 5, 4, 3, 2])
+        self.assertEqual(self.requested, ["messages", "page2", "page3"])
+
+    def test_stops_at_first_old_item(self):
+        self.assertEqual(self.list(stop=lambda item: item.id <= 4), [6, 5])
+        # No more pages are fetched once an old item is found
+        self.assertEqual(self.requested, ["messages", "page2"])
+
+
+def message(message_id, room, created, room_type='group'):
+    return WebexObject(id=message_id, roomId=room, roomType=room_type,
+                       created=created, personEmail="a@x.com")
+
+
+class FakeMessages(object):
+    """
+    Lists canned messages (newest first) as WebexAPI does, or leaves the
+    listing to the test if hold is set.
+    """
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.listed = []
+        self.hold = False
+
+    def list_until(self, stop, **params):
+        self.listed.append(params)
+        if self.hold:
+            return defer.Deferred()
+        if params['roomId'] not in self.rooms:
+            return defer.fail(ApiError(404, "GET", "messages"))
+        items = []
+        for item in self.rooms[params['roomId']]:
+            if stop(item):
+                break
+            items.append(item)
+        return defer.succeed(items)
+
+
+class FakeAPI(object):
+    def __init__(self, messages):
+        self.messages = messages
+
+
+class CatchUpTests(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+        self.messages = FakeMessages({
+            "room1": [message("m3", "room1", "2020-01-01T00:00:07.000Z"),
+                      message("m2", "room1", "2020-01-01T00:00:06.000Z"),
+                      message("m1", "room1", "2020-01-01T00:00:04.000Z")],
+            "direct1": [message("d3", "direct1", "2020-01-01T00:00:09.000Z",
+                                'direct'),
+                        message("d2", "direct1", "2020-01-01T00:00:08.000Z",
+                                'direct'),
+                        message("d1", "direct1", "2020-01-01T00:00:01.000Z",
+                                'direct')],
+        })
+        # Set up just what catching up uses, without connecting
+        client = self.client = WebexClient.__new__(WebexClient)
+        client.rooms = ["room1"]
+        client.last_seen = {}
+        client._ever_connected = False
+        client._disconnected_at = None
+        client.accept_activity = None
+        client.ingest_stats = Counter()
+        client.ingest = IngestBuffer(self.delivered.append)
+        client.connected = lambda: None
+        client.webex_api = FakeAPI(self.messages)
+
+    def delivered_ids(self):
+        return [m.id for m in self.delivered]
+
+    def test_no_catch_up_on_first_connect(self):
+        self.client._disconnected_at = DISCONNECTED_AT
+        self.client._process_connected()
+        self.assertEqual(self.messages.listed, [])
+
+    def test_catch_up_on_reconnect(self):
+        self.client._process_connected()
+        self.client._disconnected_at = DISCONNECTED_AT
+        self.client._process_connected()
+        self.assertEqual(self.delivered_ids(), ["m2", "m3"])
+        self.assertEqual(self.messages.listed,
+                         [{'roomId': "room1", 'mentionedPeople': 'me',
+                           'max': CATCH_UP_PAGE_SIZE}])
+        # The disconnection has been dealt with
+        self.assertIdentical(self.client._disconnected_at, None)
+
+    def test_rooms_seen_caught_up_from_last_message(self):
+        self.client.last_seen["direct1"] = (
+            "d2", "2020-01-01T00:00:08.000Z", 'direct')
+        self.client._disconnected_at = DISCONNECTED_AT
+        self.client.catch_up()
+        self.assertEqual(sorted(self.delivered_ids()), ["d3", "m2", "m3"])
+        listed = dict((params['roomId'], params)
+                      for params in self.messages.listed)
+        # Bots can list all messages in direct rooms
+        self.assertIdentical(listed["direct1"]['mentionedPeople'], None)
+
+    def test_messages_already_seen_dropped(self):
+        self.client.ingest.seen("m2")
+        self.client._disconnected_at = DISCONNECTED_AT
+        self.client.catch_up()
+        self.assertEqual(self.delivered_ids(), ["m3"])
+
+    def test_nothing_to_catch_up(self):
+        # Neither a disconnection time nor a last message to list from
+        self.client.catch_up()
+        self.assertEqual(self.messages.listed, [])
+
+    def test_failed_room_does_not_stop_others(self):
+        self.client.rooms.append("gone")
+        self.client._disconnected_at = DISCONNECTED_AT
+        results = []
+        self.client.catch_up().addBoth(results.append)
+        self.assertEqual(results, [None])
+        self.assertEqual(self.delivered_ids(), ["m2", "m3"])
+
+    def test_rooms_fetched_a_few_at_a_time(self):
+        self.client.rooms = ["room{}".format(i) for i in range(10)]
+        self.client._disconnected_at = DISCONNECTED_AT
+        self.messages.hold = True
+        self.client.catch_up()
+        self.assertEqual(len(self.messages.listed), CATCH_UP_CONCURRENCY)
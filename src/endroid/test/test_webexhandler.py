@@ -0,0 +1,240 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from endroid.database import Database
+from endroid.webex_api import WebexObject
+from endroid.webexhandler import (WebexHandler, RECONCILE_CONCURRENCY,
+                                  MEMBERSHIP_BATCH_WINDOW)
+
+
+class FakeRooms(object):
+    def __init__(self):
+        self.rooms = []
+        self.lists = 0
+        self.gets = []
+        self.locked = False
+
+    def list(self, type):
+        self.lists += 1
+        return defer.succeed([room for room in self.rooms
+                              if room.type == type])
+
+    def get(self, room):
+        self.gets.append(room)
+        return defer.succeed(WebexObject(id=room, title="Room " + room,
+                                         isLocked=self.locked))
+
+
+class FakeMemberships(object):
+    def __init__(self):
+        # dict of room : list of member emails
+        self.members = {}
+        self.lists = []
+        self.deletes = []
+
+    def list(self, roomId):
+        self.lists.append(roomId)
+        return defer.succeed([WebexObject(id=roomId + "/" + email,
+                                          personEmail=email,
+                                          isModerator=False)
+                              for email in self.members.get(roomId, ())])
+
+    def delete(self, membershipId):
+        self.deletes.append(membershipId)
+        return defer.succeed(None)
+
+
+class FakeAPI(object):
+    def __init__(self):
+        self.rooms = FakeRooms()
+        self.memberships = FakeMemberships()
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.webex_api = FakeAPI()
+        self.my_emails = ["endroid@x.com"]
+        self.bootstrapped = defer.succeed(None)
+
+
+class FakeUserManagement(object):
+    def __init__(self):
+        self.started = []
+        # List of (room, Deferred) for each room being reconciled
+        self.reconciling = []
+        self.roster = "roster"
+
+    def start_room(self, room):
+        self.started.append(room)
+
+    def room_roster_key(self, room):
+        return self.roster
+
+    def rooms(self):
+        return []
+
+    def self_joined_room(self, room, remove=False):
+        d = defer.Deferred()
+        self.reconciling.append((room, d))
+        return d
+
+    def unexpected_members(self, room, members):
+        return set(member for member in members
+                   if member.startswith("unexpected"))
+
+    def log_kicks(self, kicked, room, reason=None):
+        self.kicked = kicked
+
+
+def room(id, last_activity="2020-01-01T00:00:00.000Z"):
+    return WebexObject(id=id, type='group', lastActivity=last_activity)
+
+
+class WebexHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patch(Database, 'connection', None)
+        self.patch(Database, 'cursor', None)
+        self.patch(Database, 'file_name', ':memory:')
+        self.client = FakeClient()
+        self.um = FakeUserManagement()
+        self.clock = task.Clock()
+        self.wh = WebexHandler(clock=self.clock)
+        self.wh.set_user_management(self.um)
+        self.wh.setHandlerParent(self.client)
+
+
+class ReconcileTests(WebexHandlerTestCase):
+    def set_rooms(self, *rooms):
+        self.client.webex_api.rooms.rooms = list(rooms)
+
+    def reconcile_all(self, success=True):
+        """Finish reconciling rooms, until none are left in progress."""
+        while self.um.reconciling:
+            _, d = self.um.reconciling.pop(0)
+            d.callback(success)
+
+    def reconciled_rooms(self):
+        self.um.reconciling, rooms = [], self.um.reconciling
+        for _, d in rooms:
+            d.callback(True)
+        return [r for r, _ in rooms]
+
+    def test_plugins_started_in_every_room(self):
+        self.set_rooms(WebexObject(id="direct", type='direct',
+                                   lastActivity=None),
+                       *[room(str(i)) for i in range(10)])
+        self.wh.connected()
+        self.assertEqual(self.um.started, [str(i) for i in range(10)])
+
+    def test_rooms_reconciled_a_few_at_a_time(self):
+        self.set_rooms(*[room(str(i)) for i in range(10)])
+        self.wh.connected()
+        self.assertEqual([r for r, _ in self.um.reconciling],
+                         [str(i) for i in range(RECONCILE_CONCURRENCY)])
+        self.um.reconciling.pop(0)[1].callback(True)
+        self.assertEqual(len(self.um.reconciling), RECONCILE_CONCURRENCY)
+        self.reconcile_all()
+        self.assertEqual(self.wh.reconciliation,
+                         {'total': 10, 'done': 10, 'unchanged': 0,
+                          'failed': 0})
+
+    def test_unchanged_rooms_skipped(self):
+        self.set_rooms(room("1"), room("2"))
+        self.wh.connected()
+        self.reconcile_all()
+        self.wh.connected()
+        self.assertEqual(self.um.reconciling, [])
+        self.assertEqual(self.wh.reconciliation['unchanged'], 2)
+
+    def test_changed_rooms_reconciled_again(self):
+        self.set_rooms(room("1"), room("2"))
+        self.wh.connected()
+        self.reconcile_all()
+        self.set_rooms(room("1"), room("2", "2020-01-02T00:00:00.000Z"))
+        self.wh.connected()
+        self.assertEqual(self.reconciled_rooms(), ["2"])
+
+        # A change of configured users means every room is checked again
+        self.um.roster = "new roster"
+        self.wh.connected()
+        self.assertEqual(self.reconciled_rooms(), ["1", "2"])
+
+    def test_failed_rooms_reconciled_again(self):
+        self.set_rooms(room("1"), room("2"))
+        self.wh.connected()
+        self.um.reconciling.pop(0)[1].callback(False)
+        self.um.reconciling.pop(0)[1].errback(RuntimeError("failed"))
+        self.assertEqual(self.wh.reconciliation['failed'], 2)
+        self.wh.connected()
+        self.assertEqual(self.reconciled_rooms(), ["1", "2"])
+
+    def test_connect_while_reconciling_ignored(self):
+        self.set_rooms(room("1"))
+        self.wh.connected()
+        self.wh.connected()
+        self.assertEqual(self.client.webex_api.rooms.lists, 1)
+        self.reconcile_all()
+        self.wh.connected()
+        self.assertEqual(self.client.webex_api.rooms.lists, 2)
+
+
+class MembershipTests(WebexHandlerTestCase):
+    def setUp(self):
+        super(MembershipTests, self).setUp()
+        self.api = self.client.webex_api
+        self.api.memberships.members = {
+            "room1": ["a@x.com", "unexpected1@x.com", "unexpected2@x.com"],
+            "room2": ["b@x.com"]}
+
+    def test_notifications_batched_per_room(self):
+        self.wh.onMembership("room1", "unexpected1@x.com")
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW / 2)
+        self.wh.onMembership("room1", "unexpected2@x.com")
+        self.wh.onMembership("room2", "b@x.com")
+        self.assertEqual(self.api.memberships.lists, [])
+
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW / 2)
+        self.assertEqual(self.api.memberships.lists, ["room1"])
+        # Each room's batch is processed a window after it started
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW / 2)
+        self.assertEqual(self.api.memberships.lists, ["room1", "room2"])
+        self.assertEqual(self.wh._pending_adds, {})
+
+        # The next notification starts a new batch
+        self.wh.onMembership("room2", "c@x.com")
+        self.assertEqual(self.wh._pending_adds, {"room2": set(["c@x.com"])})
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW)
+        self.assertEqual(self.wh._pending_adds, {})
+
+    def test_members_known_before_batch_processed(self):
+        self.wh.onMembership("room2", "b@x.com")
+        self.assertEqual(self.wh.room_members["room2"], set(["b@x.com"]))
+
+    def test_unexpected_members_kicked_together(self):
+        self.wh.onMembership("room1", "unexpected1@x.com")
+        self.wh.onMembership("room1", "unexpected2@x.com")
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW)
+        self.assertEqual(sorted(self.api.memberships.deletes),
+                         ["room1/unexpected1@x.com",
+                          "room1/unexpected2@x.com"])
+        self.assertEqual(self.um.kicked, {"unexpected1@x.com": True,
+                                          "unexpected2@x.com": True})
+        self.assertEqual(self.wh.room_members["room1"], set(["a@x.com"]))
+
+    def test_not_kicked_from_locked_room(self):
+        self.api.rooms.locked = True
+        self.wh.onMembership("room1", "unexpected1@x.com")
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW)
+        self.assertEqual(self.api.memberships.deletes, [])
+
+    def test_added_to_room(self):
+        self.wh.onMembership("room3", "a@x.com")
+        self.wh.onMembership("room3", "endroid@x.com")
+        self.clock.advance(MEMBERSHIP_BATCH_WINDOW)
+        self.assertEqual([r for r, _ in self.um.reconciling], ["room3"])
+        self.assertEqual(self.api.memberships.lists, [])
@@ -0,0 +1,81 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+import json
+from io import BytesIO
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from endroid.webex_client import INGEST_WEBHOOK, INGEST_WEBSOCKET
+from endroid.plugins.webhook import (WebhookResource, signature,
+                                     SIGNATURE_HEADER)
+
+SECRET = "secret"
+
+
+class FakeClient(object):
+    def __init__(self, ingestion=INGEST_WEBHOOK):
+        self.ingestion = ingestion
+        self.bootstrapped = defer.succeed(None)
+        self.processed = []
+
+    def process_webhook(self, payload):
+        self.processed.append(payload)
+
+
+class WebhookResourceTests(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.resource = WebhookResource(self.client, SECRET)
+
+    def post(self, body, sign_with=SECRET):
+        request = DummyRequest([""])
+        request.method = "POST"
+        request.content = BytesIO(body)
+        if sign_with is not None:
+            request.requestHeaders.addRawHeader(SIGNATURE_HEADER,
+                                                signature(sign_with, body))
+        self.resource.render_POST(request)
+        return request.responseCode
+
+    def test_signed_event_processed(self):
+        payload = {'id': "1", 'resource': "messages", 'event': "created"}
+        self.assertIn(self.post(json.dumps(payload)), (None, 200))
+        self.assertEqual(self.client.processed, [payload])
+
+    def test_bad_signature_rejected(self):
+        self.assertEqual(self.post("{}", sign_with="wrong"), 403)
+        self.assertEqual(self.client.processed, [])
+
+    def test_missing_signature_rejected(self):
+        self.assertEqual(self.post("{}", sign_with=None), 403)
+
+    def test_tampered_body_rejected(self):
+        request = DummyRequest([""])
+        request.content = BytesIO('{"id": "2"}')
+        request.requestHeaders.addRawHeader(SIGNATURE_HEADER,
+                                            signature(SECRET, '{"id": "1"}'))
+        self.resource.render_POST(request)
+        self.assertEqual(request.responseCode, 403)
+
+    def test_bad_json(self):
+        self.assertEqual(self.post("not json"), 400)
+
+    def test_not_bootstrapped(self):
+        self.client.bootstrapped = defer.Deferred()
+        self.assertEqual(self.post("{}"), 503)
+
+    def test_ignored_without_webhook_ingestion(self):
+        self.client.ingestion = INGEST_WEBSOCKET
+        self.assertEqual(self.post("{}"), 404)
+        self.assertEqual(self.client.processed, [])
+
+    def test_signature(self):
+        # The standard HMAC-SHA1 test vector
+        self.assertEqual(
+            signature("key", "The quick brown fox jumps over the lazy dog"),
+            "de7c9b85b8b78aa6bc8a7a36f70a90701c9db4d9")
@@ -5,7 +5,9 @@
 # -----------------------------------------
 
 import logging
+import hashlib
 from endroid.pluginmanager import PluginManager
+from endroid.blocking import on_reactor
 from random import choice
 from collections import namedtuple
 from collections import defaultdict
@@ -36,7 +38,7 @@ class Roster(object):
 
     def set_registration_list(self, names):
         # if we have a list callback then don't do sub-callbacks
-        for name in self.registered:
+        for name in list(self.registered):
             if not name in names:
                 self.deregister_user(name)
         for name in names:
@@ -48,8 +50,9 @@ class Roster(object):
             self.registration_cb(name, self.name)
 
     def deregister_user(self, name):
-        self._members.pop(name, None)
-        self.deregistration_cb(name, self.name)
+        if name in self._members:
+            self._members.discard(name)
+            self.deregistration_cb(name, self.name)
 
     def __repr__(self):
         name = self.name or "contacts"
@@ -83,8 +86,17 @@ class UserManagement(object):
 
         self._pms = {}  # a dict of {room/group names : pluginmanager objects}
 
+        # callbacks taking (user, place) whenever a user is registered with or
+        # deregistered from our contact list ("contacts") or a group
+        self._roster_callbacks = []
+
+        # inverted indexes of {user : set of groups/rooms registered with},
+        # kept up to date by the group and room rosters
+        self._user_groups = defaultdict(set)
+        self._user_rooms = defaultdict(set)
+
         # our contact list and room list
-        self._users = Roster(None)
+        self._users = Roster(None, self._roster_changed, self._roster_changed)
         self._rooms = Roster()
         # dictionaries of Roster objects for our groups and rooms
         self.group_rosters = {}
@@ -121,11 +133,13 @@ class UserManagement(object):
             except KeyError:
                 # User list may have been specified old style:
                 users = self._allowed_users('room', room)
-            self.room_rosters[room] = Roster(room)
+            self.room_rosters[room] = Roster(room, self._room_registered,
+                                             self._room_deregistered)
             self.room_rosters[room].set_registration_list(users)
 
         for group in config.get("setup", "groups", default=['all']):
-            self.group_rosters[group] = Roster(group)
+            self.group_rosters[group] = Roster(group, self._group_registered,
+                                               self._group_deregistered)
             users = self._allowed_users("group", group)
             self.group_rosters[group].set_registration_list(users)
 
@@ -150,6 +164,7 @@ class UserManagement(object):
             return self.room_rosters[name].registered
     get_users = users
 
+    @on_reactor
     def available_users(self, name=None):
         """
         Return an iterable of users present in 'name'.
@@ -162,10 +177,10 @@ class UserManagement(object):
         elif name in self.group_rosters:
             return self.group_rosters[name].registered
         elif name in self.room_rosters:
-            # Find the union of the room's member list and the room roster 
-            # read in from config 
-            members = self.wh.getMemberList(name)
-            return self.room_rosters[name].registered.intersection(set(members))
+            # Find the intersection of the room's last known member list and
+            # the room roster read in from config
+            members = self._room_members(name)
+            return self.room_rosters[name].registered.intersection(members)
     get_available_users = available_users
 
     # given a user or None (us), return list of groups/rooms the user is 
@@ -177,7 +192,7 @@ class UserManagement(object):
         If user is None, return all registered groups.
 
         """
-        return self._get_user_place(user, self.group_rosters, get_available=False)
+        return self._get_user_place(user, self.group_rosters, self._user_groups)
     get_groups = groups
 
     def available_groups(self, user=None):
@@ -187,7 +202,8 @@ class UserManagement(object):
         If user is None, return all groups EnDroid is available in.
 
         """
-        return self._get_user_place(user, self.group_rosters, get_available=True)
+        # users are always present in the groups they are registered with
+        return self._get_user_place(user, self.group_rosters, self._user_groups)
     get_available_groups = available_groups
 
     def rooms(self, user=None):
@@ -197,9 +213,10 @@ class UserManagement(object):
         If user is None, return all registered rooms.
 
         """
-        return self._get_user_place(user, self.room_rosters, get_available=False)
+        return self._get_user_place(user, self.room_rosters, self._user_rooms)
     get_rooms = rooms
 
+    @on_reactor
     def available_rooms(self, user=None):
         """
         Return an iterable of rooms 'user' is present in.
@@ -207,25 +224,66 @@ class UserManagement(object):
         If user is None, return all rooms EnDroid is available in.
 
         """
-        return self._get_user_place(user, self.room_rosters, get_available=True)
+        rooms = self._get_user_place(user, self.room_rosters, self._user_rooms)
+        if user is None:
+            return rooms
+        return [room for room in rooms if user in self._room_members(room)]
     get_available_rooms = available_rooms
 
-    def _get_user_place(self, user, dct, get_available):
+    def _room_members(self, room):
+        """
+        Return the set of the room's last known members. If they aren't known
+        yet (they are fetched for every configured room on connecting), fetch
+        them in the background, returning an empty set unless they are
+        already cached.
+
+        """
+        if room not in self.wh.room_members:
+            d = self.wh.getMemberList(room)
+            d.addErrback(lambda f: logging.error(
+                "Failed to get member list for {}: {}".format(
+                    room, f.getErrorMessage())))
+        return self.wh.room_members.get(room, set())
+
+    def _get_user_place(self, user, dct, index):
         """
-        Return the list of places in dct 'user' is available in
-        (if get_available) or registered with.
+        Return the list of places in dct 'user' is registered with, looked up
+        in index (one of the user : places indexes).
 
         """
         if user is None:
             return dct.keys()
-        elif user in self.users():
-            attr = "available" if get_available else "registered"
-            return [p for p, roster in dct.items() if user in getattr(roster, attr)]
+        elif user in self.users() and user in index:
+            return list(index[user])
         else:
             return []
 
+    # Roster callbacks, maintaining the user : places indexes
+    def _group_registered(self, user, group):
+        self._user_groups[user].add(group)
+        self._roster_changed(user, group)
+
+    def _group_deregistered(self, user, group):
+        self._index_remove(self._user_groups, user, group)
+        self._roster_changed(user, group)
+
+    def _room_registered(self, user, room):
+        self._user_rooms[user].add(room)
+
+    def _room_deregistered(self, user, room):
+        self._index_remove(self._user_rooms, user, room)
+
+    @staticmethod
+    def _index_remove(index, user, place):
+        places = index.get(user)
+        if places is not None:
+            places.discard(place)
+            if not places:
+                del index[user]
+
     ### Functions for managing contact lists ###
 
+    @on_reactor
     def register_user(self, name, place=None):
         """
         Add a user to the 'member' list for our contacts (place=None) or in a
@@ -239,6 +297,7 @@ class UserManagement(object):
         elif place in self.room_rosters:
             self.room_rosters[place].register_user(name)
 
+    @on_reactor
     def deregister_user(self, name, place=None):
         """
         Remove a user from the 'member' list for our contacts (place=None) or
@@ -252,6 +311,20 @@ class UserManagement(object):
         elif place in self.room_rosters:
             self.room_rosters[place].deregister_user(name)
 
+    def register_roster_callback(self, callback):
+        """
+        Register a callback taking (user, place), called whenever user is
+        registered with or deregistered from our contact list (place
+        "contacts") or a group - i.e. whenever get_groups(user) may change.
+
+        """
+        self._roster_callbacks.append(callback)
+
+    def _roster_changed(self, user, place):
+        for callback in self._roster_callbacks:
+            callback(user, place)
+
+    @on_reactor
     def _register_presence_callback(self, user, callback,
                                     available=False, unavailable=False):
         """
@@ -279,6 +352,7 @@ class UserManagement(object):
 
     ### Room functions
 
+    @on_reactor
     def kick(self, room, user, reason=None): 
         """
         Kick the specified user from the room.
@@ -288,8 +362,13 @@ class UserManagement(object):
 
         """
 
-        def success(_):
-            logging.info("Kicked {} from {} ({})".format(user, room, reason))
+        def success(kicked):
+            if kicked:
+                logging.info("Kicked {} from {} ({})".format(user, room,
+                                                             reason))
+            else:
+                logging.error("Not permitted to kick {} from {} ({})".format(
+                              user, room, reason))
         def failure(_):
             logging.error("Failed to kick {} from {} ({})".format(
                           user, room, reason))
@@ -299,47 +378,110 @@ class UserManagement(object):
 
         return self.wh.kick(user, room, reason).addCallbacks(success, failure)
 
+    @on_reactor
+    def kick_many(self, room, users, reason=None):
+        """
+        Kick several users from the room in one go.
+
+        Returns a deferred firing with a dict of user : whether they were
+        kicked.
+
+        """
+        def failure(f):
+            logging.error("Failed to kick {} from {} ({}): {}".format(
+                          ", ".join(sorted(users)), room, reason,
+                          f.getErrorMessage()))
+            return dict((user, False) for user in users)
+
+        return self.wh.kick_many(users, room, reason).addCallbacks(
+            self.log_kicks, failure, callbackArgs=(room, reason))
+
+    def log_kicks(self, kicked, room, reason=None):
+        """
+        Log the results of kicking several users, given a dict of user :
+        whether they were kicked. Returns the dict.
+        """
+        for user, success in sorted(kicked.items()):
+            if success:
+                logging.info("Kicked {} from {} ({})".format(user, room,
+                                                             reason))
+            else:
+                logging.error("Failed to kick {} from {} ({})".format(
+                              user, room, reason))
+        return kicked
+
+    def unexpected_members(self, room, members):
+        """
+        Return the set of members of a room that aren't registered for it
+        (always empty for unregistered rooms).
+        """
+        if room not in self._rooms.registered:
+            return set()
+        return (set(members) - set(self.get_users(room)) -
+                set(self.wh.my_emails))
+
     def self_joined_room(self, room, remove=False):
         """
         Notify of Endroid joining a room.
 
         If the room is known, sanitizes the members in the room. Otherwise,
         removes self from the room.
+
+        Returns a deferred firing with True once the room's members have all
+        been checked and any unexpected ones kicked.
         """
+        # Which members are unexpected depends on who EnDroid is
+        return self.wh.when_bootstrapped(self._self_joined_room, room, remove)
+
+    def _self_joined_room(self, room, remove):
         logging.info("Joined room %s", room)
         
         if room not in self._rooms.registered:
             if remove:
-                self.wh.messagehandler.send_muc(
+                d = self.wh.messagehandler.send_muc(
                     room,
                     "Hello! If you'd like me to stay in this room please get "
                     "an EnDroid admin to add this RoomID ({}) to the "
-                    "config!".format(room), self.wh.my_emails[0])
-                self.wh.kick(self.wh.my_emails[0], room,
-                             "Added to unrecognised room")
-        else:
-            # We are being added to a room - sanitize all members against
-            # config
-            members = self.wh.getMemberList(room)
-            for member in members:
-                if (member not in self.get_users(room) and
-                    member not in self.wh.my_emails and remove):
-                    self.wh.kick(member, room, 
-                                 "Unexpected user present in room when added")
-
-            if room not in self._pms: 
-                self.start_pm(None, "room", room)
-
-    def user_joined_room(self, room, user, remove=False):
-        """
-        Notify of a user joining a room Endroid is in.
-
-        Kicks the user from the room if not in the set of registered members
-        for the room.
-        """
-        if room in self._rooms.registered and \
-           user not in self.get_users(room) and remove:
-            self.wh.kick(user, room, "Unexpected user added to room")
+                    "config!".format(room))
+                # Sends are queued, so only leave once the message has gone
+                d.addBoth(lambda _: self.kick(room, self.wh.my_emails[0],
+                                              "Added to unrecognised room"))
+            return defer.succeed(False)
+
+        # We are being added to a room - sanitize all members against
+        # config
+        def sanitize(members):
+            unexpected = self.unexpected_members(room, members)
+            if not unexpected or not remove:
+                return not unexpected
+            d = self.kick_many(room, unexpected,
+                               "Unexpected user present in room when added")
+            d.addCallback(lambda kicked: all(kicked.values()))
+            return d
+
+        def failed(f):
+            logging.error("Failed to get member list for {}: {}".format(
+                room, f.getErrorMessage()))
+            return False
+
+        d = self.wh.getMemberList(room)
+        d.addCallbacks(sanitize, failed)
+
+        self.start_room(room)
+        return d
+
+    def start_room(self, room):
+        """Start the plugins for a registered room, if not already running."""
+        if room in self._rooms.registered and room not in self._pms:
+            self.start_pm(None, "room", room)
+
+    def room_roster_key(self, room):
+        """
+        Return a string identifying the users registered for a room, which
+        changes if they do.
+        """
+        users = sorted(self.get_users(room) or ())
+        return hashlib.sha1("\n".join(users)).hexdigest()
 
     def joined_group(self, name):
         logging.info("Initialised group {}".format(name))
@@ -363,6 +505,7 @@ class UserManagement(object):
         for group in self.get_groups():
             self.joined_group(group)
 
+    @on_reactor
     def is_room_owner(self, room):
         """Find out if EnDroid is an owner for the specified room. """
 
@@ -372,14 +515,14 @@ class UserManagement(object):
             return any(email in owner_list for email in self.wh.my_emails)
 
         def error_determining_ownership(failure):
-            if failure.value.code == '403':
+            if getattr(failure.value, 'status_code', None) == 403:
                 # This is the forbidden code - so no EnDroid doesn't own the
                 # room
                 return False
             else:
                 # If it's any other error let the caller deal with it
-                logging.error("Error determining ownership of {}. Code "
-                              "{}".format(room, failure.value.code))
+                logging.error("Error determining ownership of {}: "
+                              "{}".format(room, failure.getErrorMessage()))
                 return failure
 
         if room in self.get_rooms():
@@ -399,6 +542,7 @@ class UserManagement(object):
         """
         return self._allowed_users('room', room) 
 
+    @on_reactor
     def get_room_ownerlist(self, room):
         """
         Get the owner list for a room.
@@ -407,11 +551,12 @@ class UserManagement(object):
         # get_rooms returns a list of string versions of room IDs therefore 
         # convert the room ID under query to a string before comparison
         if str(room) in self.get_rooms():
-            return defer.succeed(self.wh.getOwnerList(room)) 
+            return self.wh.getOwnerList(room)
         else:
             # Always return a deferred
             return defer.fail()
 
+    @on_reactor
     def get_room_memberlist(self, room):
         """
         Get the member list for a room.
@@ -424,6 +569,7 @@ class UserManagement(object):
             # Always return a deferred
             return defer.fail()
 
+    @on_reactor
     def invite(self, user, room, reason=None):
         """
         Invite a user to a room.
@@ -431,27 +577,67 @@ class UserManagement(object):
         Will only send invitation if the user is in our contact list, online,
         registered in the room and not currently in it.
 
-        Returns a tuple (success, message)
-
-        """
-
-        if user not in self.users():
-            return (False, "User not registered")
-        elif user not in self.available_users():
-            return (False, "User not available")
-        elif room not in self.get_rooms(user):
-            if room not in self.get_rooms():
-                reason = "Room not registered"
-            else:
-                reason = "User not registered in room"
-            return (False, reason)
-        else:
-            room_roster = self.room_rosters[room]
-            if room_roster[user] in self.wh.getMemberList(room):
-                return (False, "User already in room")
-            else:
-                self.wh.invite(user, room, reason)
-                return (True, "Invitation sent")
+        Returns a deferred which fires with a tuple (success, message)
+
+        """
+        d = self.invite_many(room, [user], reason)
+        d.addCallback(lambda outcomes: outcomes[user])
+        return d
+
+    @on_reactor
+    def invite_many(self, room, users, reason=None):
+        """
+        Invite several users to a room in one go, subject to the same checks
+        as invite.
+
+        Returns a deferred which fires with a dict of user : (success,
+        message).
+
+        """
+        outcomes = {}
+        for user in users:
+            if user not in self.users():
+                outcomes[user] = (False, "User not registered")
+            elif user not in self.available_users():
+                outcomes[user] = (False, "User not available")
+            elif room not in self.get_rooms(user):
+                if room not in self.get_rooms():
+                    outcomes[user] = (False, "Room not registered")
+                else:
+                    outcomes[user] = (False, "User not registered in room")
+        candidates = [user for user in users if user not in outcomes]
+        if not candidates:
+            return defer.succeed(outcomes)
+
+        def check_members(members):
+            for user in candidates:
+                if user in members:
+                    outcomes[user] = (False, "User already in room")
+            wanted = [user for user in candidates if user not in outcomes]
+            if not wanted:
+                return outcomes
+            d = self.wh.invite_many(wanted, room, reason)
+            d.addCallback(invited)
+            return d
+
+        def invited(added):
+            for user, success in added.items():
+                if success:
+                    outcomes[user] = (True, "Invitation sent")
+                else:
+                    # Either not permitted or the add failed (which is logged)
+                    outcomes[user] = (False, "Failed to add user to room")
+            return outcomes
+
+        def failed(failure):
+            for user in candidates:
+                outcomes.setdefault(user, (False, failure.getErrorMessage()))
+            return outcomes
+
+        d = self.wh.getMemberList(room)
+        d.addCallback(check_members)
+        d.addErrback(failed)
+        return d
 
     def for_plugin(self, pluginmanager, plugin):
         return PluginUserManagement(self, pluginmanager, plugin)
@@ -0,0 +1,101 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# -----------------------------------------
+
+"""
+Detection of plugin callbacks that block the reactor.
+"""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+from contextlib import contextmanager
+
+logger = logging.getLogger("webex-watchdog")
+
+# Seconds a callback may run on the reactor before it is reported
+DEFAULT_THRESHOLD = 0.5
+
+
+class Watchdog(object):
+    """
+    Times callbacks run on the reactor thread. Any taking longer than
+    threshold seconds is logged when it finishes, and a background thread
+    logs the reactor thread's stack while it is still running, to show where
+    it is stuck.
+
+    Attributes:
+        threshold - Seconds a callback may run for, or 0 to not watch.
+        blocked   - Dict of callback name : number of times it went over.
+    """
+    def __init__(self, threshold=DEFAULT_THRESHOLD, clock=time.time):
+        self.threshold = threshold
+        # returns the current time in seconds (called from both threads)
+        self._clock = clock
+        self.blocked = {}
+        self._watching = []     # (name, start time) of the callbacks running
+        self._thread = None
+        self._thread_id = None  # the reactor thread's id
+        self._stopping = threading.Event()
+
+    @contextmanager
+    def watching(self, name):
+        """Time the block as a call to the callback name."""
+        if not self.threshold:
+            yield
+            return
+        started = self._clock()
+        entry = (name, started)
+        self._watching.append(entry)
+        try:
+            yield
+        finally:
+            self._watching.remove(entry)
+            elapsed = self._clock() - started
+            if elapsed > self.threshold:
+                self.blocked[name] = self.blocked.get(name, 0) + 1
+                logger.warning("%s blocked the reactor for %.3fs", name,
+                               elapsed)
+
+    def start(self):
+        """
+        Start sampling the stack of the calling (reactor) thread when a
+        callback runs over the threshold.
+        """
+        if not self.threshold or self._thread is not None:
+            return
+        self._thread_id = threading.current_thread().ident
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._sample,
+                                        name="endroid-watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        sampled = None
+        while not self._stopping.wait(self.threshold / 2):
+            try:
+                # The outermost callback is the one holding up the reactor
+                name, started = self._watching[0]
+                current = self._watching[-1][0]
+            except IndexError:
+                continue
+            if (name, started) == sampled or \
+                    self._clock() - started <= self.threshold:
+                continue
+            sampled = (name, started)
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            logger.warning("%s has been blocking the reactor for over %.3fs, "
+                           "in:\n%s", current, self.threshold,
+                           "".join(traceback.format_stack(frame)))
@@ -0,0 +1,323 @@
+# -----------------------------------------
+# Endroid - Webex Bot
+# Copyright 2012, Ensoft Ltd.
+# Created by Jonathan Millican
+# -----------------------------------------
+
+"""
+Asynchronous Webex Teams REST client.
+
+Every call returns a Deferred rather than blocking the reactor thread. All
+requests share a single persistent HTTP connection pool, so concurrent calls
+reuse established TLS connections to the Webex servers, and a quota limiter
+that keeps each family of calls (messages, rooms etc.) within its rate.
+"""
+
+import json
+import base64
+import logging
+
+import treq
+from twisted.internet import reactor
+from twisted.web.client import HTTPConnectionPool
+
+from endroid.quota import QuotaLimiter, DEFAULT_QUOTAS
+
+API_BASE_URL = "https://webexapis.com/v1/"
+
+# Maximum number of idle connections kept open to the Webex servers
+DEFAULT_MAX_CONNECTIONS = 10
+
+logger = logging.getLogger("webex-api")
+
+
+class ApiError(Exception):
+    """
+    A Webex REST call returned an error status.
+
+    Attributes:
+        status_code - The HTTP status code of the response.
+        method      - The HTTP method of the failed request.
+        url         - The URL of the failed request.
+        body        - The (possibly empty) response body.
+    """
+    def __init__(self, status_code, method, url, body=""):
+        super(ApiError, self).__init__(
+            "{} {} failed with status {}: {}".format(method, url,
+                                                     status_code, body))
+        self.status_code = status_code
+        self.method = method
+        self.url = url
+        self.body = body
+
+
+class RateLimitError(ApiError):
+    """
+    A Webex REST call was rejected with a 429 (Too Many Requests).
+
+    retry_after is the number of seconds the server asked us to wait before
+    trying again.
+    """
+    def __init__(self, status_code, method, url, body="", retry_after=None):
+        super(RateLimitError, self).__init__(status_code, method, url, body)
+        self.retry_after = retry_after
+
+
+class WebexObject(dict):
+    """
+    A JSON object returned by the API. Fields can be accessed as attributes
+    (e.g. message.personEmail), with missing fields reading as None.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get(name)
+
+
+class _Endpoint(object):
+    """Base class for a family of API calls (messages, rooms etc.)."""
+    path = None
+
+    def __init__(self, api):
+        self._api = api
+
+    def _url(self, *parts):
+        return "/".join((self.path,) + parts)
+
+    def get(self, obj_id):
+        return self._api.request("GET", self._url(obj_id))
+
+    def list(self, **params):
+        return self._api.list(self.path, params)
+
+    def list_until(self, stop, **params):
+        return self._api.list(self.path, params, stop=stop)
+
+
+class Messages(_Endpoint):
+    path = "messages"
+
+    def create(self, **fields):
+        return self._api.request("POST", self.path, json=fields)
+
+    def update(self, messageId, **fields):
+        """Edit a message. fields must include its roomId."""
+        return self._api.request("PUT", self._url(messageId), json=fields)
+
+    def delete(self, messageId):
+        return self._api.request("DELETE", self._url(messageId))
+
+
+class Memberships(_Endpoint):
+    path = "memberships"
+
+    def create(self, **fields):
+        return self._api.request("POST", self.path, json=fields)
+
+    def delete(self, membershipId):
+        return self._api.request("DELETE", self._url(membershipId))
+
+
+class Rooms(_Endpoint):
+    path = "rooms"
+
+
+class Webhooks(_Endpoint):
+    path = "webhooks"
+
+    def create(self, **fields):
+        return self._api.request("POST", self.path, json=fields)
+
+    def delete(self, webhookId):
+        return self._api.request("DELETE", self._url(webhookId))
+
+
+class People(_Endpoint):
+    path = "people"
+
+    def me(self):
+        return self.get("me")
+
+
+class WebexAPI(object):
+    """
+    Deferred-returning client for the Webex REST API.
+
+    Attributes:
+        messages, memberships, rooms, people, webhooks - The API call
+            families.
+        pool - The persistent HTTP connection pool shared by all calls.
+        limiter - QuotaLimiter through which every call is made.
+    """
+    def __init__(self, access_token, base_url=API_BASE_URL,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 quotas=DEFAULT_QUOTAS):
+        self.access_token = access_token
+        self.base_url = base_url
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_connections
+        self.limiter = QuotaLimiter(quotas)
+
+        self.messages = Messages(self)
+        self.memberships = Memberships(self)
+        self.rooms = Rooms(self)
+        self.people = People(self)
+        self.webhooks = Webhooks(self)
+
+    def _headers(self):
+        return {'Authorization': ['Bearer ' + self.access_token],
+                'Content-Type': ['application/json']}
+
+    def _full_url(self, url):
+        if url.startswith("http"):
+            return url
+        return self.base_url + url
+
+    def _family(self, url):
+        """
+        Return the family of API calls (e.g. 'messages') a URL belongs to, or
+        None if it isn't an API URL.
+        """
+        if not url.startswith(self.base_url):
+            return None
+        return url[len(self.base_url):].split('/', 1)[0].split('?', 1)[0]
+
+    def _request(self, method, url, params=None, json=None, unbuffered=False):
+        """
+        Make a request, returning a Deferred that fires with the raw treq
+        response, or errbacks with an ApiError if the status is not 2xx.
+        Unless unbuffered is set, the response body is kept in memory as it
+        arrives.
+        """
+        url = self._full_url(url)
+        data = None if json is None else _dumps(json)
+        logger.debug("%s %s %s", method, url, params or "")
+
+        def check_status(response):
+            if 200 <= response.code < 300:
+                return response
+            d = treq.text_content(response)
+            d.addCallback(raise_error, response)
+            return d
+
+        def raise_error(body, response):
+            if response.code == 429:
+                retry_after = response.headers.getRawHeaders('Retry-After',
+                                                             [None])[0]
+                raise RateLimitError(response.code, method, url, body,
+                                     retry_after=_to_seconds(retry_after))
+            raise ApiError(response.code, method, url, body)
+
+        d = self.limiter.run(self._family(url), treq.request, method, url,
+                             headers=self._headers(), params=params,
+                             data=data, pool=self.pool, unbuffered=unbuffered)
+        d.addCallback(check_status)
+        return d
+
+    def open(self, url, method="GET"):
+        """
+        Make a request for a file (such as a message attachment), returning a
+        Deferred that fires with the response before any of its body has
+        been read, so the body can be streamed with deliverBody.
+        """
+        return self._request(method, url, unbuffered=True)
+
+    def request(self, method, url, params=None, json=None):
+        """
+        Make a request, returning a Deferred that fires with the decoded
+        WebexObject (or None if the response has no content).
+        """
+        def decode(response):
+            if response.code == 204:
+                return None
+            return treq.json_content(response).addCallback(_to_object)
+
+        d = self._request(method, url, params=params, json=json)
+        d.addCallback(decode)
+        return d
+
+    def list(self, url, params=None, stop=None):
+        """
+        Make a GET request for a list of items, following the Link headers
+        to fetch every page. The Deferred fires with a list of WebexObjects.
+
+        stop is an optional predicate: once an item matches it, that item and
+        any after it are discarded and no further pages are fetched.
+        """
+        items = []
+
+        def got_page(response):
+            d = treq.json_content(response)
+            d.addCallback(got_items, response)
+            return d
+
+        def got_items(content, response):
+            for item in content.get('items', []):
+                item = _to_object(item)
+                if stop is not None and stop(item):
+                    return items
+                items.append(item)
+            next_url = _next_link(response)
+            if next_url is None:
+                return items
+            d = self._request("GET", next_url)
+            d.addCallback(got_page)
+            return d
+
+        d = self._request("GET", url, params=_params(params))
+        d.addCallback(got_page)
+        return d
+
+
+def uuid_from_id(obj_id):
+    """
+    Convert a REST API ID (a base64 encoding of e.g.
+    "ciscospark://us/ROOM/<uuid>") to the bare UUID used in websocket
+    activities. IDs that are already bare UUIDs are returned unchanged.
+    """
+    try:
+        decoded = base64.urlsafe_b64decode(str(obj_id) +
+                                           '=' * (-len(obj_id) % 4))
+    except (TypeError, ValueError):
+        return obj_id
+    if decoded.startswith("ciscospark://"):
+        return decoded.rsplit('/', 1)[-1]
+    return obj_id
+
+
+def _params(params):
+    """Drop unset parameters so they aren't sent as empty strings."""
+    if params is None:
+        return None
+    return dict((k, v) for k, v in params.items() if v is not None)
+
+
+def _dumps(obj):
+    return json.dumps(_params(obj))
+
+
+def _to_object(value):
+    if isinstance(value, dict):
+        return WebexObject((k, _to_object(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [_to_object(v) for v in value]
+    return value
+
+
+def _to_seconds(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _next_link(response):
+    """Return the URL of the next page from the Link header, if any."""
+    for header in response.headers.getRawHeaders('Link', []):
+        for link in header.split(','):
+            parts = link.split(';')
+            if any(p.strip() == 'rel="next"' for p in parts[1:]):
+                return parts[0].strip().strip('<>')
+    return None
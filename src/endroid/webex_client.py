@@ -4,18 +4,25 @@
 import logging
 import sys
 import json
-import requests
 import uuid
+import hashlib
 import functools
-import webexteamssdk
 import pprint
+import datetime
+from collections import Counter
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.internet.protocol import ReconnectingClientFactory
-from webexteamssdk import WebexTeamsAPI
 from autobahn.twisted.websocket import WebSocketClientProtocol, \
     WebSocketClientFactory, connectWS
-from twisted.internet import reactor
+
+from endroid.webex_api import WebexAPI, ApiError, uuid_from_id
+from endroid.ingest import (IngestBuffer, IngestQueue, DEFAULT_MAX_DEPTH,
+                            DEFAULT_SHED_ORDER, CATEGORY_SELF,
+                            CATEGORY_MESSAGE, CATEGORY_MEMBERSHIP)
+from endroid.database import Database
+from endroid.outbound import SendQueue, DEFAULT_MAX_IN_FLIGHT
+from endroid.quota import DEFAULT_QUOTAS
 
 # Sports modules that are used by this module. Used when reloading plugin.
 USED_MODULES = []
@@ -32,6 +39,37 @@ DEVICE_DATA = {
     "systemVersion":"0.1"
 }
 
+# Ways of receiving activities: a websocket from a registered device, or
+# webhooks delivered to endroid.plugins.webhook
+INGEST_WEBSOCKET = "websocket"
+INGEST_WEBHOOK = "webhook"
+INGESTION_MODES = (INGEST_WEBSOCKET, INGEST_WEBHOOK)
+
+# Webhook (resource, event) pairs and the activity verbs they correspond to
+WEBHOOK_VERBS = {
+    ('messages', 'created'): 'post',
+    ('memberships', 'created'): 'add',
+    ('memberships', 'deleted'): 'leave',
+    ('memberships', 'updated'): 'update',
+}
+
+# Activity verbs that change a room's membership or details, passed to the
+# on_room_change callback
+ROOM_CHANGE_VERBS = frozenset(('add', 'leave', 'assignModerator',
+                               'unassignModerator', 'lock', 'unlock',
+                               'update'))
+
+# Seconds to wait before retrying a failed startup
+BOOTSTRAP_RETRY_DELAY = 10
+
+# Database used to remember the registered device across restarts
+DB_NAME = "WebexClient"
+DB_TABLE = "Devices"
+
+# Number of rooms whose missed messages are fetched at once after a reconnect
+CATCH_UP_CONCURRENCY = 4
+CATCH_UP_PAGE_SIZE = 50
+
 logger = logging.getLogger("webex-client")
 
 def catch_api_errors(func):
@@ -39,7 +77,7 @@ def catch_api_errors(func):
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except webexteamssdk.exceptions.ApiError as e:
+        except ApiError as e:
             logger.exception(e)
     return wrapper
 
@@ -102,7 +140,7 @@ class WebexProto(WebSocketClientProtocol):
     def onMessage(self, payload, isBinary):
         """
         Called on receipt of a message from the server. Calls the specified 
-        callback.
+        callback, after recording the message if the factory has a recorder.
         """
         if isBinary:
             logger.debug("Binary message received: %u bytes",
@@ -110,7 +148,10 @@ class WebexProto(WebSocketClientProtocol):
         else:
             logger.debug("Text message received: %s",
                          payload.decode('utf8'))
-        self.on_message(json.loads(payload))
+        data = json.loads(payload)
+        if self.factory.recorder is not None:
+            self.factory.recorder.record_activity(data)
+        self.on_message(data)
 
     def onClose(self, wasClean, code, reason):
         """
@@ -128,9 +169,11 @@ class WebexProtoFactory(WebSocketClientFactory, ReconnectingClientFactory):
           buildProtocol - Produce an instance of the webex client protocol.
         Inherited from reconnecting factory:
           clientConnectionFailed - Log and retry the connection.
-          clientConnectionLost   - Log and retry the connection.
+          clientConnectionLost   - Log, notify the client and retry the
+                                   connection.
     """
     maxDelay = 10
+    recorder = None
 
     def buildProtocol(self, addr):
         """
@@ -154,6 +197,7 @@ class WebexProtoFactory(WebSocketClientFactory, ReconnectingClientFactory):
         Called when an established connection is lost. Retries the connection.
         """
         logger.info("Client connection lost (%s), retrying...", reason)
+        self.disconnected_handler()
         self.retry(connector)
 
 
@@ -166,90 +210,386 @@ class WebexClient(object):
         on_message    - The callback to call on receipt of a message. 
         on_membership - The callback to call on notification of a membership 
                         creation.
-        webex_api     - The instance of the webexteamssdk API.
+        accept_activity - Optional callback deciding from the sender and room
+                        of a posted message whether it is worth fetching.
+        on_room_change - Optional callback called straight away (rather than
+                        queued) with the room, verb and affected user's
+                        email of each activity that changes a configured
+                        room's membership or details.
+        ingest_stats  - Counts of messages fetched and skipped.
+        ingest        - Buffer that drops duplicate activities and delivers
+                        each room's messages in order.
+        queue         - Bounded queue between ingestion and the on_message
+                        and on_membership callbacks, shedding work when full.
+        rooms         - The configured rooms, checked for missed messages
+                        after a reconnect.
+        room_index    - Dict of the UUIDs that identify rooms in activities
+                        to the configured room IDs. Activities for other
+                        rooms (apart from direct rooms) are discarded.
+        last_seen     - Dict of room ID to (id, created, roomType) of the last
+                        message delivered in that room.
+        webex_api     - The asynchronous webex API, used for all REST calls
+                        once the reactor is running. Each family of calls
+                        is limited to the rate given in api_quotas.
         device_info   - Webex device information.
         my_emails     - Set of the client's registered webex emails.   
         my_person_id  - The client's webex person ID.      
+        bootstrapped  - Deferred fired once the identity and device have
+                        been looked up and the websocket is connecting.
+        outbound      - Queue through which messages are sent, in order for
+                        each destination.
+        recorder      - Optional endroid.replay.Recorder to which received
+                        activities and fetched messages are written.
+        ingestion     - How activities are received: INGEST_WEBSOCKET or
+                        INGEST_WEBHOOK. In webhook mode no device is
+                        registered and activities are passed in through
+                        process_webhook.
     """
     def __init__(self, access_token, on_message=None, on_membership=None,
-                 ping_interval=10, ping_timeout=20):
+                 ping_interval=10, ping_timeout=20, rooms=(),
+                 ingestion=INGEST_WEBSOCKET, queue_depth=DEFAULT_MAX_DEPTH,
+                 shed_order=DEFAULT_SHED_ORDER, recorder=None,
+                 send_concurrency=DEFAULT_MAX_IN_FLIGHT,
+                 api_quotas=DEFAULT_QUOTAS):
+        if ingestion not in INGESTION_MODES:
+            raise ValueError("Unknown ingestion mode {}".format(ingestion))
         self.access_token = access_token
+        self.ingestion = ingestion
+        self.recorder = recorder
         self.connected = None
         self.on_message = None
         self.on_membership = None
-        self.webex_api = WebexTeamsAPI(access_token=access_token)
+        self.accept_activity = None
+        self.on_room_change = None
+        self.ingest_stats = Counter()
+        self.ingest = IngestBuffer(self._got_message)
+        self.queue = IngestQueue(queue_depth, shed_order)
+        self.rooms = list(rooms)
+        self.room_index = dict((uuid_from_id(room), room)
+                               for room in self.rooms)
+        self.last_seen = {}
+        self._ever_connected = False
+        self._disconnected_at = None
+        self.webex_api = WebexAPI(access_token, quotas=api_quotas)
+        self.outbound = SendQueue(self.webex_api, send_concurrency)
         self.device_info = None
-        self._get_device_info()
-        self.my_emails = self.webex_api.people.me().emails
-        self.my_person_id = self.webex_api.people.me().id
-
-        if self.device_info is not None:
-            factory = WebexProtoFactory(self.device_info['webSocketUrl'])
-            factory.access_token = access_token
-            factory.message_handler = self._process_message
-            factory.connected_handler = self._process_connected
-            factory.setProtocolOptions(autoPingInterval=ping_interval,
-                                       autoPingTimeout=ping_timeout)
-            connectWS(factory)
-            
+        self.my_emails = []
+        self.my_person_id = None
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+
+        self.db = Database(DB_NAME)
+        if not self.db.table_exists(DB_TABLE):
+            self.db.create_table(DB_TABLE, ('token_hash', 'url'))
+        # Identify our device by the token, without storing the token itself
+        self._token_hash = hashlib.sha256(access_token).hexdigest()
+
+        self.bootstrapped = defer.Deferred()
+        reactor.callWhenRunning(self._bootstrap)
+
+    def _bootstrap(self):
+        """
+        Look up our identity and device concurrently, then connect the
+        websocket.
+        """
+        def got_info(results):
+            me = results[0]
+            self.my_emails = me.emails
+            self.my_person_id = me.id
+            if self.recorder is not None:
+                self.recorder.record_identity(me)
+            if self.ingestion == INGEST_WEBSOCKET:
+                self.device_info = results[1]
+                self._connect()
+            else:
+                logger.info("Receiving activities by webhook")
+                self._process_connected()
+            self.bootstrapped.callback(None)
+
+        def failed(failure):
+            logger.error("Failed to start webex client (%s), retrying in "
+                         "%u seconds", failure.getErrorMessage(),
+                         BOOTSTRAP_RETRY_DELAY)
+            reactor.callLater(BOOTSTRAP_RETRY_DELAY, self._bootstrap)
+
+        lookups = [self.webex_api.people.me()]
+        if self.ingestion == INGEST_WEBSOCKET:
+            lookups.append(self._get_device_info())
+        d = defer.gatherResults(lookups, consumeErrors=True)
+        d.addCallbacks(got_info, failed)
+
+    def _connect(self):
+        factory = WebexProtoFactory(self.device_info['webSocketUrl'])
+        factory.access_token = self.access_token
+        factory.recorder = self.recorder
+        factory.message_handler = self._process_message
+        factory.connected_handler = self._process_connected
+        factory.disconnected_handler = self._process_disconnected
+        factory.setProtocolOptions(autoPingInterval=self.ping_interval,
+                                   autoPingTimeout=self.ping_timeout)
+        connectWS(factory)
+
     def _get_device_info(self):
-        # Always create a new device 
-        logger.info('Creating new device info')
-        session = self.webex_api._session.post(DEVICES_URL, 
-                                               json=DEVICE_DATA)
-        if session is None:
-            logger.error('Could not create device with webex')
-        else:
+        """
+        Reuse the device registered on a previous run if webex still knows
+        about it, otherwise register a new one. Returns a Deferred firing with
+        the device information.
+        """
+        rows = self.db.fetch(DB_TABLE, ['url'],
+                             {'token_hash': self._token_hash})
+        if not rows:
+            return self._create_device()
+
+        def stale(failure):
+            failure.trap(ApiError)
+            logger.info('Stored device is no longer valid (%s)',
+                        failure.getErrorMessage())
+            return self._create_device()
+
+        logger.info('Revalidating stored device')
+        d = self.webex_api.request("GET", rows[0]['url'])
+        d.addCallback(self._device_valid)
+        d.addErrback(stale)
+        return d
+
+    def _device_valid(self, device_info):
+        logger.info('Reusing device registered with webex')
+        return device_info
+
+    def _create_device(self):
+        def created(device_info):
             logger.info('Successfully registered new device with webex')
-            self.device_info = session
+            self.db.delete(DB_TABLE, {'token_hash': self._token_hash})
+            self.db.insert(DB_TABLE, {'token_hash': self._token_hash,
+                                      'url': device_info['url']})
+            return device_info
 
-    def set_callbacks(self, connected, on_message, on_membership):
+        logger.info('Creating new device info')
+        d = self.webex_api.request("POST", DEVICES_URL, json=DEVICE_DATA)
+        d.addCallback(created)
+        return d
+
+    def set_callbacks(self, connected, on_message, on_membership,
+                      accept_activity=None, on_room_change=None):
         self.connected = connected
         self.on_message = on_message
         self.on_membership = on_membership
+        self.accept_activity = accept_activity
+        self.on_room_change = on_room_change
         
-    @catch_api_errors
     def _process_message(self, data):
         if data['data']['eventType'] == 'conversation.activity':
             logger.debug('Event Type is conversation.activity') 
             activity = data['data']['activity']
 
+            target = activity.get('target', {})
+            direct = 'ONE_ON_ONE' in target.get('tags', [])
+            room = self.room_index.get(target.get('globalId'))
+            if room is None and not direct:
+                self._unknown_room_activity(activity)
+                return
+
+            # Activities are replayed after a reconnect
+            if self.ingest.seen(activity['id']):
+                return
+
+            if (activity['verb'] in ROOM_CHANGE_VERBS and not direct and
+                    self.on_room_change is not None):
+                self.on_room_change(room, activity['verb'],
+                                    activity.get('object', {}).get(
+                                                            'emailAddress'))
+
             if activity['verb'] == 'post': 
                 # Handle a message
                 logger.debug('activity verb is post, message id is %s',
                               activity['id'])
-                # See whether Endroid is still in the room before attempting to
-                # retrieve the message
-                try:
-                    message = self.webex_api.messages.get(activity['id'])
-
-                    logger.info('Message from %s: %s',
-                                message.personEmail, message.text)
-                    self.on_message(message)
-                except webexteamssdk.exceptions.ApiError as e:
-                    if e.status_code == 404:
-                        logger.error("Ignoring message as got 404 error - "
-                                     "perhaps no longer in room")
-                    else:
-                        logger.exception("Got exception processing message %s",
-                                         activity['id'])
-                except Exception:
-                    logger.exception("Got exception processing message %s",
-                                     activity['id'])
+                actor = activity.get('actor', {})
+                if not self._should_fetch(actor.get('emailAddress'),
+                                          room, direct):
+                    logger.debug('Not fetching message %s', activity['id'])
+                    self.ingest_stats['skipped'] += 1
+                    return
+
+                self.ingest_stats['fetched'] += 1
+                # The fetch fails if Endroid is no longer in the room
+                d = self.webex_api.messages.get(activity['id'])
+                if self.recorder is not None:
+                    d.addCallback(self.recorder.record_message)
+                d.addErrback(self._message_failed, activity['id'])
+                self.ingest.add(activity['target']['globalId'],
+                                activity['id'], d)
 
             elif activity['verb'] == 'add':
                 # Handle a membership - defer getting the event for a second as
                 # it may not be immediately findable.
                 logger.debug('activity verb is add, event id is %s',
                               activity['id'])
-                try:
-                    self.on_membership(activity['target']['globalId'],
-                                       activity['object']['emailAddress'])
-                except Exception:
-                    logger.exception("Got exception processing membership "
-                                     "%s", activity['id'])
+                self.queue.put(CATEGORY_MEMBERSHIP, self.on_membership,
+                               room or target['globalId'],
+                               activity['object']['emailAddress'])
+
+    def _unknown_room_activity(self, activity):
+        """
+        Handle an activity in a room that isn't configured, without any REST
+        calls. The only one of interest is EnDroid being added to the room,
+        which is passed on so that EnDroid can leave again.
+        """
+        email = activity.get('object', {}).get('emailAddress')
+        if activity['verb'] == 'add' and email in self.my_emails:
+            if not self.ingest.seen(activity['id']):
+                self.queue.put(CATEGORY_MEMBERSHIP, self.on_membership,
+                               activity['target']['globalId'], email)
+        else:
+            logger.debug("Discarding activity %s for unknown room",
+                         activity['id'])
+            self.ingest_stats['unknown_room'] += 1
+
+    def process_webhook(self, payload):
+        """
+        Feed a (verified) webhook event through the same pipeline as
+        websocket activities.
+        """
+        activity = _activity_from_webhook(payload)
+        if activity is None:
+            logger.debug("Ignoring webhook event %s/%s",
+                         payload.get('resource'), payload.get('event'))
+            return
+        data = {'data': {'eventType': 'conversation.activity',
+                         'activity': activity}}
+        if self.recorder is not None:
+            self.recorder.record_activity(data)
+        self._process_message(data)
+
+    def _should_fetch(self, sender, room, direct):
+        """
+        Use the sender and room already present in a posted activity to
+        decide whether the message needs to be fetched.
+        """
+        if self.accept_activity is None:
+            return True
+        return self.accept_activity(sender, room, direct)
+
+    def _got_message(self, message):
+        logger.info('Message from %s: %s', message.personEmail, message.text)
+        if message.created is not None:
+            self.last_seen[message.roomId] = (message.id, message.created,
+                                              message.roomType)
+        if message.personEmail in self.my_emails:
+            category = CATEGORY_SELF
+        else:
+            category = CATEGORY_MESSAGE
+        self.queue.put(category, self.on_message, message)
+
+    def _message_failed(self, failure, message_id):
+        if failure.check(ApiError) and failure.value.status_code == 404:
+            logger.error("Ignoring message as got 404 error - "
+                         "perhaps no longer in room")
+        else:
+            logger.error("Got exception processing message %s: %s",
+                         message_id, failure.getTraceback())
 
     @catch_api_errors
     def _process_connected(self):
         logger.info("In _process_connected")
+        if self._ever_connected:
+            self.catch_up()
+        self._ever_connected = True
         self.connected()
+
+    def _process_disconnected(self):
+        if self._disconnected_at is None:
+            self._disconnected_at = _timestamp(datetime.datetime.utcnow())
+
+    def catch_up(self):
+        """
+        Fetch the messages posted while the websocket was disconnected, in
+        all configured rooms and any room a message has been seen in, and
+        feed them through the normal ingestion path. A few rooms are fetched
+        at a time. Returns a Deferred firing when all rooms are done.
+        """
+        disconnected_at, self._disconnected_at = self._disconnected_at, None
+        rooms = dict((room, (None, disconnected_at, 'group'))
+                     for room in self.rooms)
+        rooms.update(self.last_seen)
+        logger.info("Catching up on missed messages in %u rooms", len(rooms))
+
+        sem = defer.DeferredSemaphore(CATCH_UP_CONCURRENCY)
+        d = defer.gatherResults([sem.run(self._catch_up_room, room, *info)
+                                 for room, info in rooms.items()])
+        d.addCallback(lambda counts: logger.info(
+            "Caught up on %u missed messages", sum(counts)))
+        return d
+
+    def _catch_up_room(self, room, last_id, since, room_type):
+        def is_old(message):
+            return (message.id == last_id or
+                    (since is not None and message.created <= since))
+
+        def got_messages(messages):
+            count = 0
+            # Messages are listed newest first
+            for message in reversed(messages):
+                if self._ingest_listed(message):
+                    count += 1
+            return count
+
+        def failed(failure):
+            logger.error("Failed to catch up on room %s: %s", room,
+                         failure.getErrorMessage())
+            return 0
+
+        if last_id is None and since is None:
+            return defer.succeed(0)
+
+        # Bots can only list group room messages that mention them
+        mentioned = 'me' if room_type == 'group' else None
+        d = self.webex_api.messages.list_until(is_old, roomId=room,
+                                               mentionedPeople=mentioned,
+                                               max=CATCH_UP_PAGE_SIZE)
+        d.addCallbacks(got_messages, failed)
+        return d
+
+    def _ingest_listed(self, message):
+        """
+        Feed a message retrieved by listing (rather than from a websocket
+        activity) through ingestion. Returns True if it was new.
+        """
+        activity_id = uuid_from_id(message.id)
+        if self.ingest.seen(activity_id):
+            return False
+        if (self.accept_activity is not None and
+            not self.accept_activity(message.personEmail, message.roomId,
+                                     message.roomType == 'direct')):
+            self.ingest_stats['skipped'] += 1
+            return False
+        self.ingest.add(uuid_from_id(message.roomId), activity_id,
+                        defer.succeed(message))
+        return True
+
+
+def _activity_from_webhook(payload):
+    """
+    Build the parts of a websocket activity that _process_message uses from
+    a webhook event, or return None if the event is not one we handle.
+    """
+    verb = WEBHOOK_VERBS.get((payload.get('resource'), payload.get('event')))
+    data = payload.get('data') or {}
+    if verb is None or 'id' not in data or 'roomId' not in data:
+        return None
+
+    target = {'globalId': uuid_from_id(data['roomId']),
+              'tags': ['ONE_ON_ONE'] if data.get('roomType') == 'direct'
+                      else []}
+    activity = {'id': uuid_from_id(data['id']), 'verb': verb,
+                'target': target}
+    if verb == 'post':
+        activity['actor'] = {'emailAddress': data.get('personEmail')}
+    else:
+        activity['object'] = {'emailAddress': data.get('personEmail')}
+    return activity
+
+
+def _timestamp(dt):
+    """Format a datetime the way the Webex API formats 'created' times."""
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + \
+        "{:03d}Z".format(dt.microsecond // 1000)
@@ -4,28 +4,94 @@
 # Created by Jonathan Millican
 # -----------------------------------------
 
-import re, logging
-import webexteamssdk
-
-import twisted.internet.reactor as reactor
+import re, logging, functools
 
+from twisted.internet import defer, reactor
 
 from endroid.messagehandler import Message
 from endroid.cron import Cron
+from endroid.database import Database
+
+from endroid.outbound import (chunk_text, MessageUpdater,
+                               DEFAULT_UPDATE_INTERVAL)
+from endroid.roomcache import RoomCache, DEFAULT_TTL
+from endroid.attachments import (Attachment, AttachmentFetcher,
+                                  DEFAULT_MAX_SIZE, DEFAULT_MAX_DOWNLOADS)
+
+# Seconds over which membership notifications for a room are batched up
+MEMBERSHIP_BATCH_WINDOW = 1.0
+
+# Number of membership creates or deletes made at once for a bulk invite or
+# kick
+MEMBERSHIP_CONCURRENCY = 4
+
+# Number of rooms whose members are checked at once after connecting
+RECONCILE_CONCURRENCY = 4
+# Reconciliation progress is logged each time this many more rooms are done
+RECONCILE_PROGRESS_EVERY = 50
 
-MAX_MESSAGE_LEN = 7439
+# Database remembering the state of each room when it was last reconciled
+DB_NAME = "WebexHandler"
+DB_TABLE = "Reconciled"
+
+
+def after_bootstrap(method):
+    """
+    Decorate a WebexHandler method that needs to know who EnDroid is, so that
+    calls made before the client has looked that up wait for it. The method's
+    result is always given as a Deferred.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.when_bootstrapped(method, self, *args, **kwargs)
+    return wrapper
 
 # Provides messaging and room handling
 class WebexHandler(object): 
-    def __init__(self):
+    def __init__(self, cache_ttl=DEFAULT_TTL,
+                 attachment_max_size=DEFAULT_MAX_SIZE,
+                 attachment_downloads=DEFAULT_MAX_DOWNLOADS, clock=reactor):
         self.messagehandler = None
         self.usermanagement = None
         self.client = None
+        self.cache_ttl = cache_ttl
+        self.attachment_max_size = attachment_max_size
+        self.attachment_downloads = attachment_downloads
+        # Room details and memberships, set up once we have a client
+        self.cache = None
+        # Downloads received messages' attachments, set up with the cache
+        self.attachments = None
+        # The last known member emails of each room, updated whenever a
+        # member list is fetched or a membership notification arrives
+        self.room_members = {}
+        # Dict of room : set of users whose additions are awaiting processing
+        self._pending_adds = {}
+        # Counts of rooms 'total', 'done', 'unchanged' and 'failed' in the
+        # current (or last) reconciliation, which is None until it starts
+        self.reconciliation = None
+        self._reconciling = False
+        self.db = None
+        self._clock = clock
 
     @property
     def my_emails(self):
         return self.client.my_emails
 
+    def when_bootstrapped(self, fn, *args, **kwargs):
+        """
+        Call fn once the client has looked up EnDroid's identity (so
+        my_emails is known), returning a Deferred firing with its result.
+        """
+        if self.client is None or self.client.bootstrapped.called:
+            return defer.maybeDeferred(fn, *args, **kwargs)
+        d = defer.Deferred()
+
+        def bootstrapped(result):
+            defer.maybeDeferred(fn, *args, **kwargs).chainDeferred(d)
+            return result
+        self.client.bootstrapped.addCallback(bootstrapped)
+        return d
+
     def set_message_handler(self, mh): 
         self.messagehandler = mh
         # Can only join groups once the message handler is initialized. 
@@ -36,80 +102,285 @@ class WebexHandler(object):
 
     def setHandlerParent(self, client):
         self.client = client
+        self.cache = RoomCache(client.webex_api, self.cache_ttl,
+                               clock=self._clock)
+        self.attachments = AttachmentFetcher(client.webex_api,
+                                             self.attachment_max_size,
+                                             self.attachment_downloads)
+        self.db = Database(DB_NAME)
+        if not self.db.table_exists(DB_TABLE):
+            self.db.create_table(DB_TABLE, ('room', 'last_activity',
+                                            'roster'))
+
+    def schedule(self, category, fn, *args):
+        """
+        Queue inbound work (e.g. unhandled message fallbacks) behind the
+        messages already received, subject to the ingest queue's shedding.
+        """
+        if self.client is None:
+            fn(*args)
+        else:
+            self.client.queue.put(category, fn, *args)
 
     def getMemberList(self, room):
+        """
+        Get the list of member emails for a room. Returns a Deferred.
+
+        The result is also remembered in room_members, to answer synchronous
+        queries about who is present in a room.
+        """
         logging.info("Getting member list for room: %s", room)
-        if self.client is not None: 
-            users = self.client.webex_api.memberships.list(roomId=room)
-            members = list([user.personEmail for user in users])
-        else:
-            members = list()
+        if self.client is None:
+            return defer.succeed([])
 
-        return members
+        def got_members(users):
+            members = [user.personEmail for user in users]
+            self.room_members[room] = set(members)
+            return members
+
+        d = self.cache.memberships(room)
+        d.addCallback(got_members)
+        return d
 
     def getOwnerList(self, room):
+        """Get the list of moderator emails for a room. Returns a Deferred."""
         logging.info("Getting owner list for room")
-        if self.client is not None: 
-            users = self.client.webex_api.memberships.list(roomId=room)
-            owners = list([user.personEmail 
-                                        for user in users if user.isModerator])
-        else:
-            owners = list()
+        if self.client is None:
+            return defer.succeed([])
 
-        return owners
+        d = self.cache.memberships(room)
+        d.addCallback(lambda users: [user.personEmail
+                                     for user in users if user.isModerator])
+        return d
 
     def invite(self, user, room, reason):
-        logging.info("Adding person %s to room %s, reason: %s", 
-                     user, room, reason)
-        if self.client is not None and self._is_moderator(room):
-            self.client.webex_api.memberships.create(roomId=room, 
-                                                     personEmail=user)
+        """
+        Add a user to a room. Returns a Deferred firing with True if the user
+        was added or False if EnDroid isn't able to add members to the room.
+        """
+        d = self.invite_many([user], room, reason)
+        d.addCallback(lambda added: added[user])
+        return d
+
+    @after_bootstrap
+    def invite_many(self, users, room, reason):
+        """
+        Add several users to a room, a few at a time, checking the room's
+        memberships once. Returns a Deferred firing with a dict of user :
+        True if they were added (or were already present).
+        """
+        logging.info("Adding %s to room %s, reason: %s",
+                     ", ".join(sorted(users)), room, reason)
+
+        def do_invite(is_moderator):
+            if not is_moderator:
+                return dict((user, False) for user in users)
+            d = self.cache.memberships(room)
+            d.addCallback(create)
+            return d
+
+        def create(memberships):
+            present = set(membership.personEmail
+                          for membership in memberships)
+            added = dict((user, True) for user in users if user in present)
+            missing = [user for user in users if user not in present]
+            d = self._run_limited(
+                [(self.client.webex_api.memberships.create,
+                  dict(roomId=room, personEmail=user)) for user in missing])
+            d.addCallback(check_creates, missing, added)
+            return d
+
+        def check_creates(results, missing, added):
+            for user, (success, result) in zip(missing, results):
+                if success:
+                    self.cache.member_added(room, membership=result)
+                else:
+                    logging.error("Got exception adding %s to room: %s",
+                                  user, result.getErrorMessage())
+                added[user] = success
+            return added
+
+        return self._is_moderator(room).addCallback(do_invite)
+
+    @staticmethod
+    def _run_limited(calls):
+        """
+        Make (fn, kwargs) calls, MEMBERSHIP_CONCURRENCY at a time. Returns a
+        DeferredList of their results.
+        """
+        sem = defer.DeferredSemaphore(MEMBERSHIP_CONCURRENCY)
+        return defer.DeferredList([sem.run(fn, **kwargs)
+                                   for fn, kwargs in calls],
+                                  consumeErrors=True)
 
+    @after_bootstrap
     def kick(self, user, room, reason): 
+        """
+        Remove a user from a room. Returns a Deferred firing with True if the
+        user was removed or False if EnDroid isn't able to remove members from
+        the room.
+        """
         logging.info("Kicking person %s from room %s, reason: %s",
                       user, room, reason)
 
-        if self.client is not None and \
-           (user in self.my_emails or self._is_moderator(room)):
-            memberships = self.client.webex_api.memberships.list(
-                                                              roomId=room,
-                                                              personEmail=user)
-            for membership in memberships:
-                try:
-                    self.client.webex_api.memberships.delete(
-                                                    membershipId=membership.id)
-                except Exception:
-                    logging.exception("Got exception deleting user from room")
-
-    def chat(self, user, text):
+        def do_kick(can_kick):
+            if not can_kick:
+                return False
+            if user in self.my_emails:
+                # Leaving the room, so there's no point caching its members
+                d = self.client.webex_api.memberships.list(roomId=room,
+                                                           personEmail=user)
+                d.addCallback(left)
+            else:
+                d = self.cache.memberships(room)
+            d.addCallback(self._delete_memberships, room, [user])
+            d.addCallback(lambda kicked: kicked[user])
+            return d
+
+        def left(memberships):
+            self.cache.invalidate(room)
+            return memberships
+
+        if user in self.my_emails:
+            d = defer.succeed(True)
+        else:
+            d = self._is_moderator(room)
+        return d.addCallback(do_kick)
+
+    @after_bootstrap
+    def kick_many(self, users, room, reason):
+        """
+        Remove several users from a room, looking up the room's memberships
+        once. Returns a Deferred firing with a dict of user : True if they
+        were removed (or weren't present).
+        """
+        logging.info("Kicking %s from room %s, reason: %s",
+                     ", ".join(sorted(users)), room, reason)
+
+        def do_kick(can_kick):
+            if not can_kick:
+                return dict((user, False) for user in users)
+            d = self.cache.memberships(room)
+            d.addCallback(self._delete_memberships, room, users)
+            return d
+
+        return self._is_moderator(room).addCallback(do_kick)
+
+    def _can_moderate(self, room_info, memberships):
+        """
+        Synchronous version of _is_moderator, for when the room and its
+        memberships have already been fetched.
+        """
+        return not room_info.isLocked or any(
+            membership.isModerator for membership in memberships
+            if membership.personEmail in self.my_emails)
+
+    def _delete_memberships(self, memberships, room, users):
+        """
+        Delete the memberships belonging to any of users, a few at a time,
+        firing with a dict of user : True if all their memberships were
+        deleted.
+        """
+        memberships = [membership for membership in memberships
+                       if membership.personEmail in users]
+        deletes = [(self.client.webex_api.memberships.delete,
+                    dict(membershipId=membership.id))
+                   for membership in memberships]
+
+        def check_deletes(results):
+            kicked = dict((user, True) for user in users)
+            for membership, (success, result) in zip(memberships, results):
+                if not success:
+                    logging.error("Got exception deleting %s from room: %s",
+                                  membership.personEmail,
+                                  result.getErrorMessage())
+                    kicked[membership.personEmail] = False
+            for user, removed in kicked.items():
+                if removed:
+                    self.room_members.get(room, set()).discard(user)
+                    self.cache.member_removed(room, user)
+            return kicked
+
+        d = self._run_limited(deletes)
+        d.addCallback(check_deletes)
+        return d
+
+    def chat(self, user, text, coalesce=0):
         logging.info("Sending chat to user: %s", user)
 
         if self.client is not None:
-            self._send_message(text=text, toPersonEmail=user)
+            return self._send_message(user, text, coalesce,
+                                      toPersonEmail=user)
+        return defer.succeed(False)
 
-    def groupChat(self, room, text):
+    def groupChat(self, room, text, coalesce=0):
         logging.info("Sending chat to room: %s", room)
         if self.client is not None:
-            self._send_message(text=text, roomId=room)
+            return self._send_message(room, text, coalesce, roomId=room)
+        return defer.succeed(False)
 
-    def _send_message(self, text, **kwargs):
-        chunk = text[0:MAX_MESSAGE_LEN]
-        self.client.webex_api.messages.create(text=chunk, **kwargs)
-        if len(text) > MAX_MESSAGE_LEN:
-            reactor.callLater(0, self._send_message, text[MAX_MESSAGE_LEN:],
-                              **kwargs)
+    def updatable(self, destination, direct=False,
+                  interval=DEFAULT_UPDATE_INTERVAL):
+        """
+        Return a MessageUpdater for a message to a room (or, if direct, to a
+        user), to be sent with its start method and then edited in place.
+        """
+        if direct:
+            fields = dict(toPersonEmail=destination)
+        else:
+            fields = dict(roomId=destination)
+        return MessageUpdater(self.client.outbound, destination, interval,
+                              **fields)
+
+    def _send_message(self, destination, text, coalesce, **kwargs):
+        """
+        Send text, split at line or word boundaries into chunks the API will
+        accept, via the client's outbound queue (which sends the chunks in
+        order, and coalesces short messages sent within coalesce seconds of
+        each other). Returns a Deferred firing with True once every chunk
+        has been sent, or False if any failed.
+        """
+        chunks = chunk_text(text)
+        d = defer.gatherResults([self.client.outbound.send(destination,
+                                                           coalesce,
+                                                           text=chunk,
+                                                           **kwargs)
+                                 for chunk in chunks], consumeErrors=True)
+        d.addCallbacks(lambda _: True, self._send_failed)
+        return d
+
+    def _send_failed(self, failure):
+        if failure.check(defer.FirstError):
+            failure = failure.value.subFailure
+        self._log_api_error(failure, "Failed to send message")
+        return False
+
+    def _log_api_error(self, failure, description):
+        logging.error("%s: %s", description, failure.getErrorMessage())
 
     def _is_moderator(self, room):
+        """
+        Determine whether EnDroid can manage the membership of a room (either
+        the room isn't locked or EnDroid is a moderator). Returns a Deferred.
+        """
         if self.client is None:
-            return False
-        elif self.client.webex_api.rooms.get(room).isLocked and not \
-             self.my_emails[0] in self.getOwnerList(room):
-            logging.info("Endroid is not a moderator for room %s", room)
-            logging.info(self.getMemberList(room))
-            return False
-        else:
+            return defer.succeed(False)
+
+        def check_locked(room_info):
+            if not room_info.isLocked:
+                return True
+            return self.getOwnerList(room).addCallback(check_owner)
+
+        def check_owner(owners):
+            if not any(email in owners for email in self.my_emails):
+                logging.info("Endroid is not a moderator for room %s", room)
+                return False
             return True
 
+        d = self.cache.room(room)
+        d.addCallback(check_locked)
+        return d
+
     def _remove_tag(self, message):
         prefix = '>'
         suffix = '</spark-mention>'
@@ -129,12 +400,113 @@ class WebexHandler(object):
         return text
 
     def connected(self):
-        if self.client is not None:
-            rooms = self.client.webex_api.rooms.list()
-            # rejoin and sanitize multi-person rooms
-            for room in rooms:
-                if room.type == 'group':
-                    self.usermanagement.self_joined_room(room.id, remove=True)
+        if self.client is None:
+            return
+        if self._reconciling:
+            logging.info("Rooms are still being reconciled from the last "
+                         "connection")
+            return
+        self._reconciling = True
+        self.reconciliation = None
+        d = self.client.webex_api.rooms.list(type='group')
+        d.addCallback(self._rejoin_rooms)
+        d.addErrback(self._log_api_error, "Failed to list rooms")
+        d.addBoth(self._reconciled)
+        return d
+
+    def _rejoin_rooms(self, rooms):
+        """
+        Rejoin and sanitize multi-person rooms. Plugins are started in every
+        room straight away, then the rooms' members are checked a few rooms
+        at a time in the background, skipping rooms that haven't changed
+        since they were last checked. Returns a Deferred firing once all the
+        rooms have been checked.
+        """
+        rooms = [room for room in rooms if room.type == 'group']
+        for room in rooms:
+            self.usermanagement.start_room(room.id)
+
+        self.reconciliation = {'total': len(rooms), 'done': 0,
+                               'unchanged': 0, 'failed': 0}
+        logging.info("Reconciling membership of %u rooms", len(rooms))
+        sem = defer.DeferredSemaphore(RECONCILE_CONCURRENCY)
+        return defer.gatherResults([sem.run(self._reconcile_room, room)
+                                    for room in rooms])
+
+    def _reconcile_room(self, room):
+        roster = self.usermanagement.room_roster_key(room.id)
+        stored = self.db.fetch(DB_TABLE, ['last_activity', 'roster'],
+                               {'room': room.id})
+        if (room.lastActivity is not None and stored and
+                stored[0]['last_activity'] == room.lastActivity and
+                stored[0]['roster'] == roster):
+            self._room_reconciled(True, room, roster, unchanged=True)
+            if room.id not in self.usermanagement.rooms():
+                return defer.succeed(None)
+            # Nothing to sanitize, but the members are needed to answer who
+            # is present in the room
+            d = self.getMemberList(room.id)
+            d.addErrback(self._log_api_error,
+                         "Failed to get member list for {}".format(room.id))
+            return d
+
+        d = self.usermanagement.self_joined_room(room.id, remove=True)
+        d.addErrback(lambda f: logging.error("Failed to reconcile room %s: "
+                                             "%s", room.id,
+                                             f.getErrorMessage()))
+        d.addCallback(self._room_reconciled, room, roster)
+        return d
+
+    def _room_reconciled(self, success, room, roster, unchanged=False):
+        """
+        Record the outcome of reconciling a room. Successfully reconciled
+        rooms are remembered, to be skipped next time if nothing changes.
+        """
+        progress = self.reconciliation
+        progress['done'] += 1
+        if unchanged:
+            progress['unchanged'] += 1
+        elif success:
+            self.db.delete(DB_TABLE, {'room': room.id})
+            self.db.insert(DB_TABLE, {'room': room.id,
+                                      'last_activity': room.lastActivity,
+                                      'roster': roster})
+        else:
+            progress['failed'] += 1
+        if progress['done'] % RECONCILE_PROGRESS_EVERY == 0:
+            logging.info("Reconciled %(done)u of %(total)u rooms "
+                         "(%(unchanged)u unchanged, %(failed)u failed)",
+                         progress)
+
+    def _reconciled(self, result):
+        self._reconciling = False
+        if self.reconciliation is not None:
+            logging.info("Finished reconciling %(done)u rooms "
+                         "(%(unchanged)u unchanged, %(failed)u failed)",
+                         self.reconciliation)
+
+    # called by Webex client before it fetches a message
+    # we use it to avoid fetching messages that no plugin will see
+    def accept_activity(self, sender, room, direct):
+        """
+        Decide from the sender and room (the configured room ID, or None for
+        a direct room) of a websocket activity whether the message needs to
+        be fetched. Messages EnDroid sent itself are only
+        fetched if a plugin registered for them, and messages from other users
+        must get past the sender filters (e.g. the blacklist).
+        """
+        if self.messagehandler is None or sender is None:
+            return True
+
+        if direct:
+            place, recipient = 'chat', self.my_emails[0]
+        else:
+            place, recipient = 'muc', room
+
+        if sender in self.my_emails:
+            name = sender if direct else recipient
+            return self.messagehandler.handles_self(place, name)
+        return self.messagehandler.accept_sender(place, sender, recipient)
 
     # called by Webex client
     # we use it to pass the message onto our messagehandler
@@ -156,6 +528,7 @@ class WebexHandler(object):
                         logging.info("New message: %s", text)
                         m = Message('muc', message.personEmail, text, 
                                     self.messagehandler, message.roomId)
+                        m.attachments = self._attachments(message)
                         self.messagehandler.receive_muc(m)
                     else: 
                         self.groupChat(message.roomId, 
@@ -174,16 +547,74 @@ class WebexHandler(object):
                 else:
                     logging.info("Direct message received from %s",
                                  message.personEmail)
+                    m.attachments = self._attachments(message)
                     self.messagehandler.receive_chat(m)
 
+    def _attachments(self, message):
+        """Return a (not yet downloaded) Attachment for each attached file."""
+        return [Attachment(url, self.attachments)
+                for url in message.files or ()]
+
+    # called by Webex client as soon as an activity changing a room arrives
+    # we use it to keep the room cache up to date
+    def onRoomChange(self, room, verb, user):
+        if verb == 'add':
+            self.cache.member_added(room, email=user)
+        elif verb == 'leave':
+            self.room_members.get(room, set()).discard(user)
+            self.cache.member_removed(room, user)
+        elif verb in ('assignModerator', 'unassignModerator'):
+            self.cache.invalidate(room, details=False)
+        else:
+            # Locked, unlocked or otherwise updated
+            self.cache.invalidate(room)
+
     # called by Webex client
     # we use it to pass the membership notification onto our usermanagement
+    # Notifications are batched up per room, as adding many people to a room
+    # results in a burst of them
     def onMembership(self, room, user):
-        logging.info("User %s added to room %s",
-                     user,
-                     self.client.webex_api.rooms.get(room).title)
+        self.room_members.setdefault(room, set()).add(user)
+        if room not in self._pending_adds:
+            self._pending_adds[room] = set()
+            self._clock.callLater(MEMBERSHIP_BATCH_WINDOW, self._process_adds,
+                                  room)
+        self._pending_adds[room].add(user)
 
-        if user in self.client.my_emails:
+    @after_bootstrap
+    def _process_adds(self, room):
+        """
+        Process a burst of additions to a room with one lookup of the room and
+        its memberships, kicking any unexpected members in one go.
+        """
+        users = self._pending_adds.pop(room)
+        if any(user in self.client.my_emails for user in users):
+            # This checks all the room's members anyway
             self.usermanagement.self_joined_room(room, remove=True)
-        else:
-            self.usermanagement.user_joined_room(room, user, remove=True)
\ No newline at end of file
+            return
+
+        def got_room(results):
+            room_info, memberships = results
+            logging.info("Users %s added to room %s",
+                         ", ".join(sorted(users)), room_info.title)
+            members = [membership.personEmail for membership in memberships]
+            self.room_members[room] = set(members)
+
+            unexpected = self.usermanagement.unexpected_members(room, members)
+            if not unexpected:
+                return
+            reason = "Unexpected user added to room"
+            logging.info("Kicking %s from room %s, reason: %s",
+                         ", ".join(sorted(unexpected)), room, reason)
+            if not self._can_moderate(room_info, memberships):
+                logging.error("Not permitted to kick %s from %s (%s)",
+                              ", ".join(sorted(unexpected)), room, reason)
+                return
+            d = self._delete_memberships(memberships, room, unexpected)
+            d.addCallback(self.usermanagement.log_kicks, room, reason)
+
+        d = defer.gatherResults([self.cache.room(room),
+                                 self.cache.memberships(room)],
+                                consumeErrors=True)
+        d.addCallbacks(got_room, self._log_api_error,
+                       errbackArgs=("Failed to look up room {}".format(room),))